@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# Benchmarks the bundling pipeline of lima-and-qemu.py against a synthetic Homebrew prefix, so its
+# scaling can be measured well beyond the ~115 deps of today's bundle without a Mac, Homebrew or VMs.
+#
+# For every scale a prefix with about scale × 115 deps is generated: Cellar kegs with versioned dylibs
+# that reference each other through opt paths, opt symlink chains (opt/<name>@<major> → opt/<name> →
+# ../Cellar/<name>/<version>) and relative ".." links, plus an fs_usage log of the templates touching
+# them. codesign and limactl are replaced by stand-ins on PATH. The timings are written to a JSON file,
+# and compared against a previous one with --baseline to catch regressions.
+#
+# Only timings are checked here, nothing about the output of the steps is. Their correctness is
+# covered by the tests in bin/tests ("make test-scripts"), whose helpers build the synthetic inputs.
+import argparse
+import contextlib
+import gzip
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# the prefix is built from the same synthetic Mach-O images and fs_usage lines as the fixtures of the tests
+sys.path.insert(0, os.path.join(BIN_DIR, "tests"))
+from helpers import fs_usage_line, macho_image
+
+# the number of deps the bundle has today, scales are multiples of it
+BASE_DEPS = 115
+# a package contributes about this many deps: its dylib, its opt link and every other alias or compat link
+DEPS_PER_PACKAGE = 4
+QEMU_VERSION = "9.0.2_1"
+LIMA_VERSION = "1.0.1"
+
+STEPS = [
+    "record_dep",
+    "opt_index",
+    "parse_fs_usage_log",
+    "load_command_closure",
+    "verify_dependencies",
+    "copy_deps",
+    "copy_deps_incremental",
+    "resign",
+    "package",
+    "compress",
+]
+
+STAND_INS = {
+    "codesign": """#!/bin/sh
+# stand-in codesign: "-d --entitlements" reports the hypervisor entitlement, signing only takes CODESIGN_SECONDS
+if [ "$1" = "-d" ]; then echo "[Key] com.apple.security.hypervisor"; exit 0; fi
+sleep "${CODESIGN_SECONDS:-0}"
+""",
+    "limactl": f"""#!/bin/sh
+echo "limactl version {LIMA_VERSION}"
+""",
+}
+
+def main():
+    args = parse_args()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="lima-and-qemu-benchmark-")
+    # the cache directory is read when the script is loaded, so it has to be set first
+    os.environ["LIMA_AND_QEMU_CACHE_DIR"] = f"{work_dir}/cache"
+    os.environ["CODESIGN_SECONDS"] = str(args.codesign_seconds)
+    lq = load_build_script()
+    arch = lq.Arch(args.arch)
+
+    try:
+        install_stand_ins(f"{work_dir}/stand-ins")
+        results = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "host": {
+                "platform": platform.platform(),
+                "machine": platform.machine(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+            },
+            "arch": arch.value,
+            "repeat": args.repeat,
+            "scales": {},
+        }
+        for scale in args.scales:
+            print(f"=== scale {scale}x ===")
+            results["scales"][str(scale)] = benchmark_scale(lq, arch, scale, f"{work_dir}/scale-{scale}", args)
+
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compare_results(baseline, results, args.max_slowdown, args.min_slowdown_seconds)
+            if regressions:
+                print(f"{len(regressions)} steps regressed against {args.baseline}:")
+                for regression in regressions:
+                    print(f"  {regression}")
+                sys.exit(1)
+            print(f"No regressions against {args.baseline}")
+    finally:
+        if args.work_dir is None and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        elif args.keep:
+            print(f"Kept {work_dir}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the bundling pipeline of lima-and-qemu.py against a synthetic Homebrew prefix")
+    parser.add_argument(
+        "--scales",
+        type=lambda value: [int(scale) for scale in value.split(",")],
+        default=[10, 100],
+        help=f"comma separated multiples of today's ~{BASE_DEPS} deps to benchmark (default: 10,100)",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per step, the median is reported (default: 3)")
+    parser.add_argument("--arch", choices=["aarch64", "x86_64"], default="aarch64", help="arch the prefix is generated for; on aarch64 every relinked file is resigned (default: aarch64)")
+    parser.add_argument("--dylib-size", type=int, default=64 << 10, help="size in bytes of every generated dylib (default: 65536)")
+    parser.add_argument("--fs-usage-noise", type=int, default=20, help="unrelated fs_usage lines per traced file access (default: 20)")
+    parser.add_argument("--codesign-seconds", type=float, default=0.0, help="time the codesign stand-in takes per file (default: 0)")
+    parser.add_argument("--copy-workers", type=int, default=min(32, (os.cpu_count() or 1) + 4))
+    parser.add_argument("--sign-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--compression-level", type=int, default=9)
+    parser.add_argument("--compression-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", default="lima-and-qemu-benchmark.json", help="file the results are written to (default: lima-and-qemu-benchmark.json)")
+    parser.add_argument("--baseline", help="results of a previous run; exits with 1 if a step got slower than --max-slowdown allows")
+    parser.add_argument("--max-slowdown", type=float, default=1.25, help="factor a step may get slower than the baseline (default: 1.25)")
+    parser.add_argument(
+        "--min-slowdown-seconds",
+        type=float,
+        default=0.05,
+        help="slowdowns of less than this many seconds are never regressions, they are mostly noise (default: 0.05)",
+    )
+    parser.add_argument("--work-dir", help="directory the prefixes are generated in (default: a temporary directory that is removed afterwards)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    return parser.parse_args()
+
+def load_build_script():
+    spec = importlib.util.spec_from_file_location("lima_and_qemu", os.path.join(BIN_DIR, "lima-and-qemu.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def install_stand_ins(stand_in_dir: str):
+    os.makedirs(stand_in_dir, exist_ok=True)
+    for name, script in STAND_INS.items():
+        path = os.path.join(stand_in_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = f"{stand_in_dir}:{os.environ['PATH']}"
+
+def benchmark_scale(lq, arch, scale: int, scale_dir: str, args: argparse.Namespace) -> dict:
+    install_dir = f"{scale_dir}/prefix"
+    dist_path = f"{scale_dir}/dist"
+    build_dir = f"{scale_dir}/build"
+    log_file = f"{scale_dir}/fs_usage.log"
+    packages = max(1, BASE_DEPS * scale // DEPS_PER_PACKAGE)
+
+    start = time.monotonic()
+    traced = generate_prefix(install_dir, arch, packages, args.dylib_size, random.Random(scale))
+    log_lines = generate_fs_usage_log(log_file, install_dir, arch, traced, args.fs_usage_noise, random.Random(scale))
+    os.makedirs(f"{build_dir}/src/lima", exist_ok=True)
+    print(f"generated {packages} packages and {log_lines} fs_usage lines in {time.monotonic() - start:.2f}s")
+
+    timings: Dict[str, List[float]] = {step: [] for step in STEPS}
+    deps = {}
+    cwd = os.getcwd()
+    os.chdir(build_dir)
+    try:
+        for run in range(args.repeat):
+            # the build script reports every file it handles, which would drown the results
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                deps = benchmark_run(lq, arch, install_dir, dist_path, traced, log_file, args, timings)
+            print(f"run {run + 1}: " + ", ".join(f"{step} {timings[step][-1]:.3f}s" for step in STEPS))
+    finally:
+        os.chdir(cwd)
+
+    return {
+        "packages": packages,
+        "deps": len(deps),
+        "fs_usage_lines": log_lines,
+        "steps": {
+            step: {"median": statistics.median(seconds), "min": min(seconds), "runs": seconds}
+            for step, seconds in timings.items()
+        },
+    }
+
+def benchmark_run(lq, arch, install_dir: str, dist_path: str, traced: List[str], log_file: str, args: argparse.Namespace, timings: Dict[str, List[float]]) -> dict:
+    def timed(step: str, fn: Callable):
+        start = time.perf_counter()
+        result = fn()
+        timings[step].append(time.perf_counter() - start)
+        return result
+
+    # the persistent state of a previous run would turn the cold steps into cache hits
+    shutil.rmtree(lq.CACHE_DIR, ignore_errors=True)
+    shutil.rmtree(dist_path, ignore_errors=True)
+    if os.path.exists(f"{dist_path}.manifest.json"):
+        os.unlink(f"{dist_path}.manifest.json")
+
+    def record_deps():
+        resolver = lq.DepResolver(install_dir)
+        lq.record_initial_deps(arch, resolver, QEMU_VERSION)
+        for path in traced:
+            resolver.record(path)
+        return resolver.deps
+    timed("record_dep", record_deps)
+
+    opt_index = lq.OptInodeIndex(install_dir)
+    timed("opt_index", opt_index.build)
+
+    resolver = lq.DepResolver(install_dir)
+    lq.record_initial_deps(arch, resolver, QEMU_VERSION)
+    consumer = lq.TraceConsumer(resolver, opt_index)
+    timed("parse_fs_usage_log", lambda: lq.parse_fs_usage_log(log_file, arch, consumer))
+    deps = resolver.deps
+
+    def load_command_closure():
+        closure_resolver = lq.DepResolver(install_dir)
+        lq.record_initial_deps(arch, closure_resolver, QEMU_VERSION)
+        lq.record_load_command_closure(lq.TraceConsumer(closure_resolver, opt_index), [f"{install_dir}/bin/qemu-img", f"{install_dir}/bin/qemu-system-{arch}"])
+    timed("load_command_closure", load_command_closure)
+
+    # verifies against the deps themselves, so all of the comparison is done and it passes
+    with open(lq.verification_file_name(arch), "w") as f:
+        for path in sorted(deps.keys()):
+            f.write(f"{path} {deps[path]}\n")
+    timed("verify_dependencies", lambda: lq.verify_dependencies(deps, arch, install_dir))
+
+    _, resign_files, manifest = timed("copy_deps", lambda: lq.copy_deps(deps, arch, install_dir, args.copy_workers, dist_path))
+    timed("resign", lambda: lq.resign(resign_files, manifest, args.sign_workers))
+    timed("copy_deps_incremental", lambda: lq.copy_deps(deps, arch, install_dir, args.copy_workers, dist_path))
+
+    archive_path, _ = timed(
+        "package",
+        lambda: lq.package_files_and_socket_vmnet(
+            deps,
+            install_dir,
+            dist_path,
+            LIMA_VERSION,
+            compression_level=args.compression_level,
+            compression_workers=args.compression_workers,
+        ),
+    )
+
+    # compression on its own, without reading the dist tree
+    with gzip.open(archive_path, "rb") as f:
+        tar_data = f.read()
+    def compress():
+        with open(os.devnull, "wb") as f:
+            with lq.ParallelGzipWriter(lq.DigestWriter(f), args.compression_level, workers=args.compression_workers) as gz:
+                for offset in range(0, len(tar_data), 1 << 16):
+                    gz.write(tar_data[offset:offset + (1 << 16)])
+    timed("compress", compress)
+    return deps
+
+# Generates a Homebrew prefix with qemu, limactl and the given number of library packages, returning
+# the paths the templates would open, the way they are reported by fs_usage
+def generate_prefix(install_dir: str, arch, packages: int, dylib_size: int, rng: random.Random) -> List[str]:
+    shutil.rmtree(install_dir, ignore_errors=True)
+    traced = []
+
+    def write(rel_path: str, data: bytes):
+        path = f"{install_dir}/{rel_path}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def link(rel_path: str, target: str):
+        path = f"{install_dir}/{rel_path}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.symlink(target, path)
+
+    def payload(size: int) -> bytes:
+        # half of it compresses like code, the other half not at all
+        return rng.randbytes(size // 2) + bytes(range(256)) * (size // 2 // 256)
+
+    opt_dylibs = []
+    for i in range(packages):
+        name = f"pkg{i}"
+        major = i % 3 + 1
+        version = f"{major}.{i}.0" + ("_1" if i % 5 == 0 else "")
+        dylib = f"lib{name}.{major}.dylib"
+        refs = [f"{install_dir}/opt/pkg{j}/lib/libpkg{j}.{j % 3 + 1}.dylib" for j in {(i + 1) % packages, (i + 7) % packages} if j != i]
+        write(f"Cellar/{name}/{version}/lib/{dylib}", macho_image([f"{install_dir}/opt/{name}/lib/{dylib}"], refs, payload(dylib_size)))
+        link(f"Cellar/{name}/{version}/lib/lib{name}.dylib", dylib)
+        link(f"opt/{name}", f"../Cellar/{name}/{version}")
+        if i % 3 == 0:
+            link(f"opt/{name}@{major}", name)
+        if i % 4 == 0:
+            link(f"Cellar/{name}/{version}/lib/compat/lib{name}.dylib", f"../../lib/{dylib}")
+            traced.append(f"{install_dir}/Cellar/{name}/{version}/lib/compat/lib{name}.dylib")
+        opt_dylibs.append(f"{install_dir}/opt/{name}/lib/{dylib}")
+    traced += opt_dylibs
+
+    qemu = f"Cellar/qemu/{QEMU_VERSION}"
+    system_refs = opt_dylibs[:max(1, packages // 2)]
+    write(f"{qemu}/bin/qemu-system-{arch}", macho_image([], system_refs, payload(dylib_size * 4)))
+    write(f"{qemu}/bin/qemu-img", macho_image([], opt_dylibs[:1], payload(dylib_size)))
+    for i in range(max(1, packages // 8)):
+        write(f"{qemu}/share/qemu/rom{i}.bin", payload(dylib_size // 4))
+        traced.append(f"{install_dir}/share/qemu/rom{i}.bin")
+    link(f"bin/qemu-system-{arch}", f"../{qemu}/bin/qemu-system-{arch}")
+    link("bin/qemu-img", f"../{qemu}/bin/qemu-img")
+    link("share/qemu", f"../{qemu}/share/qemu")
+    link("opt/qemu", f"../{qemu}")
+    write("bin/limactl", macho_image([], [], payload(dylib_size * 4)))
+    return traced
+
+def generate_fs_usage_log(log_file: str, install_dir: str, arch, traced: List[str], noise: int, rng: random.Random) -> int:
+    processes = [f"qemu-system-{arch}.4242", "qemu-img.4243", "limactl.4244"]
+    lines = 0
+    with open(log_file, "w") as f:
+        for i, path in enumerate(traced * 3):
+            # some of the accesses are reported relative to the working directory
+            if i % 7 == 0:
+                path = f"../{path.removeprefix(f'{install_dir}/')}"
+            f.write(fs_usage_line(lines, "open", path, rng.choice(processes)))
+            lines += 1
+            for _ in range(noise):
+                f.write(fs_usage_line(lines, rng.choice(["open", "read", "stat64", "fstat64"]), f"/System/Library/Frameworks/Hypervisor.framework/Versions/A/file{rng.randrange(1000)}", rng.choice(processes)))
+                lines += 1
+    return lines
+
+# Returns a description of every step that got slower than allowed compared to the baseline
+def compare_results(baseline: dict, results: dict, max_slowdown: float, min_slowdown_seconds: float) -> List[str]:
+    if baseline.get("host") != results["host"]:
+        print(f"WARNING: the baseline was measured on a different host: {baseline.get('host')}")
+
+    regressions = []
+    print(f"{'scale':>6} {'step':<24} {'baseline':>10} {'current':>10} {'change':>8}")
+    for scale, scale_results in results["scales"].items():
+        baseline_scale: Optional[dict] = baseline.get("scales", {}).get(scale)
+        if baseline_scale is None:
+            print(f"WARNING: scale {scale}x is not in the baseline")
+            continue
+        for step, step_results in scale_results["steps"].items():
+            baseline_step = baseline_scale["steps"].get(step)
+            if baseline_step is None: continue
+            before, after = baseline_step["median"], step_results["median"]
+            change = after / before if before else float("inf")
+            print(f"{scale + 'x':>6} {step:<24} {before:>9.3f}s {after:>9.3f}s {change:>7.2f}x")
+            if change > max_slowdown and after - before > min_slowdown_seconds:
+                regressions.append(f"{step} at {scale}x: {before:.3f}s -> {after:.3f}s ({change:.2f}x)")
+    return regressions
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# Downloads the artifacts described by deps/*.conf files, like deps/install.sh, but all of them at once.
+# Connections are kept alive and reused per host, interrupted downloads are resumed with HTTP Range
+# requests, and the digest is computed while the artifact streams in instead of in a second pass.
+# Verified artifacts are kept in a cache keyed by their digest, so they are never downloaded again.
+#
+# Usage: fetch-deps.py --arch <arm64|x86_64> <SOURCES_FILE>[=<FILEPATH>]...
+import argparse
+import fcntl
+import hashlib
+import http.client
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, NamedTuple, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+CACHE_DIR = os.getenv("FETCH_DEPS_CACHE_DIR", os.path.expanduser("~/.cache/finch-core/artifacts"))
+
+# the conf file prefix of every --arch, as in deps/install.sh
+ARCH_PREFIXES = {"arm64": "AARCH64", "x86_64": "X86_64"}
+
+MAX_REDIRECTS = 10
+
+class Artifact(NamedTuple):
+    conf: str
+    url: str
+    algorithm: str
+    digest: str
+    output: str
+
+    @property
+    def cache_path(self) -> str:
+        return os.path.join(CACHE_DIR, self.algorithm, self.digest)
+
+def main():
+    args = parse_args()
+    artifacts = []
+    for source in args.sources:
+        conf, _, output = source.partition("=")
+        artifacts.append(load_artifact(conf, args.arch, output or None, args.output_dir, args.base_url))
+
+    pool = ConnectionPool(args.timeout)
+    start = time.monotonic()
+    failures = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(fetch, artifact, pool, args.retries): artifact for artifact in artifacts}
+        for future in as_completed(futures):
+            artifact = futures[future]
+            try:
+                action, size, seconds = future.result()
+                print(f"{action:>10} {artifact.output} ({size} bytes, {seconds:.2f}s)")
+            except Exception as ex:
+                print(f"ERROR: failed to fetch {artifact.url} for {artifact.conf}: {ex}")
+                failures.append(artifact)
+    pool.close()
+
+    print(f"fetched {len(artifacts) - len(failures)} of {len(artifacts)} artifacts in {time.monotonic() - start:.2f}s")
+    if failures:
+        sys.exit(1)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Downloads and verifies the artifacts of deps/*.conf files concurrently.")
+    parser.add_argument(
+        "sources",
+        nargs="+",
+        metavar="SOURCES_FILE[=FILEPATH]",
+        help="conf file of an artifact, optionally with the path to write it to (default: the artifact name in --output-dir)",
+    )
+    parser.add_argument("--arch", "-a", choices=list(ARCH_PREFIXES), required=True)
+    parser.add_argument("--output-dir", "-o", default=".", help="directory artifacts without a FILEPATH are written to (default: .)")
+    parser.add_argument("--base-url", help="URL to use instead of the ARTIFACT_BASE_URL of every conf file, e.g. a mirror")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="number of artifacts downloaded at the same time (default: 4)")
+    parser.add_argument("--retries", type=int, default=3, help="times an interrupted download is resumed (default: 3)")
+    parser.add_argument("--timeout", type=float, default=60, help="socket timeout in seconds (default: 60)")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.retries < 0:
+        parser.error("--retries must not be negative")
+    return args
+
+# Reads the KEY=value assignments of a conf file, which deps/install.sh sources as a shell script
+def read_conf(path: str) -> Dict[str, str]:
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"): continue
+                match = re.match(r'^([A-Za-z_][A-Za-z0-9_]*)=(.*)$', line)
+                if not match: continue
+                key, value = match.groups()
+                if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+                    value = value[1:-1]
+                values[key] = value
+    except OSError as ex:
+        raise RuntimeError(f"failed to read {path}") from ex
+    return values
+
+def load_artifact(conf: str, arch: str, output: Optional[str], output_dir: str, base_url: Optional[str]) -> Artifact:
+    values = read_conf(conf)
+    prefix = ARCH_PREFIXES[arch]
+    artifact = values.get(f"{prefix}_ARTIFACT")
+    if "ARTIFACT_BASE_URL" not in values or not artifact:
+        raise RuntimeError(f"{conf} describes no {arch} artifact")
+
+    url = base_url or values["ARTIFACT_BASE_URL"]
+    pathing = values.get(f"{prefix}_ARTIFACT_PATHING")
+    if pathing:
+        url = f"{url}/{pathing}"
+
+    # deps/install.sh only knows SHA-512 digests, some conf files only have a SHA-256 one
+    for algorithm, key in [("sha512", f"{prefix}_512_DIGEST"), ("sha256", f"{prefix}_256_DIGEST")]:
+        if values.get(key):
+            return Artifact(conf, f"{url}/{artifact}", algorithm, values[key].lower(), output or os.path.join(output_dir, artifact))
+    raise RuntimeError(f"{conf} has no digest for the {arch} artifact")
+
+# Keeps idle connections per (scheme, host) so that artifacts from the same host reuse them
+class ConnectionPool:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._idle: Dict[Tuple[str, str], "queue.Queue[http.client.HTTPConnection]"] = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), queue.Queue())
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            pass
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        if scheme == "http":
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        raise RuntimeError(f"unsupported URL scheme {scheme}")
+
+    # Only connections whose last response was read completely can be reused
+    def put(self, scheme: str, netloc: str, connection: http.client.HTTPConnection):
+        with self._lock:
+            self._idle[(scheme, netloc)].put(connection)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                while not idle.empty():
+                    idle.get_nowait().close()
+
+# Sends a GET for url, following redirects, and returns the connection and the final response
+def request(pool: ConnectionPool, url: str, headers: Dict[str, str]) -> Tuple[str, http.client.HTTPConnection, http.client.HTTPResponse]:
+    for _ in range(MAX_REDIRECTS):
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        connection = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path or "/", headers=headers)
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            # an idle connection may have been closed by the server, retry on a new one
+            connection.close()
+            connection = pool.get(parts.scheme, parts.netloc)
+            connection.request("GET", path or "/", headers=headers)
+            response = connection.getresponse()
+        if response.status not in (301, 302, 303, 307, 308):
+            return url, connection, response
+        response.read()
+        pool.put(parts.scheme, parts.netloc, connection)
+        url = urljoin(url, response.getheader("Location"))
+    raise RuntimeError(f"too many redirects for {url}")
+
+# Puts the artifact in place from the cache, downloading it into the cache first if needed.
+# Returns what was done, the size and how long it took.
+def fetch(artifact: Artifact, pool: ConnectionPool, retries: int) -> Tuple[str, int, float]:
+    start = time.monotonic()
+    action = "cached"
+    # conf files for different outputs may name the same artifact
+    with _cache_lock(artifact.cache_path):
+        if not os.path.isfile(artifact.cache_path):
+            action = download(artifact, pool, retries)
+    install(artifact.cache_path, artifact.output)
+    return action, os.path.getsize(artifact.output), time.monotonic() - start
+
+# Serializes the download of an artifact between the threads of this run and other runs sharing the
+# cache. flock() locks belong to the open file, so threads that open the lock file each are excluded too.
+@contextmanager
+def _cache_lock(cache_path: str):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(f"{cache_path}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+# The output is a copy, so changing it can't corrupt the cache entry
+def install(cache_path: str, output: str):
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp_path = f"{output}.tmp"
+    shutil.copyfile(cache_path, tmp_path)
+    os.replace(tmp_path, output)
+
+# Downloads into <digest>.partial next to the cache entry and hashes the bytes as they are written.
+# Whatever is in the partial file from an earlier, interrupted attempt or run is hashed first and
+# only the rest is requested. The partial file becomes the cache entry once its digest matches.
+def download(artifact: Artifact, pool: ConnectionPool, retries: int) -> str:
+    partial_path = f"{artifact.cache_path}.partial"
+    os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+    resumed = False
+    attempt = 0
+    while True:
+        digest = hashlib.new(artifact.algorithm)
+        offset = 0
+        if os.path.isfile(partial_path):
+            with open(partial_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+                    offset += len(chunk)
+        try:
+            offset, digest = _download_from(artifact, pool, partial_path, offset, digest)
+            break
+        except (OSError, http.client.HTTPException) as ex:
+            if attempt == retries:
+                raise RuntimeError(f"download failed after {retries} retries") from ex
+            print(f"WARNING: download of {artifact.url} interrupted, resuming: {ex}")
+            attempt += 1
+            resumed = True
+
+    if digest.hexdigest() != artifact.digest:
+        os.unlink(partial_path)
+        raise RuntimeError(f"{artifact.algorithm} of {artifact.url} is {digest.hexdigest()}, expected {artifact.digest}")
+    os.replace(partial_path, artifact.cache_path)
+    return "resumed" if resumed else "downloaded"
+
+# Appends the artifact from offset on to partial_path, returning the size of partial_path and the
+# digest of its content, which starts over if the server doesn't support ranges
+def _download_from(artifact: Artifact, pool: ConnectionPool, partial_path: str, offset: int, digest) -> Tuple[int, object]:
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    url, connection, response = request(pool, artifact.url, headers)
+    parts = urlsplit(url)
+    try:
+        if response.status == 416 and offset:
+            # the partial file is complete already, or longer than the artifact; the digest decides
+            response.read()
+            pool.put(parts.scheme, parts.netloc, connection)
+            return offset, digest
+        if response.status == 206:
+            content_range = response.getheader("Content-Range", "")
+            if not content_range.startswith(f"bytes {offset}-"):
+                raise RuntimeError(f"GET {url} returned range {content_range}, requested bytes={offset}-")
+        elif response.status == 200:
+            if offset:
+                print(f"{url} doesn't support resuming, downloading it again")
+                offset = 0
+                digest = hashlib.new(artifact.algorithm)
+        else:
+            raise RuntimeError(f"GET {url} returned {response.status} {response.reason}")
+
+        expected = response.getheader("Content-Length")
+        received = 0
+        with open(partial_path, "ab" if offset else "wb") as f:
+            for chunk in iter(lambda: response.read(1 << 20), b""):
+                f.write(chunk)
+                digest.update(chunk)
+                received += len(chunk)
+        offset += received
+        # read() returns what arrived if the connection is closed early
+        if expected is not None and received != int(expected):
+            raise http.client.IncompleteRead(b"", int(expected) - received)
+    except BaseException:
+        connection.close()
+        raise
+    pool.put(parts.scheme, parts.netloc, connection)
+    return offset, digest
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,39 @@
+import argparse
+import cProfile
+import ctypes
+import errno
+import fcntl
+import fnmatch
 import platform
 import sys
 import subprocess
 import os
+import queue
 import time
 import shutil
 import re
+import resource
 import tarfile
-import gzip
 import json
+import hashlib
+import zlib
+import io
+import mmap
+import stat
+import struct
+import tempfile
+import threading
 from enum import Enum
-from collections import defaultdict
-from typing import List, Dict, Set, Literal
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, as_completed, wait
+from collections import defaultdict, deque
+from typing import Callable, List, Dict, Set, Tuple, Literal, NamedTuple, Optional
 
-# global set used in record_dep function calls
-# to check if we have already recorded a dep or not
-global_seen = set()
+# libc, loaded on first use on macOS
+_libc = None
+
+# persistent state kept between runs of this script, e.g. the opt inode index
+CACHE_DIR = os.getenv("LIMA_AND_QEMU_CACHE_DIR", os.path.expanduser("~/.cache/finch-core/lima-and-qemu"))
 
 # arch enum
 class Arch(str, Enum):
@@ -24,66 +43,1022 @@ class Arch(str, Enum):
     def __str__(self) -> str:
         return self.value
 
+# A recorded dependency. Entries are compact so that large dependency sets stay cheap, the
+# "[394K]" and "→ target" strings of the verification files are only produced by __str__.
+class DepEntry(NamedTuple):
+    kind: str              # "file", "dir" or "link"
+    size: int              # exact size in bytes as reported by lstat
+    target: Optional[str]  # link target for symlinks that are recorded as such
+    inode: int
+
+    def __str__(self) -> str:
+        if self.target is not None:
+            return f"→ {self.target}"
+        return f"[{format_size(self.size)}]"
+
+# Formats size the way "ls -lh" on macOS does, e.g. 394K or 6.8M
+def format_size(size: int) -> str:
+    value = float(size)
+    for unit in ["B", "K", "M", "G", "T"]:
+        if unit == "B" and value < 1000:
+            return f"{size}B"
+        if unit != "B" and value < 999.5:
+            return f"{value:.1f}{unit}" if value < 9.95 else f"{int(value + 0.5)}{unit}"
+        value /= 1024
+    return f"{int(value + 0.5)}P"
+
+def _dep_kind(st: os.stat_result) -> str:
+    if stat.S_ISLNK(st.st_mode):
+        return "link"
+    return "dir" if stat.S_ISDIR(st.st_mode) else "file"
+
+# File references may involve multiple symlinks that need to be recorded as well, e.g.
+#
+#   /usr/local/opt/libssh/lib/libssh.4.dylib
+#
+# turns into 2 symlinks and one file:
+#
+#   /usr/local/opt/libssh → ../Cellar/libssh/0.9.5_1
+#   /usr/local/Cellar/libssh/0.9.5_1/lib/libssh.4.dylib → libssh.4.8.6.dylib
+#   /usr/local/Cellar/libssh/0.9.5_1/lib/libssh.4.8.6.dylib [394K]
+#
+# The lstat result of every path prefix is cached for the lifetime of the resolver, so prefixes
+# shared by most deps like "opt/<formula>" and "Cellar/<formula>/<version>" are only looked at once.
+class DepResolver:
+    def __init__(self, install_dir: str):
+        self.install_dir = install_dir
+        self.deps: Dict[str, DepEntry] = {}
+        self._seen: Set[str] = set()
+        self._stats: Dict[str, Optional[os.stat_result]] = {}
+        self._links: Dict[str, str] = {}
+        # called with every path recorded, e.g. to process deps while more are being recorded
+        self.on_record: Optional[Callable[[str], None]] = None
+
+    def _add(self, path: str, entry: DepEntry):
+        self.deps[path] = entry
+        if self.on_record is not None:
+            self.on_record(path)
+
+    def _lstat(self, path: str) -> Optional[os.stat_result]:
+        if path not in self._stats:
+            try:
+                self._stats[path] = os.lstat(path)
+            except OSError:
+                self._stats[path] = None
+        return self._stats[path]
+
+    def _readlink(self, path: str) -> Optional[str]:
+        st = self._lstat(path)
+        if not st or not stat.S_ISLNK(st.st_mode):
+            return None
+        if path not in self._links:
+            try:
+                self._links[path] = os.readlink(path)
+            except Exception as ex:
+                raise RuntimeError(f"{path} is a link but failed to indirect it") from ex
+        return self._links[path]
+
+    # Adds deps recorded elsewhere, e.g. by a previous build, that aren't recorded yet
+    def merge(self, deps: Dict[str, DepEntry]):
+        for path, entry in deps.items():
+            if path not in self.deps:
+                self._add(path, entry)
+
+    def record_link(self, path: str):
+        link = self._readlink(path)
+        if link is None:
+            raise RuntimeError(f"{path} is not a link")
+        self._add(path, DepEntry("link", self._stats[path].st_size, link, self._stats[path].st_ino))
+
+    def record(self, dep: str):
+        while dep:
+            if dep in self._seen: return
+            self._seen.add(dep)
+
+            if not os.path.isabs(dep):
+                raise RuntimeError(f"{dep} is not an absolute path")
+
+            filename = ""
+            dep_segments = dep[1:].split("/")
+            link = None
+            while dep_segments:
+                segment = dep_segments.pop(0).strip()
+                name = f"{filename}/{segment}"
+                link = self._readlink(name)
+
+                # symlinks in the bin directory are replaced by the target, and the symlinks are not
+                # recorded (see copy_deps). However, at least "share/qemu" needs to remain a symlink to
+                # "../Cellar/qemu/6.0.0/share/qemu" so qemu will still find its data files. Therefore
+                # symlinks are still recorded for all other files.
+                if link and not name.startswith(f"{self.install_dir}/bin"):
+                    # Record the symlink itself with the link target as the comment
+                    self.record_link(name)
+                    if os.path.isabs(link):
+                        # Can't support absolute links pointing outside /usr/local
+                        if not link.startswith(self.install_dir):
+                            raise RuntimeError(f"{link} is not in {self.install_dir}")
+                        link = '/'.join([link] + dep_segments)
+                    else:
+                        link = '/'.join([filename, link] + dep_segments)
+                    break
+                link = None
+
+                if segment == "..":
+                    filename = os.path.dirname(filename)
+                else:
+                    filename = name
+
+            if link:
+                # Re-parse from the start because the link may contain ".." segments
+                dep = link
+                continue
+
+            st = self._lstat(filename)
+            if not st:
+                raise RuntimeError(f"failed to get size of {filename}")
+            self._add(filename, DepEntry(_dep_kind(st), st.st_size, None, st.st_ino))
+            return
+
+# Maps the (st_dev, st_ino) of every file reachable through install_dir/opt to the opt paths reaching
+# it, i.e. what "find -L {install_dir}/opt -samefile <file>" prints, so the tree is walked once per run
+# instead of once per lookup. The index is kept per opt entry (opt/<formula> → ../Cellar/<formula>/<version>)
+# in CACHE_DIR, and only entries whose link target or keg changed since the last run are walked again.
+class OptInodeIndex:
+    def __init__(self, install_dir: str):
+        self.opt_dir = f"{install_dir}/opt"
+        self.cache_path = os.path.join(CACHE_DIR, f"opt-inode-index{self.opt_dir.replace('/', '-')}.json")
+        self._entries: Dict[str, dict] = {}
+        self._index: Dict[Tuple[int, int], List[str]] = defaultdict(list)
+
+    def build(self):
+        cached = self._load()
+        try:
+            names = sorted(os.listdir(self.opt_dir))
+        except OSError as ex:
+            raise RuntimeError(f"failed to list {self.opt_dir}") from ex
+
+        walked = 0
+        for name in names:
+            path = os.path.join(self.opt_dir, name)
+            signature = self._signature(path)
+            entry = cached.get(name)
+            if not entry or entry["signature"] != signature:
+                files: List[list] = []
+                self._walk(path, set(), files)
+                entry = {"signature": signature, "files": files}
+                walked += 1
+            self._entries[name] = entry
+            for dev, ino, file_path in entry["files"]:
+                self._index[(dev, ino)].append(file_path)
+
+        print(f"indexed {len(self._index)} files in {self.opt_dir}, walked {walked} of {len(names)} entries")
+        if walked or len(cached) != len(self._entries):
+            self._save()
+
+    def links_to(self, path: str) -> List[str]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return []
+        return list(self._index.get((st.st_dev, st.st_ino), []))
+
+    @staticmethod
+    def _signature(path: str) -> list:
+        try:
+            link = os.readlink(path) if os.path.islink(path) else ""
+            st = os.stat(path)
+            return [link, st.st_dev, st.st_ino, st.st_mtime_ns]
+        except OSError:
+            return []
+
+    # Like "find -L": follows every symlink, skipping broken ones and directory cycles
+    def _walk(self, path: str, ancestors: Set[Tuple[int, int]], files: List[list]):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            files.append([st.st_dev, st.st_ino, path])
+            return
+        key = (st.st_dev, st.st_ino)
+        if key in ancestors:
+            return
+        try:
+            children = sorted(os.listdir(path))
+        except OSError:
+            return
+        for child in children:
+            self._walk(os.path.join(path, child), ancestors | {key}, files)
+
+    def _load(self) -> Dict[str, dict]:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(f"{self.cache_path}.tmp", "w") as f:
+                json.dump(self._entries, f)
+            os.replace(f"{self.cache_path}.tmp", self.cache_path)
+        except OSError as ex:
+            print(f"WARNING: failed to save opt inode index to {self.cache_path}: ", ex)
+
+# Turns the paths reported by a tracer into dependencies while the templates run. Every path is only
+# resolved once, so memory stays bounded by the number of unique paths rather than the length of the
+# trace. Tracers may report paths from several threads, so feed() is serialized.
+class TraceConsumer:
+    def __init__(self, resolver: DepResolver, opt_index: OptInodeIndex):
+        self.resolver = resolver
+        self.opt_index = opt_index
+        self._seen_paths: Set[str] = set()
+        self._lock = threading.Lock()
+        self.traced_deps_count = 0
+        self.new_deps_count = 0
+        # time spent resolving traced paths, which happens on the tracer's reader threads
+        self.feed_seconds = 0.0
+
+    def feed(self, file_path: str):
+        with self._lock:
+            start = time.monotonic()
+            self._feed(file_path)
+            self.feed_seconds += time.monotonic() - start
+
+    def _feed(self, file_path: str):
+        if file_path in self._seen_paths: return
+        self._seen_paths.add(file_path)
+
+        # Skip directories starting with /opt/homebrew/Cellar/qemu unless -f
+        if not os.path.isfile(file_path): return
+
+        # Count all traced dependencies
+        self.traced_deps_count += 1
+
+        deps = self.resolver.deps
+        # Skip if already recorded
+        if file_path in deps: return
+
+        # Record this new dependency
+        self.resolver.record(file_path)
+        self.new_deps_count += 1
+
+        # Also record any symlinks in opt pointing to this file
+        for link in self.opt_index.links_to(file_path):
+            # Skip the file itself
+            if link == file_path: continue
+            # Skip if already recorded
+            if link in deps: continue
+            self.resolver.record(link)
+            self.new_deps_count += 1
+
+    def report(self, tracer_name: str):
+        print(f"{tracer_name} detected {self.traced_deps_count} files, {self.new_deps_count} new deps recorded")
+
+# Caches the dependency closure traced by booting the lima templates. It is keyed on everything that
+# determines the closure: arch, qemu and lima version, the templates and the content of the initial
+# deps. A cached closure is only used if all of its files and links still look the same, so e.g. a
+# Homebrew upgrade of a transitive dylib that the key doesn't cover still results in a new trace.
+class TraceCache:
+    def __init__(self, key: str):
+        self.path = os.path.join(CACHE_DIR, "traces", f"{key}.json")
+
+    @staticmethod
+    def key(arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, qemu_version: str, lima_version: str, templates: List[str], initial_deps: Dict[str, DepEntry]) -> str:
+        inputs = {
+            "arch": str(arch),
+            "install_dir": install_dir,
+            "qemu_version": qemu_version,
+            "lima_version": lima_version,
+            "templates": templates,
+            "initial_deps": {path: _content_digest(path, entry) for path, entry in sorted(initial_deps.items())},
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def load(self) -> Optional[Dict[str, DepEntry]]:
+        try:
+            with open(self.path) as f:
+                cached = {path: DepEntry(*entry) for path, entry in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            return None
+
+        reason = _changed_dep(cached)
+        if reason is not None:
+            print(f"cached trace is stale, {reason}")
+            return None
+        os.utime(self.path)
+        return cached
+
+    def store(self, deps: Dict[str, DepEntry]):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(deps, f)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as ex:
+            print(f"WARNING: failed to cache traced dependencies in {self.path}: ", ex)
+
+    # Removes traces not used for max_age seconds, then the least recently used ones beyond max_bytes
+    @staticmethod
+    def evict(max_age: float, max_bytes: int):
+        trace_dir = os.path.join(CACHE_DIR, "traces")
+        try:
+            traces = [entry for entry in os.scandir(trace_dir) if entry.name.endswith(".json")]
+            traces = sorted(((entry.stat(), entry.path) for entry in traces), key=lambda t: t[0].st_mtime, reverse=True)
+        except OSError:
+            return
+
+        now = time.time()
+        total = 0
+        for st, path in traces:
+            total += st.st_size
+            if now - st.st_mtime > max_age or total > max_bytes:
+                print(f"evicting cached trace {path}")
+                try:
+                    os.unlink(path)
+                except OSError as ex:
+                    print(f"WARNING: failed to evict {path}: ", ex)
+
+# Returns why deps no longer describe the files they were recorded from, or None if they still do
+def _changed_dep(deps: Dict[str, DepEntry]) -> Optional[str]:
+    for path, entry in deps.items():
+        try:
+            st = os.lstat(path)
+            link = os.readlink(path) if entry.target is not None else None
+        except OSError:
+            return f"{path} no longer exists"
+        if (_dep_kind(st), st.st_size, st.st_ino, link) != (entry.kind, entry.size, entry.inode, entry.target):
+            return f"{path} changed"
+    return None
+
+def _content_digest(path: str, entry: DepEntry) -> str:
+    if entry.target is not None:
+        return f"link:{entry.target}"
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                digest.update(f"{os.path.relpath(file_path, path)}:{_content_digest(file_path, entry)}".encode())
+    else:
+        return _file_digest(path)
+    return digest.hexdigest()
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Measures what every phase of the build and every lima template costs: wall time, the subprocesses
+# started and how long they ran, CPU time and block I/O of this process and its children, bytes read
+# and written by this process and peak RSS. Subprocesses are counted when they are started through
+# start_process() or run_process(), which every command of the build goes through, and are attributed
+# to the current phase and to the template run by the starting thread. The report is rewritten after every phase, so a failed build
+# still shows how far it got. With a cprofile_dir, every phase is also run under cProfile, which only
+# sees the main thread.
+class BuildProfiler:
+    def __init__(self):
+        self.report_path: Optional[str] = None
+        self.cprofile_dir: Optional[str] = None
+        self.phases: List[dict] = []
+        self.templates: List[dict] = []
+        self._phase: Optional[dict] = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def install(self, report_path: str, cprofile_dir: Optional[str] = None):
+        self.report_path = report_path
+        self.cprofile_dir = cprofile_dir
+
+    @contextmanager
+    def phase(self, name: str):
+        record = {"name": name, "subprocesses": 0, "subprocess_seconds": 0.0}
+        before = _resource_usage()
+        profile = cProfile.Profile() if self.cprofile_dir else None
+        self._phase = record
+        start = time.monotonic()
+        if profile:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile:
+                profile.disable()
+            record["wall_seconds"] = round(time.monotonic() - start, 3)
+            after = _resource_usage()
+            for key, value in after.items():
+                record[key] = value if key.endswith("peak_rss_bytes") else round(value - before.get(key, 0), 3)
+            self._phase = None
+            self.phases.append(record)
+            if profile:
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                record["cprofile"] = os.path.join(self.cprofile_dir, f"{name}.prof")
+                profile.dump_stats(record["cprofile"])
+            self.write()
+
+    @contextmanager
+    def template(self, name: str):
+        record = {"name": name, "subprocesses": 0, "subprocess_seconds": 0.0}
+        self._local.template = record
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = round(time.monotonic() - start, 3)
+            self._local.template = None
+            with self._lock:
+                self.templates.append(record)
+
+    # the phase and template records a subprocess started now is attributed to
+    def scopes(self) -> List[dict]:
+        return [scope for scope in [self._phase, getattr(self._local, "template", None)] if scope is not None]
+
+    def count_subprocess(self, scopes: List[dict], seconds: Optional[float]):
+        with self._lock:
+            for scope in scopes:
+                if seconds is None:
+                    scope["subprocesses"] += 1
+                else:
+                    scope["subprocess_seconds"] = round(scope["subprocess_seconds"] + seconds, 3)
+
+    def write(self):
+        if self.report_path is None: return
+        report = {
+            "wall_seconds": round(time.monotonic() - self._start, 3),
+            "phases": self.phases,
+            "templates": sorted(self.templates, key=lambda t: t["name"]),
+        }
+        try:
+            with open(f"{self.report_path}.tmp", "w") as f:
+                json.dump(report, f, indent=2)
+            os.replace(f"{self.report_path}.tmp", self.report_path)
+        except OSError as ex:
+            print(f"WARNING: failed to write build profile {self.report_path}: ", ex)
+
+PROFILER = BuildProfiler()
+
+class _CountingPopen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._scopes = PROFILER.scopes()
+        self._started = time.monotonic()
+        self._counted_exit = False
+        PROFILER.count_subprocess(self._scopes, None)
+
+    def _count_exit(self):
+        if self._counted_exit: return
+        self._counted_exit = True
+        PROFILER.count_subprocess(self._scopes, time.monotonic() - self._started)
+
+    def poll(self):
+        returncode = super().poll()
+        if returncode is not None:
+            self._count_exit()
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        self._count_exit()
+        return returncode
+
+# Like subprocess.Popen, with the process counted by PROFILER
+def start_process(cmd, **kwargs) -> subprocess.Popen:
+    return _CountingPopen(cmd, **kwargs)
+
+# Like subprocess.run, with the process counted by PROFILER
+def run_process(cmd, check: bool = False, capture_output: bool = False, timeout: Optional[float] = None, **kwargs) -> subprocess.CompletedProcess:
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    with start_process(cmd, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except BaseException:
+            process.kill()
+            raise
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+def _resource_usage() -> Dict[str, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in bytes on macOS and in KiB on Linux
+    rss_scale = 1 if sys.platform == "darwin" else 1024
+    usage = {
+        "cpu_seconds": own.ru_utime + own.ru_stime,
+        "children_cpu_seconds": children.ru_utime + children.ru_stime,
+        "block_reads": own.ru_inblock + children.ru_inblock,
+        "block_writes": own.ru_oublock + children.ru_oublock,
+        "peak_rss_bytes": own.ru_maxrss * rss_scale,
+        "children_peak_rss_bytes": children.ru_maxrss * rss_scale,
+    }
+    usage.update(_disk_io())
+    return usage
+
+RUSAGE_INFO_V2 = 2
+
+# Bytes this process read from and wrote to storage, from /proc/self/io on Linux and
+# proc_pid_rusage on macOS
+def _disk_io() -> Dict[str, int]:
+    global _libc
+    try:
+        if sys.platform == "darwin":
+            if _libc is None:
+                _libc = ctypes.CDLL(None, use_errno=True)
+            # struct rusage_info_v2: a 16 byte uuid followed by uint64 fields, of which
+            # ri_diskio_bytesread and ri_diskio_byteswritten are the 17th and 18th
+            info = ctypes.create_string_buffer(512)
+            if _libc.proc_pid_rusage(os.getpid(), RUSAGE_INFO_V2, info) != 0:
+                return {}
+            bytes_read, bytes_written = struct.unpack_from("<QQ", info.raw, 16 + 16 * 8)
+            return {"bytes_read": bytes_read, "bytes_written": bytes_written}
+        with open("/proc/self/io") as f:
+            io_stats = dict(line.split(":", 1) for line in f)
+        return {"bytes_read": int(io_stats["read_bytes"]), "bytes_written": int(io_stats["write_bytes"])}
+    except (OSError, KeyError, ValueError, AttributeError):
+        return {}
+
+# The stages of a build, in order. Relinking happens while the deps are copied and compression while
+# they are packaged, so neither is a stage of its own.
+STAGES = ["trace", "prune", "verify", "copy", "sign", "version-map", "package", "size"]
+
+# What the stages produce for later stages. It's written to the checkpoint directory after every stage,
+# so that a build that failed late, e.g. in codesign, can be resumed without booting the templates again.
+class BuildState:
+    def __init__(self, arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, templates: List[str], qemu_version: str, lima_version: str):
+        self.arch = arch
+        self.install_dir = install_dir
+        self.templates = templates
+        self.qemu_version = qemu_version
+        self.lima_version = lima_version
+        self.completed: List[str] = []
+        self.trace_cache_key: Optional[str] = None
+        # how the deps were found: "trace", "cache" or "static"
+        self.deps_source: Optional[str] = None
+        self.deps: Dict[str, DepEntry] = {}
+        self.dist_path: Optional[str] = None
+        self.resign_files: List[str] = []
+        self.archive_path: Optional[str] = None
+        self.archive_digest: Optional[str] = None
+
+    # a checkpoint can only be resumed by a build of the same inputs
+    def inputs(self) -> dict:
+        return {
+            "arch": str(self.arch),
+            "install_dir": self.install_dir,
+            "templates": self.templates,
+            "qemu_version": self.qemu_version,
+            "lima_version": self.lima_version,
+        }
+
+    def save(self, checkpoint_dir: str):
+        state = self.inputs()
+        state.update({
+            "completed": self.completed,
+            "trace_cache_key": self.trace_cache_key,
+            "deps_source": self.deps_source,
+            "deps": self.deps,
+            "dist_path": self.dist_path,
+            "resign_files": self.resign_files,
+            "archive_path": self.archive_path,
+            "archive_digest": self.archive_digest,
+        })
+        path = os.path.join(checkpoint_dir, "state.json")
+        try:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(state, f, indent=1)
+            os.replace(f"{path}.tmp", path)
+        except OSError as ex:
+            raise RuntimeError(f"failed to save the build state to {path}") from ex
+
+    @staticmethod
+    def load(checkpoint_dir: str) -> Optional["BuildState"]:
+        try:
+            with open(os.path.join(checkpoint_dir, "state.json")) as f:
+                saved = json.load(f)
+            state = BuildState(Arch(saved["arch"]), saved["install_dir"], saved["templates"], saved["qemu_version"], saved["lima_version"])
+            state.completed = saved["completed"]
+            state.trace_cache_key = saved["trace_cache_key"]
+            state.deps_source = saved["deps_source"]
+            state.deps = {path: DepEntry(*entry) for path, entry in saved["deps"].items()}
+            state.dist_path = saved["dist_path"]
+            state.resign_files = saved["resign_files"]
+            state.archive_path = saved["archive_path"]
+            state.archive_digest = saved["archive_digest"]
+            return state
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
 def main():
-    templates = get_templates_from_args()
+    build(parse_args())
+
+def build(args: argparse.Namespace):
+    templates = args.templates
     print("using templates: ", templates)
     
     arch = get_system_arch()
     install_dir = get_installation_dir(arch)
     print("using arch: ", arch)
-    
-    qemu_version = get_installed_qemu_version()
-    print("using qemu version: ", qemu_version)
 
-    lima_version = get_installed_lima_version()
-    print("using lima version: ", lima_version)
-    
+    lima_repo_root = os.path.join(os.getcwd(), 'src', 'lima')
+    PROFILER.install(
+        f"{lima_repo_root}/build-profile-{arch}.json",
+        f"{lima_repo_root}/build-profile-{arch}" if args.profile else None,
+    )
+
+    with PROFILER.phase("versions"):
+        qemu_version = get_installed_qemu_version()
+        print("using qemu version: ", qemu_version)
+
+        lima_version = get_installed_lima_version()
+        print("using lima version: ", lima_version)
+
+    state = BuildState(arch, install_dir, templates, qemu_version, lima_version)
+    stages = STAGES
+    if args.resume or args.from_stage:
+        state = load_checkpoint(args.checkpoint_dir, state, args.from_stage)
+        if state is None:
+            print(f"All stages of the build in {args.checkpoint_dir} are complete")
+            return
+        stages = STAGES[len(state.completed):]
+        print(f"Resuming the build in {args.checkpoint_dir} from stage {stages[0]}")
+
+    run_stages(args, state, stages)
+
+    print(f"Wrote build profile {PROFILER.report_path}")
+    print("Done")
+
+# Returns the saved state to continue from, with the stages from from_stage on (or the ones that didn't
+# complete) removed from its completed stages, or None if there is nothing left to do
+def load_checkpoint(checkpoint_dir: str, state: BuildState, from_stage: Optional[str]) -> Optional[BuildState]:
+    saved = BuildState.load(checkpoint_dir)
+    if saved is None:
+        raise RuntimeError(f"there is no build state to resume from in {checkpoint_dir}")
+    if saved.inputs() != state.inputs():
+        raise RuntimeError(f"the build state in {checkpoint_dir} is for {saved.inputs()}, not {state.inputs()}")
+
+    if from_stage is None:
+        from_stage = next((stage for stage in STAGES if stage not in saved.completed), None)
+        if from_stage is None:
+            return None
+    earlier_stages = STAGES[:STAGES.index(from_stage)]
+    missing = [stage for stage in earlier_stages if stage not in saved.completed]
+    if missing:
+        raise RuntimeError(f"can't start from stage {from_stage}, {', '.join(missing)} didn't complete")
+
+    if saved.deps:
+        reason = _changed_dep(saved.deps)
+        if reason is not None:
+            raise RuntimeError(f"can't resume, {reason} since the deps were traced")
+    saved.completed = earlier_stages
+    return saved
+
+def run_stages(args: argparse.Namespace, state: BuildState, stages: List[str]):
+    syncer = None
+    if "trace" in stages and "copy" in stages:
+        # deps are copied and relinked in the background while they are recorded, see DistSyncer
+        syncer = DistSyncer(state.arch, state.install_dir, args.copy_workers)
+        syncer.start()
+    try:
+        for stage in stages:
+            if stage == "trace":
+                trace_stage(args, state, syncer)
+            elif stage == "prune":
+                prune_stage(args, state, syncer)
+            elif stage == "verify":
+                verify_stage(args, state)
+            elif stage == "copy":
+                copy_stage(args, state, syncer)
+                syncer = None
+            elif stage == "sign":
+                sign_stage(args, state)
+            elif stage == "version-map":
+                version_map_stage(args, state)
+            elif stage == "package":
+                package_stage(args, state)
+            elif stage == "size":
+                size_stage(args, state)
+            state.completed.append(stage)
+            state.save(args.checkpoint_dir)
+    except Exception:
+        if syncer is not None:
+            syncer.abort()
+        raise
+
+def trace_stage(args: argparse.Namespace, state: BuildState, syncer: Optional["DistSyncer"]):
+    arch, install_dir = state.arch, state.install_dir
     print("recording initial deps...")
-    deps = record_initial_deps(arch, install_dir, qemu_version)
-    
-    print("Starting fs_usage monitoring for runtime file access...")
-    fs_usage_log = start_fs_usage(arch)
-    time.sleep(2)
+    resolver = DepResolver(install_dir)
+    if syncer is not None:
+        resolver.on_record = syncer.submit
+    with PROFILER.phase("initial-deps"):
+        record_initial_deps(arch, resolver, state.qemu_version)
 
-    print("Running lima templates to capture runtime file access...")
-    run_lima_templates(templates)
+    with PROFILER.phase("trace-cache"):
+        state.trace_cache_key = TraceCache.key(arch, install_dir, state.qemu_version, state.lima_version, state.templates, resolver.deps)
+        trace_cache = TraceCache(state.trace_cache_key)
+        cached_deps = None if args.force_trace else trace_cache.load()
+    if cached_deps is not None:
+        print(f"Reusing the dependencies traced by a previous build from {trace_cache.path}")
+        resolver.merge(cached_deps)
+        state.deps_source = "cache"
+        state.deps = resolver.deps
+        return
 
-    print("Stopping fs_usage and parsing results...")
-    stop_fs_usage()
-    time.sleep(2)
+    print("Indexing opt links...")
+    with PROFILER.phase("opt-index"):
+        opt_index = OptInodeIndex(install_dir)
+        opt_index.build()
 
-    print("Parsing fs_usage log...")
-    parse_fs_usage_log(fs_usage_log, deps, install_dir)
+    if args.static_closure:
+        print("Computing the static dependency closure...")
+        with PROFILER.phase("static-closure"):
+            static_deps = compute_static_closure(arch, install_dir, state.qemu_version, opt_index)
+        if static_deps is not None:
+            resolver.merge(static_deps)
+            state.deps_source = "static"
+            state.deps = resolver.deps
+            return
+        print("Falling back to tracing the dependencies")
 
-    print("Verifying dependencies using verification file...")
-    verify_dependencies(deps, arch, install_dir)
+    consumer = TraceConsumer(resolver, opt_index)
+    tracer = create_tracer(args.tracer, arch, install_dir, consumer.feed)
+    with PROFILER.phase("trace") as phase:
+        print(f"Starting {tracer.name} to record runtime file access...")
+        try:
+            tracer.start()
+            tracer.ready(args.tracer_ready_timeout)
 
-    print("Copying dependencies...")
-    dist_path, resign_files = copy_deps(deps, arch, install_dir)
+            print("Running lima templates to capture runtime file access...")
+            run_lima_templates(state.templates, args.template_concurrency, tracer)
 
-    print("Resigning files...")
-    resign(resign_files)
+            print(f"Stopping {tracer.name}...")
+            tracer.stop()
+        except Exception:
+            tracer.cleanup()
+            raise
+        consumer.report(tracer.name)
+        phase["trace_consumer_seconds"] = round(consumer.feed_seconds, 3)
+    cleanup(tracer)
+    state.deps_source = "trace"
+    state.deps = resolver.deps
 
-    print("Extracting and exporting package versions...")
-    extract_and_export_package_versions(deps, arch, install_dir)
+def prune_stage(args: argparse.Namespace, state: BuildState, syncer: Optional["DistSyncer"]):
+    print("Pruning share/qemu to the traced and allowlisted files...")
+    with PROFILER.phase("prune") as phase:
+        resolver = DepResolver(state.install_dir)
+        resolver.deps.update(state.deps)
+        if syncer is not None:
+            resolver.on_record = syncer.submit
+        phase["pruned_bytes"] = prune_share_qemu(resolver, state.arch, args.share_qemu_allow)
+        state.deps = resolver.deps
 
-    print("Packaging files and socket_vmnet...")
-    archive_path = package_files_and_socket_vmnet(deps, install_dir, dist_path)
+def verify_stage(args: argparse.Namespace, state: BuildState):
+    print("Verifying dependencies using verification file...")
+    with PROFILER.phase("verify"):
+        verify_dependencies(state.deps, state.arch, state.install_dir)
 
-    print("adding lima version info to built archive...")
-    add_lima_version_to_archive(archive_path, lima_version)
+        # only traced closures are cached, a static closure is cheap to compute again
+        if state.deps_source == "trace":
+            TraceCache(state.trace_cache_key).store(state.deps)
+        TraceCache.evict(args.trace_cache_max_age_days * 24 * 60 * 60, args.trace_cache_max_size)
 
-    print("compressing archive...")
-    compress_archive(archive_path)
+def copy_stage(args: argparse.Namespace, state: BuildState, syncer: Optional["DistSyncer"]):
+    print("Copying remaining dependencies..." if syncer else "Copying dependencies...")
+    with PROFILER.phase("copy"):
+        if syncer is None:
+            syncer = DistSyncer(state.arch, state.install_dir, args.copy_workers)
+            syncer.start()
+        dist_path, resign_files, _ = syncer.finish(state.deps)
+    state.dist_path = dist_path
+    state.resign_files = sorted(resign_files)
 
-    print("Cleaning up...")
-    cleanup()
+def sign_stage(args: argparse.Namespace, state: BuildState):
+    print("Resigning files...")
+    with PROFILER.phase("sign"):
+        manifest = DistManifest(state.dist_path)
+        if not manifest.load():
+            raise RuntimeError(f"failed to load the dist manifest {manifest.path}")
+        resign(set(state.resign_files), manifest, args.sign_workers)
 
-    print("Done")
+def version_map_stage(args: argparse.Namespace, state: BuildState):
+    print("Extracting and exporting package versions...")
+    with PROFILER.phase("version-map"):
+        extract_and_export_package_versions(state.deps, state.arch, state.install_dir, state.lima_version, state.qemu_version)
 
-def get_templates_from_args():
-    default_templates = ["fedora-44", "default"]
-    return sys.argv[1:] if len(sys.argv) > 1 else default_templates
+def package_stage(args: argparse.Namespace, state: BuildState):
+    print("Packaging and compressing files, socket_vmnet and lima version info...")
+    with PROFILER.phase("package"):
+        state.archive_path, state.archive_digest = package_files_and_socket_vmnet(
+            state.deps,
+            state.install_dir,
+            state.dist_path,
+            state.lima_version,
+            compression_level=args.compression_level,
+            compression_block_size=args.compression_block_size,
+            compression_workers=args.compression_workers,
+            dedup=args.dedup,
+            layered=args.layered,
+            seekable=args.seekable,
+        )
+
+def size_stage(args: argparse.Namespace, state: BuildState):
+    # compressing every package once more costs about as much as the package stage itself
+    if not args.size_gate:
+        print("Skipping the package size gate, enable it with --size-gate")
+        return
+    print("Accounting the size of every package...")
+    with PROFILER.phase("size"):
+        check_package_sizes(
+            state.deps,
+            state.arch,
+            state.install_dir,
+            state.dist_path,
+            SizeThresholds(args.size_package_warn, args.size_package_fail, args.size_total_warn, args.size_total_fail, args.size_min_change),
+            compression_level=args.compression_level,
+            compression_workers=args.compression_workers,
+            dedup=args.dedup,
+        )
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Builds the lima-and-qemu bundle from the installed lima and qemu.")
+    parser.add_argument(
+        "templates",
+        nargs="*",
+        default=["fedora-44", "default"],
+        help="lima templates to boot while recording runtime file access (default: fedora-44 default)",
+    )
+    parser.add_argument(
+        "--template-concurrency",
+        type=int,
+        default=1,
+        help="number of lima templates to boot at the same time (default: 1)",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        default="/tmp/lima-and-qemu.checkpoint",
+        help="directory the state of the build is saved to after every stage (default: /tmp/lima-and-qemu.checkpoint)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the build saved in the checkpoint directory with the first stage that didn't complete",
+    )
+    parser.add_argument(
+        "--from-stage",
+        choices=STAGES,
+        help="continue the build saved in the checkpoint directory from this stage, running it and all later stages again",
+    )
+    parser.add_argument(
+        "--force-trace",
+        action="store_true",
+        help="boot the lima templates to trace the dependencies even if a previous build traced the same inputs",
+    )
+    parser.add_argument(
+        "--trace-cache-max-age-days",
+        type=float,
+        default=30,
+        help="remove cached dependency traces not used for this many days (default: 30)",
+    )
+    parser.add_argument(
+        "--trace-cache-max-size",
+        type=int,
+        default=64 << 20,
+        help="remove the least recently used dependency traces beyond this many bytes (default: 64 MiB)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="also dump the cProfile stats of every phase to src/lima/build-profile-<arch>/<phase>.prof",
+    )
+    parser.add_argument(
+        "--static-closure",
+        action="store_true",
+        help="compute the dependencies from the Mach-O load commands and a list of data files instead of booting the lima templates, "
+        "falling back to booting them if the result differs from the verification file",
+    )
+    parser.add_argument(
+        "--share-qemu-allow",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="glob, relative to share/qemu, of data files to ship even if the templates don't open them; may be repeated",
+    )
+    parser.add_argument(
+        "--tracer",
+        choices=["auto"] + list(TRACERS),
+        default="auto",
+        help="how runtime file access is recorded (default: auto, fs_usage on macOS and strace on Linux)",
+    )
+    parser.add_argument(
+        "--tracer-ready-timeout",
+        type=float,
+        default=120,
+        help="seconds to wait for the tracer to report file access before giving up (default: 120)",
+    )
+    parser.add_argument(
+        "--copy-workers",
+        type=int,
+        default=min(32, (os.cpu_count() or 1) + 4),
+        help="number of threads copying dependencies into the dist tree (default: CPUs + 4, at most 32)",
+    )
+    parser.add_argument(
+        "--sign-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of files signed at the same time (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=9,
+        choices=range(1, 10),
+        metavar="{1..9}",
+        help="gzip compression level of the archive (default: 9)",
+    )
+    parser.add_argument(
+        "--compression-block-size",
+        type=int,
+        default=1 << 20,
+        help="size in bytes of the blocks compressed in parallel (default: 1 MiB)",
+    )
+    parser.add_argument(
+        "--compression-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of threads compressing the archive (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--size-gate",
+        action="store_true",
+        help="compare the compressed size of every package with the size baseline and fail if it grew too much",
+    )
+    parser.add_argument(
+        "--size-package-warn",
+        type=float,
+        default=10,
+        help="warn if the compressed size of a package grew by more than this percentage over the size baseline (default: 10)",
+    )
+    parser.add_argument(
+        "--size-package-fail",
+        type=float,
+        default=50,
+        help="fail if the compressed size of a package grew by more than this percentage over the size baseline (default: 50)",
+    )
+    parser.add_argument(
+        "--size-total-warn",
+        type=float,
+        default=5,
+        help="warn if the compressed size of all packages grew by more than this percentage over the size baseline (default: 5)",
+    )
+    parser.add_argument(
+        "--size-total-fail",
+        type=float,
+        default=20,
+        help="fail if the compressed size of all packages grew by more than this percentage over the size baseline (default: 20)",
+    )
+    parser.add_argument(
+        "--size-min-change",
+        type=int,
+        default=1 << 20,
+        help="growth in bytes a package may always have, e.g. so new small packages don't count (default: 1 MiB)",
+    )
+    parser.add_argument(
+        "--no-dedup",
+        dest="dedup",
+        action="store_false",
+        help="store files with identical content in full instead of as hardlinks to the first copy",
+    )
+    parser.add_argument(
+        "--layered",
+        action="store_true",
+        help=f"also split the archive into content-addressed layers listed in src/lima/layers/{LAYERS_MANIFEST}",
+    )
+    parser.add_argument(
+        "--seekable",
+        action="store_true",
+        help="also write src/lima/lima-and-qemu.seekable.tar.gz, which can be read member by member",
+    )
+    args = parser.parse_args(argv)
+    if args.template_concurrency < 1:
+        parser.error("--template-concurrency must be at least 1")
+    if args.compression_block_size < 1 << 15:
+        parser.error("--compression-block-size must be at least 32768")
+    if args.tracer_ready_timeout <= 0:
+        parser.error("--tracer-ready-timeout must be positive")
+    if args.copy_workers < 1:
+        parser.error("--copy-workers must be at least 1")
+    if args.sign_workers < 1:
+        parser.error("--sign-workers must be at least 1")
+    if args.compression_workers < 1:
+        parser.error("--compression-workers must be at least 1")
+    return args
 
 def get_system_arch():
     machine = platform.machine()
@@ -96,7 +1071,7 @@ def get_installation_dir(arch: Literal[Arch.X86_64, Arch.AARCH64]):
 
 def get_installed_lima_version():
     try:
-        res = subprocess.check_output("limactl --version", shell=True, text=True)
+        res = run_process("limactl --version", shell=True, text=True, stdout=subprocess.PIPE, check=True).stdout
         lima_version = res.replace("limactl version", "").strip()
         if not lima_version:
             raise RuntimeError("failed to get installed lima version")
@@ -106,7 +1081,7 @@ def get_installed_lima_version():
 
 def get_installed_qemu_version():
     try:
-        res = subprocess.check_output("brew list --versions qemu", shell=True, text=True)
+        res = run_process("brew list --versions qemu", shell=True, text=True, stdout=subprocess.PIPE, check=True).stdout
         qemu_version = res.replace("qemu", "").strip()
         if not qemu_version:
             raise RuntimeError("failed to get installed qemu version")
@@ -114,182 +1089,1266 @@ def get_installed_qemu_version():
     except Exception as ex:
         raise RuntimeError("failed to get installed qemu version") from ex
 
-def record_initial_deps(arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, qemu_version: str):
+def record_initial_deps(arch: Literal[Arch.X86_64, Arch.AARCH64], resolver: DepResolver, qemu_version: str):
+    install_dir = resolver.install_dir
     try:
-        deps: Dict[str, str] = {}
-        record_dep(f"{install_dir}/bin/limactl", deps, install_dir)
-        record_dep(f"{install_dir}/bin/qemu-img", deps, install_dir)
-        record_dep(f"{install_dir}/bin/qemu-system-{arch}", deps, install_dir)
-        record_dep(f"{install_dir}/Cellar/qemu/{qemu_version}/bin", deps, install_dir)
-        deps[f"{install_dir}/share/qemu"] = f"→ {os.readlink(f'{install_dir}/share/qemu')}"
-        return deps
+        resolver.record(f"{install_dir}/bin/limactl")
+        resolver.record(f"{install_dir}/bin/qemu-img")
+        resolver.record(f"{install_dir}/bin/qemu-system-{arch}")
+        resolver.record(f"{install_dir}/Cellar/qemu/{qemu_version}/bin")
+        resolver.record_link(f"{install_dir}/share/qemu")
+        return resolver.deps
     except Exception as ex:
         raise RuntimeError("failed to get deps") from ex
 
-def start_fs_usage(arch: Literal[Arch.X86_64, Arch.AARCH64]):
-    fs_usage_log = "/tmp/fs_usage.log"
-    try:
-        print("running fs_usage with sudo may prompt for password")
-        subprocess.run(
-            f"sudo -b fs_usage -w -f pathname limactl qemu-img qemu-system-{arch} > {fs_usage_log}",
-            shell=True,
-            check=True,
-        )
-        return fs_usage_log
-    except Exception as ex:
-        raise RuntimeError("failed to start fs_usage") from ex
+# Files qemu and lima read at runtime that no load command references, relative to install_dir.
+# qemu-system loads the firmware and option ROMs of the machine lima configures, limactl reads
+# the guest agent, the templates used by the default templates and the helpers it runs.
+STATIC_DATA_FILES = {
+    Arch.AARCH64: [
+        "share/qemu/edk2-aarch64-code.fd",
+        "share/qemu/efi-virtio.rom",
+    ],
+    Arch.X86_64: [
+        "share/qemu/edk2-x86_64-code.fd",
+        "share/qemu/efi-virtio.rom",
+        "share/qemu/kvmvapic.bin",
+    ],
+}
+STATIC_LIMA_DATA_FILES = [
+    "libexec/lima/limactl-mcp",
+    "libexec/lima/limactl-url-fedora-rawhide",
+    "share/lima/lima-guestagent.Linux-{arch}.gz",
+    "share/lima/templates/_default/mounts.yaml",
+    "share/lima/templates/_images/fedora-44.yaml",
+    "share/lima/templates/_images/ubuntu.yaml",
+]
+
+# Only the files under share/qemu that the templates opened are deps, plus the ones STATIC_DATA_FILES
+# and allow_patterns name, e.g. because a template doesn't exercise them. Records the allowlisted files
+# that weren't traced and reports the size of every file left out. Returns the bytes left out.
+def prune_share_qemu(resolver: DepResolver, arch: Literal[Arch.X86_64, Arch.AARCH64], allow_patterns: List[str]) -> int:
+    install_dir = resolver.install_dir
+    # resolved like DepResolver does, which doesn't resolve symlinks in install_dir itself
+    share_dir = os.path.normpath(os.path.join(f"{install_dir}/share", os.readlink(f"{install_dir}/share/qemu")))
+    allowlist = [path.removeprefix("share/qemu/") for path in STATIC_DATA_FILES[arch] if path.startswith("share/qemu/")]
+
+    files: Dict[str, int] = {}
+    for root, dirs, names in os.walk(share_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if not os.path.islink(path):
+                files[os.path.relpath(path, share_dir)] = os.path.getsize(path)
+
+    for rel_path in allowlist:
+        if rel_path not in files:
+            raise RuntimeError(f"{share_dir}/{rel_path} is allowlisted but doesn't exist")
+    for pattern in allow_patterns:
+        matches = fnmatch.filter(files, pattern)
+        if not matches:
+            print(f"WARNING: --share-qemu-allow {pattern} matches no file in {share_dir}")
+        allowlist.extend(matches)
 
-def stop_fs_usage():
     try:
-        subprocess.run("sudo pkill fs_usage", shell=True, check=True)
+        for rel_path in sorted(set(allowlist)):
+            resolver.record(f"{install_dir}/share/qemu/{rel_path}")
     except Exception as ex:
-        raise RuntimeError("failed to stop fs_usage") from ex
+        raise RuntimeError("failed to record the allowlisted share/qemu files") from ex
+
+    kept = {os.path.relpath(path, share_dir) for path in resolver.deps if path.startswith(f"{share_dir}/")}
+    pruned = sorted((rel_path for rel_path in files if rel_path not in kept), key=lambda rel_path: files[rel_path], reverse=True)
+    pruned_size = sum(files[rel_path] for rel_path in pruned)
+    kept_size = sum(size for rel_path, size in files.items() if rel_path in kept)
+    print(f"shipping {len(kept)} of {len(files)} files in {share_dir} ({format_size(kept_size)}), left out {len(pruned)} ({format_size(pruned_size)}):")
+    for rel_path in pruned:
+        print(f"  {format_size(files[rel_path]):>6} {rel_path}")
+    return pruned_size
+
+# Computes the deps without booting a VM: the initial deps, the dylibs their load commands reference,
+# followed recursively, and the declared data files. The result is only used if it matches the
+# verification file, since e.g. a dlopen-ed module or a data file needed by a new qemu version can't
+# be found this way. Returns None otherwise, so the deps are traced instead.
+def compute_static_closure(arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, qemu_version: str, opt_index: OptInodeIndex) -> Optional[Dict[str, DepEntry]]:
+    verification_path = os.path.join(os.getcwd(), verification_file_name(arch))
+    if not os.path.isfile(verification_path):
+        print(f"{verification_path} not found, the static closure can't be checked")
+        return None
+
+    resolver = DepResolver(install_dir)
+    record_initial_deps(arch, resolver, qemu_version)
+    # files found statically are recorded like traced ones, including the opt links pointing at them
+    consumer = TraceConsumer(resolver, opt_index)
+    executables = [f"{install_dir}/bin/limactl", f"{install_dir}/bin/qemu-img", f"{install_dir}/bin/qemu-system-{arch}"]
+    data_files = [f"{install_dir}/{path.format(arch=arch)}" for path in STATIC_DATA_FILES[arch] + STATIC_LIMA_DATA_FILES]
+    record_load_command_closure(consumer, executables + data_files)
+    consumer.report("static closure")
+
+    comparison = compare_dependencies(resolver.deps, load_verification_file(verification_path), install_dir)
+    if not comparison.matches:
+        print(f"The static closure differs from {verification_path}:")
+        for dep in comparison.missing:
+            print(f"  - {dep}")
+        for dep in comparison.unexpected:
+            print(f"  + {dep} {resolver.deps[dep]}")
+        return None
+    return resolver.deps
+
+# Feeds paths and the dylibs they load to consumer, resolving install names like dyld does
+def record_load_command_closure(consumer: TraceConsumer, paths: List[str]):
+    install_dir = consumer.resolver.install_dir
+    # (path, main executable, rpaths inherited from the loading images)
+    pending = deque((path, None, []) for path in paths)
+    seen: Set[str] = set()
+    while pending:
+        path, executable, inherited_rpaths = pending.popleft()
+        real_path = os.path.realpath(path)
+        if real_path in seen: continue
+        seen.add(real_path)
+        if not os.path.isfile(real_path):
+            print(f"WARNING: {path} does not exist")
+            continue
+        consumer.feed(path)
+        # the kernel and dyld open the real path of an executable started through a symlink in bin
+        consumer.feed(real_path)
+
+        slices = read_macho(real_path)
+        if not slices: continue
+        # dyld resolves @executable_path and @loader_path against the real path of the image
+        executable = executable or real_path
+        loader_dir = os.path.dirname(real_path)
+        for image in slices:
+            rpaths = [_expand_load_path(rpath, loader_dir, executable) for rpath in image.rpaths()] + inherited_rpaths
+            for ref in image.dependent_dylibs():
+                dylib = _resolve_install_name(ref.name, loader_dir, executable, rpaths)
+                if dylib is None:
+                    # system libraries are in the dyld shared cache rather than on disk
+                    if ref.name.startswith(f"{install_dir}/"):
+                        print(f"WARNING: {path} references {ref.name}, which does not exist")
+                    continue
+                if dylib.startswith(f"{install_dir}/"):
+                    pending.append((dylib, executable, rpaths))
+
+def _expand_load_path(path: str, loader_dir: str, executable: str) -> str:
+    if path.startswith("@loader_path/"):
+        return f"{loader_dir}/{path.removeprefix('@loader_path/')}"
+    if path.startswith("@executable_path/"):
+        return f"{os.path.dirname(executable)}/{path.removeprefix('@executable_path/')}"
+    return path
+
+def _resolve_install_name(name: str, loader_dir: str, executable: str, rpaths: List[str]) -> Optional[str]:
+    if name.startswith("@rpath/"):
+        for rpath in rpaths:
+            candidate = f"{rpath}/{name.removeprefix('@rpath/')}"
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+    path = _expand_load_path(name, loader_dir, executable)
+    return path if os.path.isfile(path) else None
+
+# Records the files the lima templates access while they run. start() launches the tracer and ready()
+# blocks until it is known to report file access, so nothing the templates do is missed. Every path
+# the tracer sees under install_dir is passed to on_path as soon as it is read, and stop() returns
+# once all of the tracer's output has been consumed.
+class Tracer:
+    name = "tracer"
+
+    def __init__(self, arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, on_path: Callable[[str], None]):
+        self.arch = arch
+        self.install_dir = install_dir
+        self.on_path = on_path
+        self._prefix = f"{install_dir}/"
+
+    def start(self):
+        pass
+
+    def ready(self, timeout: float):
+        pass
+
+    # Returns the command line that runs cmd, for tracers that only see the processes they start
+    def wrap(self, cmd: List[str]) -> List[str]:
+        return cmd
+
+    def stop(self):
+        pass
+
+    # Stops whatever start() left running after a failure, errors are ignored
+    def cleanup(self):
+        pass
+
+# macOS backend, fs_usage reports the file access of limactl and qemu system wide
+class FsUsageTracer(Tracer):
+    name = "fs_usage"
+
+    def __init__(self, arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, on_path: Callable[[str], None]):
+        super().__init__(arch, install_dir, on_path)
+        self._pattern = re.compile(rf'\s+(open|read)\s+.*?\s+({re.escape(install_dir)}/\S+|\.\./\S+?)(?:\s+\d+\.\d+\s+\S+)?$')
+        self._process: Optional[subprocess.Popen] = None
+        self._reader: Optional[threading.Thread] = None
+        # raised by on_path on the reader thread, stop() raises it on the caller's thread
+        self._error: Optional[Exception] = None
+        self._sentinel: Optional[str] = None
+        self._sentinel_seen = threading.Event()
+
+    def start(self):
+        self._sentinel = tempfile.mkdtemp(prefix="lima-and-qemu-trace-")
+        try:
+            print("running fs_usage with sudo may prompt for password")
+            self._process = start_process(
+                ["sudo", "fs_usage", "-w", "-f", "pathname", "limactl", "qemu-img", f"qemu-system-{self.arch}"],
+                stdout=subprocess.PIPE,
+                text=True,
+                errors="replace",
+            )
+            self._reader = threading.Thread(target=self._read, args=(self._process.stdout,), daemon=True)
+            self._reader.start()
+        except Exception as ex:
+            raise RuntimeError("failed to start fs_usage") from ex
+
+    # fs_usage gives no sign of when it starts reporting, so limactl is run against an empty LIMA_HOME
+    # until the trace shows it reading that directory
+    def ready(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        env = dict(os.environ, LIMA_HOME=self._sentinel)
+        while not self._sentinel_seen.is_set():
+            if self._error is not None:
+                raise RuntimeError("failed to process fs_usage output") from self._error
+            if self._process.poll() is not None:
+                raise RuntimeError(f"fs_usage exited with {self._process.returncode} before reporting file access")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"fs_usage did not report file access within {timeout:.0f}s")
+            run_process(["limactl", "list"], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._sentinel_seen.wait(0.2)
+
+    def stop(self):
+        try:
+            run_process("sudo pkill fs_usage", shell=True, check=True)
+            self._process.wait(timeout=30)
+            # fs_usage flushes its output when it exits, wait until all of it has been consumed
+            self._reader.join()
+        except Exception as ex:
+            raise RuntimeError("failed to stop fs_usage") from ex
+        finally:
+            shutil.rmtree(self._sentinel, ignore_errors=True)
+        if self._error is not None:
+            raise RuntimeError("failed to process fs_usage output") from self._error
+
+    def cleanup(self):
+        if self._process is not None:
+            run_process("sudo pkill fs_usage", shell=True)
+        if self._sentinel is not None:
+            shutil.rmtree(self._sentinel, ignore_errors=True)
+
+    def _read(self, lines):
+        try:
+            self.consume(lines)
+        except Exception as ex:
+            self._error = ex
+            # keep reading so fs_usage doesn't block on a full pipe until stop()
+            for _ in lines: pass
+
+    def consume(self, lines):
+        for line in lines:
+            if self._sentinel is not None and self._sentinel in line:
+                self._sentinel_seen.set()
+                continue
+            file_path = self.parse(line)
+            if file_path is not None:
+                self.on_path(file_path)
+
+    # Lines are only matched against the pattern if they contain one of the path prefixes it looks
+    # for, which discards the bulk of the trace cheaply
+    def parse(self, line: str) -> Optional[str]:
+        if self._prefix not in line and "../" not in line: return None
+
+        # Parse fs_usage output format:
+        match = self._pattern.search(line.strip())
+        if not match: return None
+
+        file_path = match.group(2)
+        # Handle relative paths by removing "../" and prepending install_dir
+        if file_path.startswith(".."):
+            file_path = file_path.removeprefix("../")
+            file_path = f"{self.install_dir}/{file_path}"
+        return file_path
+
+# Linux backend. strace only sees the processes it starts, so every limactl command the templates run
+# is wrapped in its own strace, which writes to a FIFO that a reader thread consumes. The wrapped
+# command only runs once strace is attached to it, so there is nothing to wait for in ready().
+# strace runs detached (-D), so the wrapped command is what the caller waits for: "limactl start"
+# leaves the hostagent and qemu running, and strace -f keeps tracing them until they exit.
+class StraceTracer(Tracer):
+    name = "strace"
+    syscalls = "open,openat,openat2,creat,execve,execveat"
+
+    def __init__(self, arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, on_path: Callable[[str], None]):
+        super().__init__(arch, install_dir, on_path)
+        # the path is the first string argument, e.g. 1234  openat(AT_FDCWD, "/opt/homebrew/...", O_RDONLY) = 3
+        self._pattern = re.compile(rf'\b(?:{self.syscalls.replace(",", "|")})\([^"]*?"({re.escape(install_dir)}/[^"]+)"')
+        self._fifo_dir: Optional[str] = None
+        self._readers: List[Tuple[threading.Thread, str]] = []
+        # raised by on_path on the reader threads, stop() raises them on the caller's thread
+        self._errors: List[Exception] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if shutil.which("strace") is None:
+            raise RuntimeError("strace is not installed")
+        self._fifo_dir = tempfile.mkdtemp(prefix="lima-and-qemu-trace-")
+
+    def wrap(self, cmd: List[str]) -> List[str]:
+        with self._lock:
+            fifo = os.path.join(self._fifo_dir, f"{len(self._readers)}.trace")
+            os.mkfifo(fifo)
+            reader = threading.Thread(target=self._read, args=(fifo,), daemon=True)
+            reader.start()
+            self._readers.append((reader, fifo))
+        return ["strace", "-D", "-f", "-qq", "-s", "4096", "-e", f"trace={self.syscalls}", "-e", "signal=none", "-o", fifo, "--"] + cmd
+
+    # the FIFO is closed once the wrapped command and everything it started, e.g. the lima
+    # hostagent and qemu, have exited
+    def stop(self):
+        try:
+            for reader, fifo in self._readers:
+                reader.join(timeout=30)
+                if reader.is_alive():
+                    raise RuntimeError(f"{fifo} is still open, traced processes are still running")
+        except Exception as ex:
+            raise RuntimeError("failed to stop strace") from ex
+        finally:
+            shutil.rmtree(self._fifo_dir, ignore_errors=True)
+        if self._errors:
+            raise RuntimeError(f"failed to process the output of {len(self._errors)} strace runs") from self._errors[0]
+
+    def cleanup(self):
+        if self._fifo_dir is not None:
+            shutil.rmtree(self._fifo_dir, ignore_errors=True)
+
+    def _read(self, fifo: str):
+        with open(fifo, errors="replace") as f:
+            try:
+                self.consume(f)
+            except Exception as ex:
+                with self._lock:
+                    self._errors.append(ex)
+                # keep reading so strace doesn't block on a full FIFO
+                for _ in f: pass
+
+    def consume(self, lines):
+        for line in lines:
+            if self._prefix not in line: continue
+            match = self._pattern.search(line)
+            if match:
+                self.on_path(match.group(1))
+
+TRACERS = {
+    FsUsageTracer.name: FsUsageTracer,
+    StraceTracer.name: StraceTracer,
+}
+
+def create_tracer(name: str, arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, on_path: Callable[[str], None]) -> Tracer:
+    if name == "auto":
+        name = FsUsageTracer.name if platform.system() == "Darwin" else StraceTracer.name
+    return TRACERS[name](arch, install_dir, on_path)
+
+# raised by template runs that were stopped because another template failed
+class TemplateCancelledError(RuntimeError):
+    pass
 
 # we used to perform a check for limactl version <= 1.0.0-alpha.0
 # we no longer need to do that
-def run_lima_templates(templates: List[str]):
+def run_lima_templates(templates: List[str], concurrency: int, tracer: Tracer):
     lima_repo_root = os.path.join(os.getcwd(), 'src', 'lima')
     lima_template_dir = os.path.join(lima_repo_root, 'templates')
+    template_yamls = {}
     for template in templates:
         template_yaml = os.path.join(lima_template_dir, f"{template}.yaml")
         if not os.path.exists(template_yaml):
             raise RuntimeError(f"{template_yaml} does not exist in {lima_template_dir}")
-        run_lima_template(template, template_yaml)
+        template_yamls[template] = template_yaml
 
-def run_lima_template(template_name: str, template_yaml: str):
-    try:
-        home_dir = os.getenv("HOME")
-        if not home_dir:
-            raise RuntimeError("failed to get home dir")
-        if os.path.exists(os.path.join(home_dir, ".lima", template_name)):
-            subprocess.run(f"limactl delete -f {template_name}", shell=True, check=True)
-        
-        subprocess.run(f"limactl start --tty=false --vm-type=qemu {template_yaml}", shell=True, check=True)
-        subprocess.run(f"limactl shell {template_name} uname", shell=True, check=True)
-        subprocess.run(f"limactl stop {template_name}", shell=True, check=True)
-        subprocess.run(f"limactl delete {template_name}", shell=True, check=True)
-    except Exception as ex:
-        home_dir = os.getenv("HOME", "")
-        lima_dir = os.path.join(home_dir, ".lima", template_name)
-        for log in ["ha.stderr.log", "ha.stdout.log", "serial.log"]:
-            log_path = os.path.join(lima_dir, log)
-            if os.path.exists(log_path):
-                print(f"=== {log} ===")
-                with open(log_path) as f:
-                    content = f.read()
-                    print(content[-5000:] if len(content) > 5000 else content)
-        raise RuntimeError(f"failed to run lima template '{template_name}'") from ex
-
-def copy_deps(deps: Dict[str, str], arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str):
-    resign_files: Set[str] = set()
-    dist_path = "/tmp/lima-and-qemu"
-    shutil.rmtree(dist_path, ignore_errors=True)
-    
-    for file_path in deps.keys():
-        copy_path = file_path.replace(install_dir, dist_path)   
-        os.makedirs(os.path.dirname(copy_path), exist_ok=True)
-        
-        if file_path.startswith(f"{install_dir}/bin/"):
-            # symlinks in the bin directory are replaced by the target file because in
-            # macOS Monterey @executable_path refers to the symlink target and not the
-            # symlink location itself, breaking the dylib lookup.
-            subprocess.run(f"cp {file_path} {copy_path}", shell=True)
-        else:
-            # do not set check=True here because "cp -R" ignores errors
-            subprocess.run(f"cp -R {file_path} {copy_path}", shell=True)
-            if os.path.islink(file_path): continue
-        
-        # if the file is not a mac os executable, skip the otool run for the file
+    # the output of every template goes to its own log file, which is printed if the template fails
+    log_dir = "/tmp/lima-template-logs"
+    os.makedirs(log_dir, exist_ok=True)
+
+    # when one template fails, the templates still running are stopped and the pending ones never start
+    cancel = threading.Event()
+    failure = None
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(run_lima_template, template, template_yaml, log_dir, cancel, tracer)
+            for template, template_yaml in template_yamls.items()
+        ]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (CancelledError, TemplateCancelledError):
+                pass
+            except Exception as ex:
+                if failure is None:
+                    failure = ex
+                    cancel.set()
+                    for pending in futures:
+                        pending.cancel()
+    if failure is not None:
+        raise failure
+
+def run_lima_template(template_name: str, template_yaml: str, log_dir: str, cancel: threading.Event, tracer: Tracer):
+    log_path = os.path.join(log_dir, f"{template_name}.log")
+    with PROFILER.template(template_name):
+        start = time.monotonic()
         try:
-            if 'Mach-O' not in subprocess.check_output(f"file {copy_path}", shell=True, text=True): continue
+            home_dir = os.getenv("HOME")
+            if not home_dir:
+                raise RuntimeError("failed to get home dir")
+            with open(log_path, "w") as log:
+                if os.path.exists(os.path.join(home_dir, ".lima", template_name)):
+                    run_limactl(template_name, ["delete", "-f", template_name], log, cancel, tracer)
+
+                run_limactl(template_name, ["start", "--tty=false", "--vm-type=qemu", template_yaml], log, cancel, tracer)
+                run_limactl(template_name, ["shell", template_name, "uname"], log, cancel, tracer)
+                run_limactl(template_name, ["stop", template_name], log, cancel, tracer)
+                run_limactl(template_name, ["delete", template_name], log, cancel, tracer)
+            print(f"[{template_name}] finished in {time.monotonic() - start:.1f}s")
+        except TemplateCancelledError:
+            print(f"[{template_name}] cancelled, deleting the instance")
+            run_process(["limactl", "delete", "-f", template_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            raise
         except Exception as ex:
-            print(f"WARNING: failed to run file command on {copy_path}: ", ex)
+            # set here rather than once the failure is seen by run_lima_templates, which may be after
+            # this thread has picked up a pending template
+            cancel.set()
+            print_lima_template_logs(template_name, log_path)
+            raise RuntimeError(f"failed to run lima template '{template_name}'") from ex
+
+# Runs limactl under tracer with its output appended to log, stopping it early if cancel gets set
+def run_limactl(template_name: str, args: List[str], log, cancel: threading.Event, tracer: Tracer):
+    if cancel.is_set():
+        raise TemplateCancelledError(f"lima template '{template_name}' was cancelled")
+
+    cmd = ["limactl"] + args
+    print(f"[{template_name}] {' '.join(cmd)}")
+    log.write(f"$ {' '.join(cmd)}\n")
+    log.flush()
+    process = start_process(tracer.wrap(cmd), stdout=log, stderr=subprocess.STDOUT)
+    while True:
+        try:
+            returncode = process.wait(timeout=1)
+            break
+        except subprocess.TimeoutExpired:
+            if not cancel.is_set(): continue
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            raise TemplateCancelledError(f"lima template '{template_name}' was cancelled")
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+def print_lima_template_logs(template_name: str, log_path: str):
+    home_dir = os.getenv("HOME", "")
+    lima_dir = os.path.join(home_dir, ".lima", template_name)
+    logs = [(f"{template_name} limactl output", log_path)]
+    logs += [(f"{template_name} {log}", os.path.join(lima_dir, log)) for log in ["ha.stderr.log", "ha.stdout.log", "serial.log"]]
+    for title, path in logs:
+        if os.path.exists(path):
+            print(f"=== {title} ===")
+            with open(path, errors="replace") as f:
+                content = f.read()
+                print(content[-5000:] if len(content) > 5000 else content)
+
+# Mach-O constants, see <mach-o/loader.h> and <mach-o/fat.h>
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_LOAD_WEAK_DYLIB = 0x80000018
+LC_RPATH = 0x8000001c
+LC_REEXPORT_DYLIB = 0x8000001f
+LC_LOAD_UPWARD_DYLIB = 0x80000023
+LC_SOURCE_VERSION = 0x2a
+
+# load commands naming a dylib the image links against, i.e. the ones
+# "otool -L" lists and "install_name_tool -change" rewrites
+DEPENDENT_DYLIB_COMMANDS = {
+    LC_LOAD_DYLIB,
+    LC_LOAD_WEAK_DYLIB,
+    LC_REEXPORT_DYLIB,
+    LC_LAZY_LOAD_DYLIB,
+    LC_LOAD_UPWARD_DYLIB,
+}
+
+class DylibRef(NamedTuple):
+    command: int  # LC_* constant of the load command
+    name: str     # install name, or the path for LC_RPATH
+    offset: int   # file offset of the load command
+
+class MachOSlice(NamedTuple):
+    offset: int       # file offset of the image, 0 unless it is part of a fat binary
+    size: int
+    cputype: int
+    is_64: bool
+    byteorder: str    # struct byte order prefix
+    ncmds: int
+    sizeofcmds: int
+    data_offset: int  # image relative offset of the first segment or section contents
+    refs: List[DylibRef]
+    source_version: int = 0  # packed A.B.C.D.E of LC_SOURCE_VERSION, 0 if there is none
+
+    @property
+    def header_size(self) -> int:
+        return 32 if self.is_64 else 28
+
+    def dependent_dylibs(self) -> List[DylibRef]:
+        return [ref for ref in self.refs if ref.command in DEPENDENT_DYLIB_COMMANDS]
+
+    def rpaths(self) -> List[str]:
+        return [ref.name for ref in self.refs if ref.command == LC_RPATH]
+
+    def install_name(self) -> Optional[str]:
+        return next((ref.name for ref in self.refs if ref.command == LC_ID_DYLIB), None)
+
+# Reads the Mach-O header(s) and load commands of path without running "file" and "otool".
+# The file is mmap-ed, so only the pages holding the headers are actually read from disk.
+# Returns None if path is not a Mach-O file, and one MachOSlice per architecture otherwise.
+def read_macho(path: str) -> Optional[List[MachOSlice]]:
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 8:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                magic, = struct.unpack_from(">I", m, 0)
+                if magic not in (FAT_MAGIC, FAT_MAGIC_64):
+                    image = _read_macho_image(m, 0, size)
+                    return [image] if image else None
+                return _read_fat_macho(m, magic)
+    except (OSError, ValueError, struct.error) as ex:
+        raise RuntimeError(f"failed to read Mach-O headers of {path}") from ex
+
+def _read_fat_macho(m: mmap.mmap, magic: int) -> Optional[List[MachOSlice]]:
+    nfat_arch, = struct.unpack_from(">I", m, 4)
+    # Java class files share the fat magic, their version numbers make nfat_arch huge
+    if not 0 < nfat_arch < 20:
+        return None
+    images = []
+    for i in range(nfat_arch):
+        if magic == FAT_MAGIC:
+            _, _, offset, size, _ = struct.unpack_from(">iiIII", m, 8 + i * 20)
+        else:
+            _, _, offset, size, _, _ = struct.unpack_from(">iiQQII", m, 8 + i * 32)
+        image = _read_macho_image(m, offset, size)
+        if not image:
+            raise ValueError(f"fat slice at offset {offset} is not a Mach-O image")
+        images.append(image)
+    return images
+
+def _read_macho_image(m: mmap.mmap, offset: int, size: int) -> Optional[MachOSlice]:
+    byteorder = "<"
+    magic, = struct.unpack_from("<I", m, offset)
+    if magic not in (MH_MAGIC, MH_MAGIC_64):
+        byteorder = ">"
+        magic, = struct.unpack_from(">I", m, offset)
+        if magic not in (MH_MAGIC, MH_MAGIC_64):
+            return None
+
+    is_64 = magic == MH_MAGIC_64
+    cputype, _, _, ncmds, sizeofcmds, _ = struct.unpack_from(f"{byteorder}iiIIII", m, offset + 4)
+    pos = offset + (32 if is_64 else 28)
+    end = pos + sizeofcmds
+    if end > offset + size or end > len(m):
+        raise ValueError(f"load commands of image at offset {offset} are truncated")
+
+    refs: List[DylibRef] = []
+    data_offset = size
+    source_version = 0
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from(f"{byteorder}II", m, pos)
+        if cmdsize < 8 or pos + cmdsize > end:
+            raise ValueError(f"malformed load command at offset {pos}")
+        if cmd in DEPENDENT_DYLIB_COMMANDS or cmd in (LC_ID_DYLIB, LC_RPATH):
+            name_offset, = struct.unpack_from(f"{byteorder}I", m, pos + 8)
+            if not 8 < name_offset < cmdsize:
+                raise ValueError(f"malformed name in load command at offset {pos}")
+            name = m[pos + name_offset:pos + cmdsize].split(b"\0", 1)[0]
+            refs.append(DylibRef(cmd, name.decode("utf-8", "surrogateescape"), pos))
+        elif cmd in (LC_SEGMENT, LC_SEGMENT_64):
+            data_offset = min(data_offset, _segment_data_offset(m, pos, cmd == LC_SEGMENT_64, byteorder))
+        elif cmd == LC_SOURCE_VERSION and cmdsize >= 16:
+            source_version, = struct.unpack_from(f"{byteorder}Q", m, pos + 8)
+        pos += cmdsize
+
+    return MachOSlice(offset, size, cputype, is_64, byteorder, ncmds, sizeofcmds, data_offset, refs, source_version)
+
+# Returns the lowest offset of the segment's file contents, excluding the mach header itself which
+# is mapped by __TEXT at file offset 0. This bounds how far the load commands can grow.
+def _segment_data_offset(m: mmap.mmap, pos: int, is_64: bool, byteorder: str) -> int:
+    if is_64:
+        _, _, _, fileoff, filesize, _, _, nsects, _ = struct.unpack_from(f"{byteorder}16sQQQQiiII", m, pos + 8)
+        sections, section_size, offset_field = pos + 72, 80, 48
+    else:
+        _, _, _, fileoff, filesize, _, _, nsects, _ = struct.unpack_from(f"{byteorder}16sIIIIiiII", m, pos + 8)
+        sections, section_size, offset_field = pos + 56, 68, 40
+    offsets = [fileoff] if fileoff and filesize else []
+    for i in range(nsects):
+        section_offset, = struct.unpack_from(f"{byteorder}I", m, sections + i * section_size + offset_field)
+        if section_offset:
+            offsets.append(section_offset)
+    return min(offsets, default=sys.maxsize)
+
+# Rewrites the dependent dylib install names of path according to changes (old name -> new name),
+# like one "install_name_tool -change" per entry but in a single pass over the load commands of
+# every slice. Raises RuntimeError without touching the file if the rewritten load commands don't
+# fit into the padding before the first section. Returns whether the file was changed.
+def change_install_names(path: str, changes: Dict[str, str]) -> bool:
+    slices = read_macho(path)
+    if not slices:
+        raise RuntimeError(f"{path} is not a Mach-O file")
+
+    try:
+        with open(path, "r+b") as f:
+            patches = []
+            for image in slices:
+                f.seek(image.offset)
+                load_commands = f.read(image.header_size + image.sizeofcmds)
+                patch = _change_install_names_in_image(image, load_commands, changes)
+                if patch is None: continue
+                if len(patch) > image.data_offset:
+                    raise RuntimeError(
+                        f"changed load commands of {path} (cputype {image.cputype}) need {len(patch)} bytes, "
+                        f"but only {image.data_offset} are available before the first section"
+                    )
+                patches.append((image.offset, patch))
+
+            for offset, patch in patches:
+                f.seek(offset)
+                f.write(patch)
+            return bool(patches)
+    except OSError as ex:
+        raise RuntimeError(f"failed to change install names of {path}") from ex
+
+# Returns the mach header and load commands of image with the install names in changes replaced,
+# zero padded to the original size if they shrank, or None if none of the names are referenced.
+def _change_install_names_in_image(image: MachOSlice, load_commands: bytes, changes: Dict[str, str]) -> Optional[bytes]:
+    byteorder = image.byteorder
+    alignment = 8 if image.is_64 else 4
+    commands = []
+    changed = False
+    pos = image.header_size
+    for _ in range(image.ncmds):
+        cmd, cmdsize = struct.unpack_from(f"{byteorder}II", load_commands, pos)
+        command = load_commands[pos:pos + cmdsize]
+        pos += cmdsize
+        if cmd not in DEPENDENT_DYLIB_COMMANDS:
+            commands.append(command)
+            continue
+
+        name_offset, = struct.unpack_from(f"{byteorder}I", command, 8)
+        name = command[name_offset:].split(b"\0", 1)[0].decode("utf-8", "surrogateescape")
+        if name not in changes:
+            commands.append(command)
             continue
-        
+
+        new_name = changes[name].encode("utf-8", "surrogateescape") + b"\0"
+        new_cmdsize = -(-(name_offset + len(new_name)) // alignment) * alignment
+        commands.append(
+            struct.pack(f"{byteorder}III", cmd, new_cmdsize, name_offset)
+            + command[12:name_offset]
+            + new_name.ljust(new_cmdsize - name_offset, b"\0")
+        )
+        changed = True
+
+    if not changed:
+        return None
+    body = b"".join(commands)
+    header = bytearray(load_commands[:image.header_size])
+    struct.pack_into(f"{byteorder}I", header, 20, len(body))
+    return bytes(header) + body.ljust(image.sizeofcmds, b"\0")
+
+# Records what every entry of the dist tree was built from: the source signature, the install names
+# rewritten in it and whether it still has to be signed. Later builds only recopy, relink and re-sign
+# the entries whose source or dist copy changed, and remove the ones that left the dependency set.
+class DistManifest:
+    def __init__(self, dist_path: str):
+        self.dist_path = dist_path
+        self.path = f"{dist_path}.manifest.json"
+        # keyed by the path relative to dist_path
+        self.entries: Dict[str, dict] = {}
+
+    def load(self) -> bool:
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+            return True
+        except (OSError, ValueError):
+            self.entries = {}
+            return False
+
+    def save(self):
         try:
-            print("using otool to find all dylib references")
-            res = subprocess.check_output(f"otool -L {file_path}", shell=True, text=True)
-            print(f"otool output: {res}")
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as ex:
+            raise RuntimeError(f"failed to save dist manifest {self.path}") from ex
+
+    def is_current(self, rel_path: str, source: list) -> bool:
+        entry = self.entries.get(rel_path)
+        return bool(entry) and entry["source"] == source and entry["dist"] == _dist_signature(f"{self.dist_path}/{rel_path}")
+
+    def entry(self, copy_path: str) -> dict:
+        return self.entries[copy_path.removeprefix(f"{self.dist_path}/")]
+
+    # the digests before and after signing are kept so that the same bytes aren't signed again
+    def mark_signed(self, copy_path: str, unsigned_digest: str, signed_digest: str):
+        entry = self.entry(copy_path)
+        entry["signed"] = True
+        entry["unsigned_digest"] = unsigned_digest
+        entry["signed_digest"] = signed_digest
+        entry["dist"] = _dist_signature(copy_path)
+
+def _tree_digest(path: str, with_stats: bool) -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            if with_stats:
+                st = os.lstat(file_path)
+                digest.update(f":{st.st_size}:{st.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+# What the copy of path would be built from; files in bin are copied from the symlink target
+def _source_signature(path: str, dereference: bool) -> list:
+    if not dereference and os.path.islink(path):
+        return ["link", os.readlink(path)]
+    st = os.stat(path)
+    if stat.S_ISDIR(st.st_mode):
+        return ["dir", _tree_digest(path, with_stats=True)]
+    return ["file", st.st_size, st.st_mtime_ns, st.st_ino]
+
+# The state of a dist copy after it was processed. Directories are compared by the names they contain
+# only, because files in them are relinked and signed after the directory was copied.
+def _dist_signature(copy_path: str) -> list:
+    try:
+        st = os.lstat(copy_path)
+        if stat.S_ISLNK(st.st_mode):
+            return ["link", os.readlink(copy_path)]
+        if stat.S_ISDIR(st.st_mode):
+            return ["dir", _tree_digest(copy_path, with_stats=False)]
+        return ["file", st.st_size, st.st_mtime_ns]
+    except OSError:
+        return []
+
+def _remove_dist_copy(copy_path: str):
+    if os.path.isdir(copy_path) and not os.path.islink(copy_path):
+        shutil.rmtree(copy_path)
+    elif os.path.lexists(copy_path):
+        os.unlink(copy_path)
+
+# Collects the size and duration of every file copied into the dist tree
+class CopyStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files: List[Tuple[str, int, float]] = []
+        self.start = time.monotonic()
+
+    def add(self, path: str, size: int, seconds: float):
+        with self._lock:
+            self.files.append((path, size, seconds))
+
+    def report(self):
+        elapsed = time.monotonic() - self.start
+        total = sum(size for _, size, _ in self.files)
+        rate = total / elapsed / (1 << 20) if elapsed > 0 else 0
+        print(f"copied {len(self.files)} files, {total} bytes in {elapsed:.2f}s ({rate:.1f} MiB/s)")
+        for path, size, seconds in sorted(self.files, key=lambda f: f[2], reverse=True)[:5]:
+            print(f"  {seconds * 1000:8.1f}ms {format_size(size):>6} {path}")
+
+FICLONE = 0x40049409
+
+# Clones src into dst where the filesystem supports it (APFS clonefile, btrfs/XFS FICLONE), otherwise
+# copies the contents in the kernel with copy_file_range, sendfile or fcopyfile, never through Python.
+def copy_file(src: str, dst: str, stats: Optional[CopyStats] = None):
+    start = time.monotonic()
+    try:
+        if not _clone_file(src, dst):
+            with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+                size = os.fstat(f_in.fileno()).st_size
+                copied = 0
+                if hasattr(os, "copy_file_range"):
+                    try:
+                        while copied < size:
+                            n = os.copy_file_range(f_in.fileno(), f_out.fileno(), size - copied)
+                            if n == 0: break
+                            copied += n
+                    except OSError as ex:
+                        if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP): raise
+                        copied = 0
+            if copied < size:
+                # uses sendfile on Linux and fcopyfile on macOS
+                shutil.copyfile(src, dst)
+            shutil.copymode(src, dst)
+        if stats is not None:
+            stats.add(dst, os.path.getsize(dst), time.monotonic() - start)
+    except OSError as ex:
+        raise RuntimeError(f"failed to copy {src} to {dst}") from ex
+
+def _clone_file(src: str, dst: str) -> bool:
+    global _libc
+    if sys.platform == "darwin":
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        # clonefile copies the mode like cp does and fails with ENOTSUP across filesystems
+        return _libc.clonefile(os.fsencode(os.path.realpath(src)), os.fsencode(dst), 0) == 0
+    try:
+        with open(src, "rb") as f_in, open(dst, "wb") as f_out:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        shutil.copymode(src, dst)
+        return True
+    except OSError:
+        return False
+
+# Copies src to dst like "cp -R": symlinks are copied as symlinks, files are copied on executor if given
+def copy_tree(src: str, dst: str, stats: CopyStats, executor: Optional[ThreadPoolExecutor] = None):
+    futures = []
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.makedirs(target_root, exist_ok=True)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target_root, name))
+            elif name in files and executor:
+                futures.append(executor.submit(copy_file, path, os.path.join(target_root, name), stats))
+            elif name in files:
+                copy_file(path, os.path.join(target_root, name), stats)
+        # os.walk doesn't descend into symlinked directories, which were copied as links above
+    _raise_failures(futures, f"failed to copy {src} to {dst}")
+
+def _raise_failures(futures: list, message: str):
+    failures = []
+    for future in futures:
+        try:
+            future.result()
         except Exception as ex:
-            raise RuntimeError(f"failed to run otool command on {file_path}") from ex
-        
-        # skip the first line as it lists the binary iteself
-        # this is not done in the perl script and yet it somehow works
-        for line in res.splitlines()[1:]:
-            line = line.strip()
-            match = re.search(rf'{install_dir}/(\S+)', line)
-            if not match: continue
-            dylib = match.group(1)
-            print(f"otool found dylib -> {dylib}")
-            
-            grep_filter = ""
-            if file_path.endswith(f'bin/qemu-system-{arch}'):
-                # qemu-system-* is already signed with an entitlement to use the hypervisor framework
-                grep_filter = "| grep -v 'will invalidate the code signature'"
-                resign_files.add(copy_path)
-            if arch == Arch.AARCH64:
-                resign_files.add(copy_path)
-            
-            try:
-                install_name_tool_cmd = f"install_name_tool -change {install_dir}/{dylib} @executable_path/../{dylib} {copy_path} 2>&1 {grep_filter}"
-                res = subprocess.check_output(install_name_tool_cmd, text=True, shell=True)
-                print("install_name_tool output: ", res)
-            except Exception as ex:
-                print("WARNING: failed to run install_name_tool: ", ex)
+            failures.append(ex)
+    for ex in failures:
+        print(f"ERROR: {ex}")
+    if failures:
+        raise RuntimeError(f"{message}: {len(failures)} errors") from failures[0]
+
+# Keeps the dist tree in sync with the deps while they are still being recorded. Every path passed to
+# submit() is checked against the manifest by a sequencing thread, and outdated files are copied and
+# relinked on a thread pool, so most of the work is done while the lima templates boot and finish()
+# only has to process what is left. Directories are copied by the sequencing thread itself: their
+# copy overwrites the copies of files in them, so the files already processed are waited for and
+# processed again after it.
+class DistSyncer:
+    def __init__(self, arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, copy_workers: int = min(32, (os.cpu_count() or 1) + 4), dist_path: str = "/tmp/lima-and-qemu"):
+        self.arch = arch
+        self.install_dir = install_dir
+        self.dist_path = dist_path
+        self.manifest = DistManifest(self.dist_path)
+        self.resign_files: Set[str] = set()
+        self.stats = CopyStats()
+        self.updated_count = 0
+        self._executor = ThreadPoolExecutor(max_workers=copy_workers)
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._error: Optional[Exception] = None
+        # guards the manifest and resign_files, which are updated from the pool
+        self._lock = threading.Lock()
+        # only used by the sequencing thread until it's done
+        self._processed: Set[str] = set()
+        self._futures: Dict[str, Future] = {}
+        self._recopied_dirs: List[str] = []
 
-    # Replace invalidated signatures
-    return dist_path, resign_files
+    def start(self):
+        if not self.manifest.load():
+            # without a manifest nothing is known about an existing dist tree
+            shutil.rmtree(self.dist_path, ignore_errors=True)
+        self._thread.start()
 
-def resign(resign_files: Set[str]):
-    for file_path in resign_files:
+    def submit(self, file_path: str):
+        self._queue.put(file_path)
+
+    # Processes the deps not submitted yet, removes the copies of paths that are no longer deps and
+    # waits for the dist tree to be complete
+    def finish(self, deps: Dict[str, DepEntry]) -> Tuple[str, Set[str], DistManifest]:
         try:
-            res = subprocess.check_output(
-                f"codesign --sign - --force --preserve-metadata=entitlements {file_path}",
-                shell=True,
-                text=True
-            )
-            print(f"codesign output: {res}")
+            for file_path in deps.keys():
+                self.submit(file_path)
+            self._queue.put(None)
+            self._thread.join()
+            if self._error is not None:
+                raise RuntimeError("failed to copy dependencies") from self._error
+
+            rel_paths = {file_path.removeprefix(f"{self.install_dir}/") for file_path in deps.keys()}
+            for rel_path in sorted(set(self.manifest.entries) - rel_paths, reverse=True):
+                print(f"removing {self.dist_path}/{rel_path}, it is no longer a dependency")
+                self._redo_under(f"{rel_path}/", lambda: _remove_dist_copy(f"{self.dist_path}/{rel_path}"))
+                del self.manifest.entries[rel_path]
+
+            _raise_failures(list(self._futures.values()), "failed to copy dependencies")
+        finally:
+            self._executor.shutdown()
+            self.manifest.save()
+        self.stats.report()
+        print(f"updated {self.updated_count} of {len(deps)} entries in {self.dist_path}")
+
+        # Replace invalidated signatures
+        return self.dist_path, self.resign_files, self.manifest
+
+    # Stops processing after a failure elsewhere, keeping what was done so far
+    def abort(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown(cancel_futures=True)
+        self.manifest.save()
+
+    def _run(self):
+        try:
+            while True:
+                file_path = self._queue.get()
+                if file_path is None: return
+                self._process(file_path)
         except Exception as ex:
-            raise RuntimeError(f"failed to resign {file_path}") from ex
+            self._error = ex
 
-def compress_archive(archive_path: str):
-    if not os.path.exists(archive_path):
-        raise RuntimeError("{archive_path} does not exist")
-    
+    def _process(self, file_path: str):
+        if file_path in self._processed: return
+        self._processed.add(file_path)
+
+        rel_path = file_path.removeprefix(f"{self.install_dir}/")
+        in_bin = file_path.startswith(f"{self.install_dir}/bin/")
+        source = _source_signature(file_path, dereference=in_bin)
+        # a directory that got copied again overwrote the copies of the files in it
+        in_recopied_dir = any(rel_path.startswith(dir_path) for dir_path in self._recopied_dirs)
+        with self._lock:
+            if self.manifest.is_current(rel_path, source) and not in_recopied_dir:
+                entry = self.manifest.entries[rel_path]
+                if entry["needs_signature"] and not entry["signed"]:
+                    self.resign_files.add(f"{self.dist_path}/{rel_path}")
+                return
+        self.updated_count += 1
+
+        copy_path = f"{self.dist_path}/{rel_path}"
+        if source[0] == "dir":
+            def copy_dir():
+                _copy_dep(file_path, copy_path, in_bin, self.stats, self._executor)
+                with self._lock:
+                    self._update(file_path, rel_path, source, {})
+            self._redo_under(f"{rel_path}/", copy_dir)
+            return
+        self._futures[file_path] = self._executor.submit(self._copy_and_update, file_path, rel_path, in_bin, source)
+
+    # Runs change, which replaces the dist copy of the directory dir_path, once the files in it are
+    # done, and processes them again afterwards
+    def _redo_under(self, dir_path: str, change: Callable[[], None]):
+        redo = [
+            file_path for file_path in self._processed
+            if file_path.removeprefix(f"{self.install_dir}/").startswith(dir_path)
+        ]
+        for file_path in redo:
+            future = self._futures.pop(file_path, None)
+            if future is not None:
+                wait([future])
+        change()
+        self._recopied_dirs.append(dir_path)
+        for file_path in sorted(redo):
+            self._processed.discard(file_path)
+            self._process(file_path)
+
+    def _copy_and_update(self, file_path: str, rel_path: str, in_bin: bool, source: list):
+        rewrites = _copy_and_relink(file_path, f"{self.dist_path}/{rel_path}", in_bin, self.install_dir, self.stats)
+        with self._lock:
+            self._update(file_path, rel_path, source, rewrites)
+
+    def _update(self, file_path: str, rel_path: str, source: list, rewrites: Dict[str, str]):
+        copy_path = f"{self.dist_path}/{rel_path}"
+        # qemu-system-* is already signed with an entitlement to use the hypervisor framework,
+        # and on aarch64 every binary has to carry a valid signature
+        needs_signature = bool(rewrites) and (file_path.endswith(f'bin/qemu-system-{self.arch}') or self.arch == Arch.AARCH64)
+        if needs_signature:
+            self.resign_files.add(copy_path)
+        else:
+            self.resign_files.discard(copy_path)
+        self.manifest.entries[rel_path] = {
+            "source_path": file_path,
+            "source": source,
+            "rewrites": rewrites,
+            "needs_signature": needs_signature,
+            "signed": False,
+            "dist": _dist_signature(copy_path),
+        }
+
+def copy_deps(deps: Dict[str, DepEntry], arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str, copy_workers: int = min(32, (os.cpu_count() or 1) + 4), dist_path: str = "/tmp/lima-and-qemu"):
+    syncer = DistSyncer(arch, install_dir, copy_workers, dist_path)
+    syncer.start()
+    return syncer.finish(deps)
+
+def _copy_dep(file_path: str, copy_path: str, in_bin: bool, stats: CopyStats, executor: Optional[ThreadPoolExecutor] = None):
+    os.makedirs(os.path.dirname(copy_path), exist_ok=True)
+    _remove_dist_copy(copy_path)
+
+    if in_bin:
+        # symlinks in the bin directory are replaced by the target file because in
+        # macOS Monterey @executable_path refers to the symlink target and not the
+        # symlink location itself, breaking the dylib lookup.
+        copy_file(file_path, copy_path, stats)
+    elif os.path.islink(file_path):
+        os.symlink(os.readlink(file_path), copy_path)
+    elif os.path.isdir(file_path):
+        copy_tree(file_path, copy_path, stats, executor)
+    else:
+        copy_file(file_path, copy_path, stats)
+
+# Copies file_path to copy_path and points its references to dylibs in install_dir to the copies in
+# the dist tree. Returns the install names that were changed.
+def _copy_and_relink(file_path: str, copy_path: str, in_bin: bool, install_dir: str, stats: CopyStats) -> Dict[str, str]:
+    _copy_dep(file_path, copy_path, in_bin, stats)
+
+    # if the file is not a mac os executable, skip looking for dylib references
+    if os.path.islink(copy_path) or not os.path.isfile(copy_path): return {}
+    slices = read_macho(copy_path)
+    if not slices: return {}
+
+    dylibs = []
+    for image in slices:
+        for ref in image.dependent_dylibs():
+            dylib = ref.name.removeprefix(f"{install_dir}/")
+            if dylib != ref.name and dylib not in dylibs:
+                dylibs.append(dylib)
+
+    changes: Dict[str, str] = {}
+    for dylib in dylibs:
+        print(f"found dylib reference in {file_path} -> {dylib}")
+        changes[f"{install_dir}/{dylib}"] = f"@executable_path/../{dylib}"
+    if not changes or not change_install_names(copy_path, changes):
+        return {}
+    print(f"changed {len(changes)} install names in {copy_path}")
+    return changes
+
+# Signed copies are kept under the digest of the file before signing, so a file that is copied and
+# relinked to the same bytes again by a later build doesn't go through codesign again
+SIGNED_CACHE_DIR = os.path.join(CACHE_DIR, "signed")
+# seconds a signed copy is kept after the last build that used it
+SIGNED_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+HYPERVISOR_ENTITLEMENT = "com.apple.security.hypervisor"
+
+def resign(resign_files: Set[str], manifest: DistManifest, sign_workers: int = os.cpu_count() or 1):
+    start = time.monotonic()
+    timings: List[Tuple[str, str, float]] = []
     try:
-        lima_repo_root = os.path.join(os.getcwd(), 'src', 'lima')
-        compressed_tarball_path = f"{lima_repo_root}/lima-and-qemu.tar.gz"
-        if os.path.exists(compressed_tarball_path):
-            os.unlink(compressed_tarball_path)
-        with open(archive_path, "rb") as f_in, gzip.open(compressed_tarball_path, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-    except Exception as ex:
-        raise RuntimeError("failed to compress archive {archive_path}") from ex
+        with ThreadPoolExecutor(max_workers=sign_workers) as executor:
+            futures = {}
+            for file_path in sorted(resign_files):
+                entry = manifest.entry(file_path)
+                future = executor.submit(_resign_file, file_path, entry.get("unsigned_digest"), entry.get("signed_digest"))
+                futures[future] = file_path
+            for future in as_completed(futures):
+                if future.exception() is not None: continue
+                file_path = futures[future]
+                unsigned_digest, signed_digest, action, seconds = future.result()
+                manifest.mark_signed(file_path, unsigned_digest, signed_digest)
+                timings.append((file_path, action, seconds))
+            _raise_failures(list(futures), "failed to resign files")
+    finally:
+        manifest.save()
+
+    counts = {action: sum(1 for _, a, _ in timings if a == action) for action in ["signed", "cached", "unchanged"]}
+    print(f"resigned {len(timings)} files in {time.monotonic() - start:.2f}s: {counts['signed']} signed, {counts['cached']} from the cache, {counts['unchanged']} unchanged")
+    for file_path, action, seconds in sorted(timings, key=lambda t: t[2], reverse=True)[:5]:
+        print(f"  {seconds * 1000:8.1f}ms {action:>9} {file_path}")
+    _evict_signed_copies(manifest)
 
-def add_lima_version_to_archive(archive_path: str, lima_version: str):
+# Signs file_path unless it already is the result of its last signature, returning the digests
+# before and after signing, what was done and how long it took
+def _resign_file(file_path: str, unsigned_digest: Optional[str], signed_digest: Optional[str]) -> Tuple[str, str, str, float]:
+    start = time.monotonic()
     try:
-        if not os.path.exists(archive_path):
-            raise RuntimeError(f"archive {archive_path} does not exist")
-        
-        with open("LIMA_VERSION", "w") as f:
-            f.write(lima_version)
-        print(f"Created LIMA_VERSION file with content: {lima_version}")
-
-        with tarfile.open(archive_path, "a" ) as tar:
-            tar.add("LIMA_VERSION", arcname="LIMA_VERSION")
-            print(f"Added LIMA_VERSION file to archive {archive_path}")
+        digest = _file_digest(file_path)
+        if digest == signed_digest:
+            return unsigned_digest, signed_digest, "unchanged", time.monotonic() - start
+
+        cached_path = os.path.join(SIGNED_CACHE_DIR, digest)
+        if os.path.isfile(cached_path):
+            copy_file(cached_path, f"{file_path}.signed")
+            os.replace(f"{file_path}.signed", file_path)
+            action = "cached"
+        else:
+            res = run_process(
+                ["codesign", "--sign", "-", "--force", "--preserve-metadata=entitlements", file_path],
+                capture_output=True,
+                text=True,
+            )
+            if res.returncode != 0:
+                raise RuntimeError(f"codesign exited with {res.returncode}: {res.stderr.strip()}")
+            action = "signed"
+
+        # qemu can't use the hypervisor framework without this entitlement
+        if os.path.basename(file_path).startswith("qemu-system-"):
+            _check_entitlement(file_path, HYPERVISOR_ENTITLEMENT)
+
+        if action == "signed":
+            try:
+                os.makedirs(SIGNED_CACHE_DIR, exist_ok=True)
+                # identical files may be signed at the same time
+                tmp_path = f"{cached_path}.{threading.get_ident()}.tmp"
+                copy_file(file_path, tmp_path)
+                os.replace(tmp_path, cached_path)
+            except Exception as ex:
+                print(f"WARNING: failed to cache the signed copy of {file_path}: ", ex)
+        return digest, _file_digest(file_path), action, time.monotonic() - start
     except Exception as ex:
-        raise RuntimeError("failed to add LIMA_VERSION to archive") from ex
+        raise RuntimeError(f"failed to resign {file_path}") from ex
+
+def _check_entitlement(file_path: str, entitlement: str):
+    res = run_process(["codesign", "-d", "--entitlements", "-", file_path], capture_output=True, text=True)
+    if res.returncode != 0 or entitlement not in res.stdout + res.stderr:
+        raise RuntimeError(f"{file_path} is missing the {entitlement} entitlement after signing")
+
+# The signed copies are shared by every dist tree built with the same CACHE_DIR, e.g. the one of each
+# arch, so they are evicted by age rather than by what the current dist tree references. The copies of
+# the current dist tree are marked as used first, then the ones no build used for a while are removed.
+def _evict_signed_copies(manifest: DistManifest):
+    used = {entry.get("unsigned_digest") for entry in manifest.entries.values()}
+    try:
+        cached = os.listdir(SIGNED_CACHE_DIR)
+    except OSError:
+        return
+    now = time.time()
+    for name in cached:
+        path = os.path.join(SIGNED_CACHE_DIR, name)
+        try:
+            if name in used:
+                os.utime(path, (now, now))
+            elif now - os.stat(path).st_mtime > SIGNED_CACHE_MAX_AGE:
+                os.unlink(path)
+        except OSError as ex:
+            print(f"WARNING: failed to evict signed copy {name}: ", ex)
+
+# Passes everything written to it on to f while computing its digest
+class DigestWriter:
+    def __init__(self, f, algorithm: str = "sha512"):
+        self.f = f
+        self.hash = hashlib.new(algorithm)
+        self.bytes_written = 0
+
+    def write(self, data) -> int:
+        self.hash.update(data)
+        self.bytes_written += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+# Counts what is written to it instead of keeping it, e.g. to get a compressed size
+class ByteCounter:
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data) -> int:
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+# A gzip writer that compresses blocks of its input on a thread pool like pigz does; zlib releases the
+# GIL while compressing. Every block is deflated on its own, primed with the last 32K of the previous
+# block as dictionary and ended with a sync flush, so the concatenated blocks form one standard
+# deflate stream that gunzip and tar read like any other gzip file.
+class ParallelGzipWriter:
+    def __init__(self, f, level: int = 9, block_size: int = 1 << 20, workers: int = os.cpu_count() or 1, mtime: Optional[int] = None):
+        self.f = f
+        self.level = level
+        self.block_size = block_size
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = workers * 2
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._dictionary = b""
+        self._crc = 0
+        self._size = 0
+        self._closed = False
+        xfl = 2 if level == 9 else 4 if level == 1 else 0
+        self.f.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time()) if mtime is None else mtime) + bytes([xfl, 3]))
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, last=False)
+        return len(data)
 
-def package_files_and_socket_vmnet(deps: Dict[str, str], install_dir: str, dist_path: str):
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._closed: return
+        self._closed = True
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            while self._pending:
+                self.f.write(self._pending.popleft().result())
+            self.f.write(struct.pack("<II", self._crc & 0xffffffff, self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._closed = True
+            self._executor.shutdown(cancel_futures=True)
+
+    def _submit(self, block: bytes, last: bool):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._executor.submit(_deflate_block, block, self._dictionary, self.level, last))
+        self._dictionary = block[-32768:]
+        while len(self._pending) > self._max_pending:
+            self.f.write(self._pending.popleft().result())
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def package_files_and_socket_vmnet(
+    deps: Dict[str, DepEntry],
+    install_dir: str,
+    dist_path: str,
+    lima_version: str,
+    compression_level: int = 9,
+    compression_block_size: int = 1 << 20,
+    compression_workers: int = os.cpu_count() or 1,
+    dedup: bool = True,
+    layered: bool = False,
+    seekable: bool = False,
+):
     tar_files = [path.removeprefix(f"{install_dir}/") for path in deps.keys()]
     
     # Package socket_vmnet
     socket_vmnet_dest = f"{dist_path}/socket_vmnet"
-    if os.path.exists(socket_vmnet_dest):
-        raise RuntimeError(f"{socket_vmnet_dest} already exists")
-    
     try:
+        # the dist tree is reused between builds, see DistManifest
+        shutil.rmtree(socket_vmnet_dest, ignore_errors=True)
         socket_vmnet_src = "/opt/socket_vmnet/bin/socket_vmnet"
         if os.path.isfile(socket_vmnet_src):
             os.makedirs(f"{socket_vmnet_dest}/bin", exist_ok=True)
@@ -301,161 +2360,488 @@ def package_files_and_socket_vmnet(deps: Dict[str, str], install_dir: str, dist_
     # Ensure all files are writable by the owner; this is required for Squirrel.Mac
     # to remove the quarantine xattr when applying updates.
     try:
-        subprocess.run(f"chmod -R u+w {dist_path}", shell=True, check=True)
+        run_process(f"chmod -R u+w {dist_path}", shell=True, check=True)
     except Exception as ex:
         raise RuntimeError("failed to chmod files before packaging") from ex
 
+    # tar, LIMA_VERSION, gzip and the SHA-512 of the result are all produced in a single pass over
+    # the files, without an intermediate uncompressed tarball
     try:
         lima_repo_root = os.path.join(os.getcwd(), 'src', 'lima')
-        tarball_path = f"{lima_repo_root}/lima-and-qemu.tar"
-        if os.path.exists(tarball_path):
-            os.unlink(tarball_path)
-        with tarfile.open(tarball_path, "w") as tar:
-            for file in tar_files:
-                print(f"adding {dist_path}/{file} to tarball")
-                tar.add(f"{dist_path}/{file}", arcname=file)
-        return tarball_path
+        archive_path = f"{lima_repo_root}/lima-and-qemu.tar.gz"
+        with open(archive_path, "wb") as f:
+            out = DigestWriter(f)
+            gz = ParallelGzipWriter(out, compression_level, compression_block_size, compression_workers)
+            members = _archive_members(dist_path, tar_files)
+            duplicates = _duplicate_files(members) if dedup else {}
+            with gz, tarfile.open(fileobj=gz, mode="w|") as tar:
+                _add_members(tar, members, duplicates)
+
+                lima_version_info = tarfile.TarInfo("LIMA_VERSION")
+                lima_version_info.size = len(lima_version.encode())
+                lima_version_info.mtime = int(time.time())
+                lima_version_info.mode = 0o644
+                tar.addfile(lima_version_info, io.BytesIO(lima_version.encode()))
+                print(f"Added LIMA_VERSION with content {lima_version} to archive")
+
+        if duplicates:
+            saved = sum(os.path.getsize(path) for path, arcname in members if arcname in duplicates)
+            print(f"Stored {len(duplicates)} duplicate files as hardlinks, saving {format_size(saved)} before compression")
+        archive_digest = out.hash.hexdigest()
+        with open(f"{archive_path}.sha512sum", "w") as f:
+            f.write(f"{archive_digest}\n")
+        print(f"Wrote {archive_path} ({out.bytes_written} bytes, sha512 {archive_digest})")
     except Exception as ex:
         raise RuntimeError("failed to package files") from ex
 
-# File references may involve multiple symlinks that need to be recorded as well, e.g.
-#
-#   /usr/local/opt/libssh/lib/libssh.4.dylib
-#
-# turns into 2 symlinks and one file:
-#
-#   /usr/local/opt/libssh → ../Cellar/libssh/0.9.5_1
-#   /usr/local/Cellar/libssh/0.9.5_1/lib/libssh.4.dylib → libssh.4.8.6.dylib
-#   /usr/local/Cellar/libssh/0.9.5_1/lib/libssh.4.8.6.dylib [394K]
-def record_dep(dep: str, deps: Dict[str, str], install_dir: str):
-    if not dep: return
-    if dep in global_seen: return
-    global_seen.add(dep)
+    if layered:
+        try:
+            write_layers(members, dist_path, lima_version, f"{lima_repo_root}/layers", compression_level, compression_block_size, compression_workers, dedup)
+        except Exception as ex:
+            raise RuntimeError("failed to package layers") from ex
+    if seekable:
+        seekable_path = f"{lima_repo_root}/lima-and-qemu.seekable.tar.gz"
+        try:
+            write_seekable_archive(members, duplicates, lima_version, seekable_path, compression_level, compression_workers)
+        except Exception as ex:
+            raise RuntimeError("failed to package the seekable archive") from ex
+    return archive_path, archive_digest
 
-    if not os.path.isabs(dep):
-        raise RuntimeError(f"{dep} is not an absolute path")
-    
-    dep = dep[1:]
-    filename = ""
-    dep_segments = dep.split("/")
-    while dep_segments:
-        segment = dep_segments.pop(0).strip()
-        name = f"{filename}/{segment}"
-        link = None
-        if os.path.islink(name):
-            try:
-                link = os.readlink(name)
-            except Exception as ex:
-                raise RuntimeError(f"{name} is a link but failed to indirect it") from ex
-        
-        # symlinks in the bin directory are replaced by the target, and the symlinks are not
-        # recorded (see above). However, at least "share/qemu" needs to remain a symlink to
-        # "../Cellar/qemu/6.0.0/share/qemu" so qemu will still find its data files. Therefore
-        # symlinks are still recorded for all other files.
-        if link and not name.startswith(f"{install_dir}/bin"):
-            # Record the symlink itself with the link target as the comment
-            deps[name] = f"→ {link}"
-            if os.path.isabs(link):
-                # Can't support absolute links pointing outside /usr/local
-                if not link.startswith(install_dir):
-                    raise RuntimeError(f"{link} is not in {install_dir}")
-                link = '/'.join([link] + dep_segments)
+# With normalize, everything but the content, mode and type of the members is left out, so the same
+# files always result in the same bytes
+def _add_members(tar: tarfile.TarFile, members: List[Tuple[str, str]], duplicates: Dict[str, str], normalize: bool = False):
+    for path, arcname in members:
+        tarinfo = tar.gettarinfo(path, arcname)
+        if normalize:
+            tarinfo.mtime = 0
+            tarinfo.uid = tarinfo.gid = 0
+            tarinfo.uname = tarinfo.gname = ""
+        if arcname in duplicates:
+            print(f"adding {path} to archive as a hardlink to {duplicates[arcname]}")
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = duplicates[arcname]
+            tarinfo.size = 0
+            tar.addfile(tarinfo)
+        elif tarinfo.isreg():
+            print(f"adding {path} to archive")
+            with open(path, "rb") as f:
+                tar.addfile(tarinfo, f)
+        else:
+            print(f"adding {path} to archive")
+            tar.addfile(tarinfo)
+
+LAYERS_MANIFEST = "lima-and-qemu.layers.json"
+
+# The layer of an archive member: qemu's data files rarely change, Homebrew dylibs change with their
+# formula, and the binaries, lima's files and socket_vmnet change with almost every release
+def _layer_name(dist_path: str, arcname: str) -> str:
+    parts = arcname.split("/")
+    if arcname == "share/qemu" or (parts[:2] == ["Cellar", "qemu"] and parts[3:4] == ["share"]):
+        return "share-qemu"
+    if parts[0] == "Cellar" and len(parts) > 2 and parts[3:4] != ["bin"]:
+        return f"brew-{parts[1]}"
+    if parts[0] == "opt" and len(parts) == 2 and os.path.islink(f"{dist_path}/{arcname}"):
+        target = os.readlink(f"{dist_path}/{arcname}").split("/")
+        if target[:2] == ["..", "Cellar"] and len(target) > 2:
+            return f"brew-{target[2]}"
+    return "binaries"
+
+# Splits the archive into layers that are each extracted on top of the same directory. A layer is
+# named after the SHA-256 of its compressed bytes, which only change with its files, so a release
+# that only changes lima reuses the layers of qemu and the Homebrew dylibs. The manifest lists the
+# digest and size of every layer.
+def write_layers(
+    members: List[Tuple[str, str]],
+    dist_path: str,
+    lima_version: str,
+    layer_dir: str,
+    compression_level: int,
+    compression_block_size: int,
+    compression_workers: int,
+    dedup: bool,
+) -> str:
+    layers: Dict[str, List[Tuple[str, str]]] = defaultdict(list)
+    for path, arcname in members:
+        layers[_layer_name(dist_path, arcname)].append((path, arcname))
+    # LIMA_VERSION is added to the binaries
+    layers.setdefault("binaries", [])
+
+    os.makedirs(layer_dir, exist_ok=True)
+    manifest = {"lima_version": lima_version, "layers": []}
+    for name in sorted(layers):
+        tmp_path = f"{layer_dir}/{name}.tmp"
+        with open(tmp_path, "wb") as f:
+            out = DigestWriter(f, "sha256")
+            gz = ParallelGzipWriter(out, compression_level, compression_block_size, compression_workers, mtime=0)
+            uncompressed = DigestWriter(gz, "sha256")
+            with gz, tarfile.open(fileobj=uncompressed, mode="w|") as tar:
+                # hardlinks can only point at a file of the same layer
+                _add_members(tar, layers[name], _duplicate_files(layers[name]) if dedup else {}, normalize=True)
+                if name == "binaries":
+                    lima_version_info = tarfile.TarInfo("LIMA_VERSION")
+                    lima_version_info.size = len(lima_version.encode())
+                    lima_version_info.mode = 0o644
+                    tar.addfile(lima_version_info, io.BytesIO(lima_version.encode()))
+        digest = out.hash.hexdigest()
+        os.replace(tmp_path, f"{layer_dir}/{digest}.tar.gz")
+        manifest["layers"].append({
+            "name": name,
+            "file": f"{digest}.tar.gz",
+            "digest": f"sha256:{digest}",
+            "size": out.bytes_written,
+            "uncompressed_digest": f"sha256:{uncompressed.hash.hexdigest()}",
+            "uncompressed_size": uncompressed.bytes_written,
+        })
+        print(f"Wrote layer {name} to {layer_dir}/{digest}.tar.gz ({format_size(out.bytes_written)})")
+
+    # layers of earlier builds are left behind otherwise
+    current = {layer["file"] for layer in manifest["layers"]}
+    for file in os.listdir(layer_dir):
+        if file.endswith(".tar.gz") and file not in current:
+            os.unlink(f"{layer_dir}/{file}")
+
+    manifest_path = f"{layer_dir}/{LAYERS_MANIFEST}"
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Wrote {manifest_path} ({len(manifest['layers'])} layers)")
+    return manifest_path
+
+SEEKABLE_TOC = "lima-and-qemu.toc.json"
+# an empty gzip member whose extra field holds the offset of the TOC as 16 hex digits
+SEEKABLE_FOOTER_SIZE = 42
+
+# Writes the archive as one gzip member per tar member, which gzip and tar read like any other
+# multi-member gzip file. The last tar member is a TOC with the offset and compressed size of the
+# gzip member of every other one, and the archive ends with a footer pointing at the TOC, so a reader
+# can get at any member by reading the footer, the TOC and that member's gzip member, see
+# SeekableArchive. Members are compressed on a thread pool since they don't depend on each other.
+def write_seekable_archive(
+    members: List[Tuple[str, str]],
+    duplicates: Dict[str, str],
+    lima_version: str,
+    archive_path: str,
+    compression_level: int,
+    compression_workers: int,
+):
+    toc = []
+    offset = 0
+    # headers is only used for gettarinfo
+    with open(f"{archive_path}.tmp", "wb") as f, ThreadPoolExecutor(max_workers=compression_workers) as executor, tarfile.open(fileobj=io.BytesIO(), mode="w") as headers:
+        def write_chunk(tarinfo: tarfile.TarInfo, chunk: Tuple[bytes, int, Optional[str]]):
+            nonlocal offset
+            compressed, header_size, digest = chunk
+            f.write(compressed)
+            entry = {
+                "name": tarinfo.name,
+                "type": "reg" if tarinfo.isreg() else "dir" if tarinfo.isdir() else "symlink" if tarinfo.issym() else "hardlink" if tarinfo.islnk() else "other",
+                "mode": tarinfo.mode,
+                "size": tarinfo.size,
+                "offset": offset,
+                "compressed_size": len(compressed),
+                "header_size": header_size,
+            }
+            if tarinfo.linkname:
+                entry["linkname"] = tarinfo.linkname
+            if digest is not None:
+                entry["digest"] = f"sha256:{digest}"
+            toc.append(entry)
+            offset += len(compressed)
+
+        pending = deque()
+        def submit(tarinfo: tarfile.TarInfo, path: Optional[str], data: Optional[bytes] = None):
+            pending.append((tarinfo, executor.submit(_seekable_chunk, tarinfo, path, data, compression_level)))
+            while len(pending) > compression_workers * 2:
+                write_chunk(pending[0][0], pending.popleft()[1].result())
+
+        for path, arcname in members:
+            tarinfo = headers.gettarinfo(path, arcname)
+            if arcname in duplicates:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = duplicates[arcname]
+                tarinfo.size = 0
+            submit(tarinfo, path if tarinfo.isreg() else None)
+        lima_version_info = tarfile.TarInfo("LIMA_VERSION")
+        lima_version_info.size = len(lima_version.encode())
+        lima_version_info.mtime = int(time.time())
+        lima_version_info.mode = 0o644
+        submit(lima_version_info, None, lima_version.encode())
+        while pending:
+            write_chunk(pending[0][0], pending.popleft()[1].result())
+
+        toc_offset = offset
+        toc_data = json.dumps({"entries": toc}, indent=1).encode()
+        toc_info = tarfile.TarInfo(SEEKABLE_TOC)
+        toc_info.size = len(toc_data)
+        toc_info.mtime = int(time.time())
+        toc_info.mode = 0o644
+        f.write(_seekable_chunk(toc_info, None, toc_data, compression_level)[0])
+        # the end of the tar archive
+        f.write(_gzip_member(b"\0" * tarfile.RECORDSIZE, compression_level))
+        footer = f"{toc_offset:016x}".encode()
+        f.write(b"\x1f\x8b\x08\x04" + bytes(4) + b"\x00\xff" + struct.pack("<HBBH", 4 + len(footer), ord("L"), ord("Q"), len(footer)) + footer + b"\x03\x00" + bytes(8))
+    os.replace(f"{archive_path}.tmp", archive_path)
+    print(f"Wrote {archive_path} ({format_size(os.path.getsize(archive_path))}, {len(toc)} members)")
+
+# Returns a tar member as a gzip member, the size of its tar header and the SHA-256 of its content.
+# The content of path is compressed as it is read, so only its compressed form is held in memory.
+def _seekable_chunk(tarinfo: tarfile.TarInfo, path: Optional[str], data: Optional[bytes], level: int) -> Tuple[bytes, int, Optional[str]]:
+    header = tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, "surrogateescape")
+    if path is None and data is None:
+        return _gzip_member(header, level), len(header), None
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = [compressor.compress(header)]
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") if path is not None else io.BytesIO(data) as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            compressed.append(compressor.compress(block))
+            digest.update(block)
+            size += len(block)
+    if size != tarinfo.size:
+        raise RuntimeError(f"{path} changed size from {tarinfo.size} to {size} bytes while it was packaged")
+    compressed.append(compressor.compress(b"\0" * (-size % tarfile.BLOCKSIZE)))
+    compressed.append(compressor.flush())
+    return b"".join(compressed), len(header), digest.hexdigest()
+
+def _gzip_member(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+# Reads single members of an archive written by write_seekable_archive without decompressing the rest
+class SeekableArchive:
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+
+        with open(path, "rb") as f:
+            f.seek(-SEEKABLE_FOOTER_SIZE, os.SEEK_END)
+            footer = f.read(SEEKABLE_FOOTER_SIZE)
+            if footer[:4] != b"\x1f\x8b\x08\x04" or footer[12:14] != b"LQ":
+                raise RuntimeError(f"{path} has no seekable archive footer")
+            toc_offset = int(footer[16:32], 16)
+            f.seek(toc_offset)
+            compressed = f.read()
+        raw = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(compressed)
+        toc_info = tarfile.TarInfo.frombuf(raw[:tarfile.BLOCKSIZE], tarfile.ENCODING, "surrogateescape")
+        if toc_info.name != SEEKABLE_TOC:
+            raise RuntimeError(f"{path} has no TOC at offset {toc_offset}")
+        toc = json.loads(raw[tarfile.BLOCKSIZE:tarfile.BLOCKSIZE + toc_info.size])
+        for entry in toc["entries"]:
+            self.entries[entry["name"]] = entry
+
+    def read(self, name: str) -> bytes:
+        entry = self.entries[name]
+        if entry["type"] != "reg":
+            raise RuntimeError(f"{name} in {self.path} is not a regular file")
+        with open(self.path, "rb") as f:
+            f.seek(entry["offset"])
+            compressed = f.read(entry["compressed_size"])
+        raw = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(compressed)
+        data = raw[entry["header_size"]:entry["header_size"] + entry["size"]]
+        if f"sha256:{hashlib.sha256(data).hexdigest()}" != entry["digest"]:
+            raise RuntimeError(f"{name} in {self.path} doesn't match its digest")
+        return data
+
+# Lists the (path, arcname) of every archive member the way "tar.add" would recurse into directories,
+# skipping arcnames that were already added, e.g. a file that is also a dep of its own
+def _archive_members(dist_path: str, tar_files: List[str]) -> List[Tuple[str, str]]:
+    members: List[Tuple[str, str]] = []
+    added: Set[str] = set()
+
+    def add(arcname: str):
+        if arcname in added: return
+        added.add(arcname)
+        path = f"{dist_path}/{arcname}"
+        members.append((path, arcname))
+        if os.path.isdir(path) and not os.path.islink(path):
+            for name in sorted(os.listdir(path)):
+                add(f"{arcname}/{name}")
+
+    for file in tar_files:
+        add(file)
+    return members
+
+# Maps the arcname of every regular file whose content and mode equal those of a file earlier in the
+# archive to the arcname of that first copy, e.g. the copies of a qemu binary in bin and in its keg.
+# Only files that share their size with another one are hashed.
+def _duplicate_files(members: List[Tuple[str, str]]) -> Dict[str, str]:
+    by_size: Dict[Tuple[int, int], List[Tuple[str, str]]] = defaultdict(list)
+    for path, arcname in members:
+        st = os.lstat(path)
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            by_size[(st.st_size, stat.S_IMODE(st.st_mode))].append((path, arcname))
+
+    duplicates: Dict[str, str] = {}
+    for candidates in by_size.values():
+        if len(candidates) < 2: continue
+        first_copies: Dict[str, str] = {}
+        for path, arcname in candidates:
+            digest = _file_digest(path)
+            if digest in first_copies:
+                duplicates[arcname] = first_copies[digest]
             else:
-                link = '/'.join([filename, link] + dep_segments)
+                first_copies[digest] = arcname
+    return duplicates
 
-            # Re-parse from the start because the link may contain ".." segments
-            record_dep(link, deps, install_dir)
-            return
-        
-        if segment == "..":
-            filename = os.path.dirname(filename)
+def size_baseline_file_name(arch: Literal[Arch.X86_64, Arch.AARCH64]) -> str:
+    return verification_file_name(arch).replace("deps-verification-", "deps-size-baseline-").replace(".txt", ".json")
+
+class SizeThresholds(NamedTuple):
+    # percentages of growth over the baseline
+    package_warn: float
+    package_fail: float
+    total_warn: float
+    total_fail: float
+    # bytes of growth that are never reported
+    min_change: int
+
+# The package the file at arcname in the dist tree comes from: the Cellar formula it resolves to in
+# install_dir, e.g. "qemu" for bin/qemu-img and share/qemu, or else its top-level directory
+def _size_package(install_dir: str, arcname: str) -> str:
+    if arcname.startswith("socket_vmnet/"):
+        return "socket_vmnet"
+    real_path = os.path.realpath(f"{install_dir}/{arcname}")
+    parts = real_path.removeprefix(f"{os.path.realpath(install_dir)}/").split("/")
+    if parts[0] == "Cellar" and len(parts) > 1:
+        return parts[1]
+    return arcname.split("/")[0]
+
+# Sums the exact sizes of the files of every package in the dist tree, as stored in the archive, and
+# compresses them on their own to get the compressed size of every package. One package makes up most
+# of the bundle, so the packages are compressed one after the other, each on all compression workers.
+def package_sizes(
+    deps: Dict[str, DepEntry],
+    install_dir: str,
+    dist_path: str,
+    compression_level: int = 9,
+    compression_workers: int = os.cpu_count() or 1,
+    dedup: bool = True,
+) -> Dict[str, dict]:
+    tar_files = [path.removeprefix(f"{install_dir}/") for path in deps.keys()]
+    if os.path.isfile(f"{dist_path}/socket_vmnet/bin/socket_vmnet"):
+        tar_files.append("socket_vmnet/bin/socket_vmnet")
+    members = _archive_members(dist_path, tar_files)
+    # hardlinks don't add to the size of the archive, see _duplicate_files
+    duplicates = _duplicate_files(members) if dedup else {}
+
+    files: Dict[str, List[str]] = defaultdict(list)
+    for path, arcname in members:
+        package = _size_package(install_dir, arcname)
+        # packages that only contribute links are listed as well
+        files.setdefault(package, [])
+        if arcname not in duplicates and stat.S_ISREG(os.lstat(path).st_mode):
+            files[package].append(path)
+
+    sizes = {}
+    for package in sorted(files):
+        size = 0
+        compressed = ByteCounter()
+        with ParallelGzipWriter(compressed, compression_level, workers=compression_workers, mtime=0) as gz:
+            for path in files[package]:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        size += len(chunk)
+                        gz.write(chunk)
+        sizes[package] = {"size": size, "compressed_size": compressed.bytes_written, "files": len(files[package])}
+    return sizes
+
+# Compares the package sizes to the baseline next to the verification file, writing the current sizes
+# to a generated file for the workflow to pick up, like verify_dependencies does, and the comparison
+# to deps-size-diff-<arch>.json. Fails if a package or the total grew by more than the fail threshold;
+# a missing baseline is only a warning.
+def check_package_sizes(
+    deps: Dict[str, DepEntry],
+    arch: Literal[Arch.X86_64, Arch.AARCH64],
+    install_dir: str,
+    dist_path: str,
+    thresholds: SizeThresholds,
+    compression_level: int = 9,
+    compression_workers: int = os.cpu_count() or 1,
+    dedup: bool = True,
+):
+    packages = package_sizes(deps, install_dir, dist_path, compression_level, compression_workers, dedup)
+    total = {key: sum(sizes[key] for sizes in packages.values()) for key in ["size", "compressed_size", "files"]}
+    current = {"total": total, "packages": packages}
+
+    baseline_file = size_baseline_file_name(arch)
+    generated_file = baseline_file.replace(".json", ".generated.json")
+    with open(os.path.join(os.getcwd(), generated_file), "w") as f:
+        json.dump(current, f, indent=2)
+        f.write("\n")
+    print(f"Wrote the sizes of {len(packages)} packages to {generated_file}: {format_size(total['size'])}, {format_size(total['compressed_size'])} compressed")
+
+    baseline_path = os.path.join(os.getcwd(), baseline_file)
+    if not os.path.isfile(baseline_path):
+        print(f"WARNING: size baseline {baseline_file} not found, package sizes are not checked")
+        return
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def compare(before: Optional[dict], after: Optional[dict], warn: float, fail: float) -> dict:
+        before_size = before["compressed_size"] if before else 0
+        after_size = after["compressed_size"] if after else 0
+        growth = after_size - before_size
+        percent = growth * 100 / before_size if before_size else (0.0 if not after_size else float("inf"))
+        status = "ok"
+        if growth > thresholds.min_change:
+            status = "fail" if percent > fail else "warn" if percent > warn else "ok"
+        return {
+            "size": [before["size"] if before else None, after["size"] if after else None],
+            "compressed_size": [before["compressed_size"] if before else None, after["compressed_size"] if after else None],
+            "growth": growth,
+            "growth_percent": round(percent, 2) if percent != float("inf") else None,
+            "status": status,
+        }
+
+    diff = {"baseline": baseline_file, "packages": {}}
+    for package in sorted(set(baseline["packages"]) | set(packages)):
+        diff["packages"][package] = compare(baseline["packages"].get(package), packages.get(package), thresholds.package_warn, thresholds.package_fail)
+    diff["total"] = compare(baseline["total"], total, thresholds.total_warn, thresholds.total_fail)
+    statuses = [result["status"] for result in diff["packages"].values()] + [diff["total"]["status"]]
+    diff["status"] = "fail" if "fail" in statuses else "warn" if "warn" in statuses else "ok"
+
+    diff_file = baseline_file.replace("deps-size-baseline-", "deps-size-diff-")
+    with open(os.path.join(os.getcwd(), diff_file), "w") as f:
+        json.dump(diff, f, indent=2)
+        f.write("\n")
+    print(f"Wrote the comparison with {baseline_file} to {diff_file}")
+
+    for package, result in list(diff["packages"].items()) + [("total", diff["total"])]:
+        before, after = result["compressed_size"]
+        if before == after: continue
+        change = f"{result['growth_percent']:+.1f}%" if result["growth_percent"] is not None else "new"
+        line = f"  {package}: {format_size(before or 0)} -> {format_size(after or 0)} compressed ({change})"
+        if result["status"] == "fail":
+            print(f"ERROR: {line.strip()}")
+        elif result["status"] == "warn":
+            print(f"WARNING: {line.strip()}")
         else:
-            filename = name
-    
-    try:
-        size = subprocess.check_output(f"ls -lh {filename}", shell=True, text=True).split()[4]
-        deps[filename] = f"[{size}]"
-    except Exception as ex:
-        raise RuntimeError(f"failed to get size of {filename}") from ex
+            print(line)
 
-def parse_fs_usage_log(log_file: str, deps: Dict[str, str], install_dir: str):
+    if diff["status"] == "fail":
+        raise RuntimeError(f"the bundle grew more than allowed over {baseline_file}, see {diff_file}")
+
+# Replays a recorded fs_usage log, e.g. one written with "fs_usage -w -f pathname ... > log"
+def parse_fs_usage_log(log_file: str, arch: Literal[Arch.X86_64, Arch.AARCH64], consumer: TraceConsumer):
     if not os.path.isfile(log_file):
-        print(f"WARNING: fs_usage log file not found: ${log_file}")
+        print(f"WARNING: fs_usage log file not found: {log_file}")
         return
-    
-    fs_usage_deps_count = 0
-    new_deps_count = 0
-    with open(log_file, "r") as f:
-        for line in f:
-            line = line.strip()
-            
-            # Parse fs_usage output format:
-            match = re.search(rf'\s+(open|read)\s+.*?\s+({re.escape(install_dir)}/\S+|\.\./\S+?)(?:\s+\d+\.\d+\s+\S+)?$', line)
-            if not match: continue
-            
-            file_path = match.group(2)
-            # Handle relative paths by removing "../" and prepending install_dir
-            if file_path.startswith(".."):
-                file_path = file_path.removeprefix("../")
-                file_path = f"{install_dir}/{file_path}"
-            
-            # Skip directories starting with /opt/homebrew/Cellar/qemu unless -f
-            if not os.path.isfile(file_path): continue
-            
-            # Count all fs_usage detected dependencies
-            fs_usage_deps_count += 1
-            
-            # Skip if already recorded
-            if file_path in deps: continue
-            
-            # Record this new dependency
-            record_dep(file_path, deps, install_dir)
-            new_deps_count += 1
-
-            # Also find and record any symlinks pointing to this file
-            res = subprocess.check_output(
-                f"find -L {install_dir}/opt -samefile {file_path} 2>/dev/null", 
-                shell=True,
-                text=True,
-            )
-            for link in res.splitlines():
-                link = link.strip()
-                # Skip the file itself
-                if link == file_path: continue
-                # Skip if already recorded
-                if link in deps: continue
-                record_dep(link, deps, install_dir)
-                new_deps_count += 1
-
-    os.unlink(log_file)
-
-def _write_verification_file(verification_path: str, deps: Dict[str, str]):
+
+    with open(log_file, "r", errors="replace") as f:
+        FsUsageTracer(arch, consumer.resolver.install_dir, consumer.feed).consume(f)
+    consumer.report(FsUsageTracer.name)
+
+def _write_verification_file(verification_path: str, deps: Dict[str, DepEntry]):
     with open(verification_path, 'w') as f:
         for path in sorted(deps.keys()):
             f.write(f"{path} {deps[path]}\n")
 
-def verify_dependencies(current_deps: Dict[str, str], arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str):
-    print("=== Dependency Verification ===")
-    
-    # Determine verification file based on architecture
-    verification_file = "deps-verification-x86.txt" if arch == Arch.X86_64 else "deps-verification-arm64.txt"
-    verification_path = os.path.join(os.getcwd(), verification_file)
+def verification_file_name(arch: Literal[Arch.X86_64, Arch.AARCH64]) -> str:
+    return "deps-verification-x86.txt" if arch == Arch.X86_64 else "deps-verification-arm64.txt"
 
-    # Always write the current deps to a generated file for the workflow to pick up
-    generated_file = verification_file.replace(".txt", ".generated.txt")
-    generated_path = os.path.join(os.getcwd(), generated_file)
-    _write_verification_file(generated_path, current_deps)
-    print(f"Wrote current dependencies to {generated_file} ({len(current_deps)} entries)")
-
-    if not os.path.isfile(verification_path):
-        print(f"ERROR: Verification file {verification_path} not found.")
-        print("The verification file should always exist in the repo.")
-        print(f"A generated file has been written to {generated_file} for the workflow to create a PR.")
-        raise RuntimeError(f"Verification file {verification_file} not found!")
-    
-    print(f"Verifying dependencies against {verification_file} (ignoring version mismatches)...")
-    
-    # Load expected dependencies from verification file
+# Reads the expected deps from a verification file, mapping every path to its "[size]" or "→ target" info
+def load_verification_file(verification_path: str) -> Dict[str, str]:
     expected_deps = {}
     with open(verification_path) as f:
         for line in f:
@@ -472,19 +2858,19 @@ def verify_dependencies(current_deps: Dict[str, str], arch: Literal[Arch.X86_64,
             else:
                 # Handle lines that are just paths without additional info
                 expected_deps[line] = ""
-    
-    print(f"Expected dependencies: {len(expected_deps)}")
-    print(f"Current dependencies: {len(current_deps)}")
-    
-    print("--- Expected Dependencies ---")
-    for path in sorted(expected_deps.keys()):
-        print(f"  {path} {expected_deps[path]}")
-    
-    print("--- Current Dependencies ---")
-    for path in sorted(current_deps.keys()):
-        print(f"  {path} {current_deps[path]}")
-    print()
-    
+    return expected_deps
+
+class DepComparison(NamedTuple):
+    missing: List[str]
+    unexpected: List[str]
+    version_mismatches: List[Dict[str, str]]
+
+    @property
+    def matches(self) -> bool:
+        return not self.missing and not self.unexpected
+
+# Compares deps ignoring versions, see normalize_path_for_version_comparison
+def compare_dependencies(current_deps: Dict[str, DepEntry], expected_deps: Dict[str, str], install_dir: str) -> DepComparison:
     # Create version-agnostic lookup for expected dependencies
     expected_normalized = defaultdict(list)
     for path in expected_deps:
@@ -518,6 +2904,46 @@ def verify_dependencies(current_deps: Dict[str, str], arch: Literal[Arch.X86_64,
     for normalized_current in current_normalized:
         if normalized_current not in expected_normalized:
             unexpected_deps.extend(current_normalized[normalized_current])
+
+    return DepComparison(missing_deps, unexpected_deps, version_mismatches)
+
+def verify_dependencies(current_deps: Dict[str, DepEntry], arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str):
+    print("=== Dependency Verification ===")
+    
+    # Determine verification file based on architecture
+    verification_file = verification_file_name(arch)
+    verification_path = os.path.join(os.getcwd(), verification_file)
+
+    # Always write the current deps to a generated file for the workflow to pick up
+    generated_file = verification_file.replace(".txt", ".generated.txt")
+    generated_path = os.path.join(os.getcwd(), generated_file)
+    _write_verification_file(generated_path, current_deps)
+    print(f"Wrote current dependencies to {generated_file} ({len(current_deps)} entries)")
+
+    if not os.path.isfile(verification_path):
+        print(f"ERROR: Verification file {verification_path} not found.")
+        print("The verification file should always exist in the repo.")
+        print(f"A generated file has been written to {generated_file} for the workflow to create a PR.")
+        raise RuntimeError(f"Verification file {verification_file} not found!")
+    
+    print(f"Verifying dependencies against {verification_file} (ignoring version mismatches)...")
+    
+    # Load expected dependencies from verification file
+    expected_deps = load_verification_file(verification_path)
+    
+    print(f"Expected dependencies: {len(expected_deps)}")
+    print(f"Current dependencies: {len(current_deps)}")
+    
+    print("--- Expected Dependencies ---")
+    for path in sorted(expected_deps.keys()):
+        print(f"  {path} {expected_deps[path]}")
+    
+    print("--- Current Dependencies ---")
+    for path in sorted(current_deps.keys()):
+        print(f"  {path} {current_deps[path]}")
+    print()
+    
+    missing_deps, unexpected_deps, version_mismatches = compare_dependencies(current_deps, expected_deps, install_dir)
     
     verification_failed = False
     if missing_deps:
@@ -571,20 +2997,43 @@ def normalize_path_for_version_comparison(path: str, install_dir: str):
     
     return path
 
-def extract_and_export_package_versions(deps: Dict[str, str], arch: Literal[Arch.X86_64, Arch.AARCH64], install_dir: str):
+CELLAR_PACKAGE_PATTERN = re.compile(r'/Cellar/([^/]+)/([^/]+)/')
+# Homebrew appends "_<revision>" to the version of rebuilt formulae, e.g. 9.2.0_1
+HOMEBREW_REVISION_PATTERN = re.compile(r'_\d+$')
+VERSION_PATTERN = re.compile(r'(\d+\.\d+\.\d+[^\s]*)')
+
+def extract_and_export_package_versions(
+    deps: Dict[str, DepEntry],
+    arch: Literal[Arch.X86_64, Arch.AARCH64],
+    install_dir: str,
+    lima_version: Optional[str] = None,
+    qemu_version: Optional[str] = None,
+):
     """
     Extract package versions from dependencies and export to JSON.
     
     This function:
     1. Extracts package names and versions from Cellar paths
-    2. Attempts to get version info from binary files directly
-    3. Exports the mapping to a JSON file
+    2. Takes the versions of lima and qemu binaries in bin from the installed versions
+    3. Reads the version of other binaries from the files, running them with --version
+       in parallel only if that fails
+    4. Exports the mapping to a JSON file
     """
     package_versions = {}
-    
+    # versions of the binaries in bin that are already known
+    known_versions = {}
+    if lima_version:
+        known_versions["limactl"] = lima_version
+    if qemu_version:
+        qemu_version = HOMEBREW_REVISION_PATTERN.sub("", qemu_version)
+        known_versions["qemu-img"] = qemu_version
+        known_versions[f"qemu-system-{arch}"] = qemu_version
+
+    bin_dir = f"{install_dir}/bin/"
+    unknown_binaries = []
     for file_path in deps.keys():
         # Extract package info from Cellar path: /opt/homebrew/Cellar/package/version/...
-        cellar_match = re.search(r'/Cellar/([^/]+)/([^/]+)/', file_path)
+        cellar_match = CELLAR_PACKAGE_PATTERN.search(file_path)
         if cellar_match:
             package, version = cellar_match.groups()
             package_versions[package] = {
@@ -592,27 +3041,27 @@ def extract_and_export_package_versions(deps: Dict[str, str], arch: Literal[Arch
                 "version": version
             }
         # Handle direct bin files (like limactl) that might not be in Cellar
-        elif re.match(rf'^{re.escape(install_dir)}/bin/([^/]+)$', file_path):
+        elif file_path.startswith(bin_dir) and "/" not in file_path.removeprefix(bin_dir):
             binary_name = os.path.basename(file_path)
-            # Try to get version from the binary itself
-            try:
-                result = subprocess.run(
-                    [file_path, '--version'],
-                    capture_output=True,
-                    text=True,
-                    stderr=subprocess.DEVNULL,
-                    timeout=5
-                )
-                # Extract version pattern like 1.2.3 or 1.2.3-alpha
-                version_match = re.search(r'(\d+\.\d+\.\d+[^\s]*)', result.stdout)
-                if version_match:
+            version = known_versions.get(binary_name) or _embedded_version(file_path)
+            if version:
+                package_versions[binary_name] = {
+                    "package": binary_name,
+                    "version": version
+                }
+            else:
+                unknown_binaries.append(file_path)
+
+    # Get the remaining versions from the binaries themselves, all at once
+    if unknown_binaries:
+        with ThreadPoolExecutor(max_workers=len(unknown_binaries)) as executor:
+            for file_path, version in zip(unknown_binaries, executor.map(_version_from_output, unknown_binaries)):
+                if version:
+                    binary_name = os.path.basename(file_path)
                     package_versions[binary_name] = {
                         "package": binary_name,
-                        "version": version_match.group(1)
+                        "version": version
                     }
-            except Exception:
-                # Skip if version extraction fails
-                pass
     
     # Export to JSON
     lima_repo_root = os.path.join(os.getcwd(), 'src', 'lima')
@@ -625,8 +3074,53 @@ def extract_and_export_package_versions(deps: Dict[str, str], arch: Literal[Arch
     except Exception as ex:
         raise RuntimeError(f"failed to write JSON file {json_file}") from ex
 
-def cleanup():
+# Reads the version of a Mach-O binary from its LC_SOURCE_VERSION, or from a "<name> version X.Y.Z"
+# string embedded in it. The file is mmap-ed, so it is only read as far as the scan gets.
+def _embedded_version(path: str) -> Optional[str]:
+    try:
+        slices = read_macho(path)
+    except Exception:
+        return None
+    if not slices: return None
+
+    for image in slices:
+        if image.source_version:
+            v = image.source_version
+            parts = [v >> 40, (v >> 30) & 0x3ff, (v >> 20) & 0x3ff, (v >> 10) & 0x3ff, v & 0x3ff]
+            while len(parts) > 3 and parts[-1] == 0:
+                parts.pop()
+            return ".".join(str(part) for part in parts)
+
+    name = re.escape(os.path.basename(path).encode())
+    pattern = re.compile(rb'\b' + name + rb' version (\d+\.\d+\.\d+[\w.+-]*)')
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            match = pattern.search(m)
+            # the match refers to the mapping, so it has to be read before it is closed
+            return match.group(1).decode() if match else None
+    except (OSError, ValueError):
+        return None
+
+def _version_from_output(path: str) -> Optional[str]:
+    try:
+        result = run_process(
+            [path, '--version'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=5
+        )
+    except Exception:
+        # Skip if version extraction fails
+        return None
+    # Extract version pattern like 1.2.3 or 1.2.3-alpha
+    version_match = VERSION_PATTERN.search(result.stdout)
+    return version_match.group(1) if version_match else None
+
+def cleanup(tracer: Optional[Tracer]):
     # no need to check for failures here
-    subprocess.run("sudo pkill fs_usage", shell=True)
+    if tracer is not None:
+        tracer.cleanup()
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# The scripts in bin are not a package and have dashes in their names, so the tests load them by path.
+# Every test gets its own cache directories instead of the ones in the user's home.
+import importlib.util
+import os
+
+import pytest
+
+BIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_script(name: str, file_name: str):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(BIN_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope="session")
+def lq():
+    return load_script("lima_and_qemu", "lima-and-qemu.py")
+
+@pytest.fixture(scope="session")
+def fetch_deps():
+    return load_script("fetch_deps", "fetch-deps.py")
+
+@pytest.fixture(autouse=True)
+def cache_dirs(request, tmp_path, monkeypatch):
+    if "lq" in request.fixturenames:
+        lq = request.getfixturevalue("lq")
+        monkeypatch.setattr(lq, "CACHE_DIR", str(tmp_path / "lima-and-qemu-cache"))
+        monkeypatch.setattr(lq, "SIGNED_CACHE_DIR", str(tmp_path / "lima-and-qemu-cache" / "signed"))
+    if "fetch_deps" in request.fixturenames:
+        monkeypatch.setattr(request.getfixturevalue("fetch_deps"), "CACHE_DIR", str(tmp_path / "artifacts"))
+
+# Returns a function that puts an executable script with the given name and content first on PATH
+@pytest.fixture
+def stand_in(tmp_path, monkeypatch):
+    stand_in_dir = tmp_path / "stand-ins"
+    stand_in_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{stand_in_dir}:{os.environ['PATH']}")
+
+    def install(name: str, script: str) -> str:
+        path = stand_in_dir / name
+        path.write_text(script)
+        path.chmod(0o755)
+        return str(path)
+    return install
@@ -0,0 +1,57 @@
+# Builders of the synthetic inputs fed to lima-and-qemu.py by the tests
+import struct
+from typing import List, Tuple
+
+CPU_TYPE_X86_64 = 0x01000007
+CPU_TYPE_ARM64 = 0x0100000c
+
+# A line like "fs_usage -w -f filesys" prints, n is used for a timestamp that grows with it
+def fs_usage_line(n: int, syscall: str, path: str, process: str) -> str:
+    return f"12:{n // 60_000_000 % 60:02d}:{n // 1_000_000 % 60:02d}.{n % 1_000_000:06d}  {syscall:<17} F=5        (R_____)  {path:<80} 0.000012   {process}\n"
+
+# A 64-bit Mach-O image with one __TEXT segment and the given install names, dependent dylibs, rpaths
+# and packed LC_SOURCE_VERSION. The load commands are followed by enough padding for relinking to
+# rewrite them in place.
+def macho_image(install_names: List[str], dylibs: List[str], payload: bytes, rpaths: Tuple[str, ...] = (), source_version: int = 0) -> bytes:
+    commands = [dylib_command(0xd, name) for name in install_names] + [dylib_command(0xc, name) for name in dylibs]
+    commands += [rpath_command(path) for path in rpaths]
+    if source_version:
+        commands.append(struct.pack("<IIQ", 0x2a, 16, source_version))
+    text_offset = (32 + 152 + sum(len(command) for command in commands)) * 2 + 0x1000
+    size = text_offset + len(payload)
+    section = struct.pack("<16s16sQQIIIIIIII", b"__text", b"__TEXT", 0, len(payload), text_offset, 0, 0, 0, 0, 0, 0, 0)
+    segment = struct.pack("<II16sQQQQiiII", 0x19, 72 + len(section), b"__TEXT", 0, size, 0, size, 5, 5, 1, 0) + section
+    body = segment + b"".join(commands)
+    header = struct.pack("<IiiIIIII", 0xfeedfacf, CPU_TYPE_ARM64, 0, 6, 1 + len(commands), len(body), 0, 0)
+    image = header + body
+    return image + b"\0" * (text_offset - len(image)) + payload
+
+def dylib_command(cmd: int, name: str) -> bytes:
+    raw = name.encode() + b"\0"
+    size = (24 + len(raw) + 7) // 8 * 8
+    return struct.pack("<IIIIII", cmd, size, 24, 2, 0x10000, 0x10000) + raw + b"\0" * (size - 24 - len(raw))
+
+def rpath_command(path: str) -> bytes:
+    raw = path.encode() + b"\0"
+    size = (12 + len(raw) + 7) // 8 * 8
+    return struct.pack("<III", 0x8000001c, size, 12) + raw + b"\0" * (size - 12 - len(raw))
+
+# A fat binary of images, each aligned to a 16 KiB page like lipo does. Returns it and the offsets of the images.
+def fat_macho(images: List[bytes], cputypes: List[int], align: int = 0x4000) -> Tuple[bytes, List[int]]:
+    header = struct.pack(">II", 0xcafebabe, len(images))
+    offsets = []
+    offset = align
+    for image in images:
+        offsets.append(offset)
+        offset += -(-len(image) // align) * align
+    for image, cputype, offset in zip(images, cputypes, offsets):
+        header += struct.pack(">iiIII", cputype, 0, offset, len(image), 14)
+    data = bytearray(header)
+    for image, offset in zip(images, offsets):
+        data += b"\0" * (offset - len(data)) + image
+    return bytes(data), offsets
+
+def with_cputype(image: bytes, cputype: int) -> bytes:
+    image = bytearray(image)
+    struct.pack_into("<i", image, 4, cputype)
+    return bytes(image)
@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+STAGE_FUNCTIONS = {stage: f"{stage.replace('-', '_')}_stage" for stage in ["trace", "prune", "verify", "copy", "sign", "version-map", "package", "size"]}
+
+# A build with every stage replaced by one that records it was run. The trace stage records a single
+# file as the deps, and the stages in fail raise like a failing codesign would.
+@pytest.fixture
+def build(lq, tmp_path, monkeypatch):
+    install_dir = tmp_path / "homebrew"
+    (install_dir / "lib").mkdir(parents=True)
+    (install_dir / "lib" / "libglib-2.0.0.dylib").write_text("glib")
+    versions = {"qemu": "9.0.2_1", "lima": "1.0.1"}
+    monkeypatch.setattr(lq, "get_system_arch", lambda: lq.Arch.AARCH64)
+    monkeypatch.setattr(lq, "get_installation_dir", lambda arch: str(install_dir))
+    monkeypatch.setattr(lq, "get_installed_qemu_version", lambda: versions["qemu"])
+    monkeypatch.setattr(lq, "get_installed_lima_version", lambda: versions["lima"])
+    monkeypatch.setattr(lq, "PROFILER", lq.BuildProfiler())
+    (tmp_path / "src" / "lima").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+
+    class Syncer:
+        def __init__(self, arch, install_dir, copy_workers):
+            pass
+        def start(self):
+            pass
+        def abort(self):
+            pass
+    monkeypatch.setattr(lq, "DistSyncer", Syncer)
+
+    runs = []
+    fail = set()
+    def stub(stage):
+        def run(args, state, syncer=None):
+            runs.append(stage)
+            if stage in fail:
+                raise RuntimeError(f"{stage} failed")
+            if stage == "trace":
+                resolver = lq.DepResolver(str(install_dir))
+                resolver.record(f"{install_dir}/lib/libglib-2.0.0.dylib")
+                state.deps = resolver.deps
+            # every stage has to see what the earlier ones produced, also after resuming
+            assert f"{install_dir}/lib/libglib-2.0.0.dylib" in state.deps
+        return run
+    for stage, name in STAGE_FUNCTIONS.items():
+        monkeypatch.setattr(lq, name, stub(stage))
+
+    def run_build(*argv):
+        runs.clear()
+        lq.build(lq.parse_args(["--checkpoint-dir", str(tmp_path / "checkpoint"), *argv]))
+        return list(runs)
+    run_build.install_dir = install_dir
+    run_build.versions = versions
+    run_build.fail = fail
+    return run_build
+
+def saved_stages(lq, tmp_path):
+    return lq.BuildState.load(str(tmp_path / "checkpoint")).completed
+
+def test_stage_functions(lq):
+    assert list(STAGE_FUNCTIONS) == lq.STAGES
+
+def test_resume_after_failure(lq, build, tmp_path, capsys):
+    build.fail.add("sign")
+    with pytest.raises(RuntimeError, match="sign failed"):
+        build()
+    assert saved_stages(lq, tmp_path) == ["trace", "prune", "verify", "copy"]
+
+    build.fail.clear()
+    assert build("--resume") == ["sign", "version-map", "package", "size"]
+    assert "from stage sign" in capsys.readouterr().out
+    assert saved_stages(lq, tmp_path) == lq.STAGES
+
+    assert build("--resume") == []
+    assert "are complete" in capsys.readouterr().out
+
+@pytest.mark.parametrize("stage", ["trace", "copy", "package", "size"])
+def test_from_stage(lq, build, tmp_path, stage):
+    assert build() == lq.STAGES
+    assert build("--from-stage", stage) == lq.STAGES[lq.STAGES.index(stage):]
+    assert saved_stages(lq, tmp_path) == lq.STAGES
+
+def test_from_stage_after_incomplete_stage(lq, build):
+    build.fail.add("sign")
+    with pytest.raises(RuntimeError, match="sign failed"):
+        build()
+
+    build.fail.clear()
+    with pytest.raises(RuntimeError, match="can't start from stage package, sign, version-map didn't complete"):
+        build("--from-stage", "package")
+    # stages up to the one that failed can be run again
+    assert build("--from-stage", "copy") == lq.STAGES[lq.STAGES.index("copy"):]
+
+def test_resume_without_state(build, tmp_path):
+    with pytest.raises(RuntimeError, match=f"there is no build state to resume from in {tmp_path}/checkpoint"):
+        build("--resume")
+
+def test_resume_with_other_inputs(build):
+    build.fail.add("package")
+    with pytest.raises(RuntimeError):
+        build()
+
+    # like "brew upgrade qemu" between the failed build and the resumed one
+    build.fail.clear()
+    build.versions["qemu"] = "9.1.0"
+    with pytest.raises(RuntimeError, match="the build state in .* is for .*9.0.2_1.*, not .*9.1.0"):
+        build("--resume")
+    # templates are inputs too
+    build.versions["qemu"] = "9.0.2_1"
+    with pytest.raises(RuntimeError, match="the build state in .* is for"):
+        build("--resume", "default")
+
+def test_resume_with_changed_deps(build):
+    build.fail.add("package")
+    with pytest.raises(RuntimeError):
+        build()
+
+    build.fail.clear()
+    path = build.install_dir / "lib" / "libglib-2.0.0.dylib"
+    path.write_text("glib 2.82.4")
+    with pytest.raises(RuntimeError, match=f"can't resume, {path} changed since the deps were traced"):
+        build("--resume")
+    os.unlink(path)
+    with pytest.raises(RuntimeError, match=f"can't resume, {path} no longer exists"):
+        build("--from-stage", "copy")
@@ -0,0 +1,141 @@
+import errno
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / "libglib-2.0.0.dylib"
+    path.write_bytes(b"glib" * 4096)
+    path.chmod(0o755)
+    return str(path)
+
+# Records which of the copy paths copy_file took, the earlier ones are made to fail by the tests
+@pytest.fixture
+def copy_paths(lq, monkeypatch):
+    calls = []
+    def ioctl(fd, request, arg):
+        calls.append("clone")
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+    copy_file_range = os.copy_file_range
+    def recording_copy_file_range(*args):
+        calls.append("copy_file_range")
+        return copy_file_range(*args)
+    copyfile = shutil.copyfile
+    def recording_copyfile(src, dst):
+        calls.append("copyfile")
+        return copyfile(src, dst)
+    monkeypatch.setattr(lq.fcntl, "ioctl", ioctl)
+    monkeypatch.setattr(lq.os, "copy_file_range", recording_copy_file_range)
+    monkeypatch.setattr(lq.shutil, "copyfile", recording_copyfile)
+    return calls
+
+def assert_copied(src, dst):
+    with open(src, "rb") as f_src, open(dst, "rb") as f_dst:
+        assert f_src.read() == f_dst.read()
+    assert os.stat(dst).st_mode == os.stat(src).st_mode
+
+def test_copy_file_clones(lq, src, tmp_path, copy_paths, monkeypatch):
+    def clone(fd, request, arg):
+        copy_paths.append("clone")
+        assert request == lq.FICLONE
+        os.write(fd, os.read(arg, 1 << 20))
+    monkeypatch.setattr(lq.fcntl, "ioctl", clone)
+
+    stats = lq.CopyStats()
+    lq.copy_file(src, str(tmp_path / "copy"), stats)
+    assert copy_paths == ["clone"]
+    assert_copied(src, tmp_path / "copy")
+    assert [(path, size) for path, size, _ in stats.files] == [(str(tmp_path / "copy"), 4 * 4096)]
+
+def test_copy_file_without_clone(lq, src, tmp_path, copy_paths):
+    lq.copy_file(src, str(tmp_path / "copy"))
+    assert copy_paths[:2] == ["clone", "copy_file_range"]
+    assert "copyfile" not in copy_paths
+    assert_copied(src, tmp_path / "copy")
+
+@pytest.mark.parametrize("error", [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP])
+def test_copy_file_without_copy_file_range(lq, src, tmp_path, copy_paths, monkeypatch, error):
+    def copy_file_range(*args):
+        copy_paths.append("copy_file_range")
+        raise OSError(error, os.strerror(error))
+    monkeypatch.setattr(lq.os, "copy_file_range", copy_file_range)
+
+    lq.copy_file(src, str(tmp_path / "copy"))
+    assert copy_paths == ["clone", "copy_file_range", "copyfile"]
+    assert_copied(src, tmp_path / "copy")
+
+def test_copy_file_errors(lq, src, tmp_path, copy_paths, monkeypatch):
+    def copy_file_range(*args):
+        raise OSError(errno.EIO, "Input/output error")
+    monkeypatch.setattr(lq.os, "copy_file_range", copy_file_range)
+
+    with pytest.raises(RuntimeError, match=f"failed to copy {src} to {tmp_path}/copy"):
+        lq.copy_file(src, str(tmp_path / "copy"))
+    with pytest.raises(RuntimeError, match="failed to copy"):
+        lq.copy_file(str(tmp_path / "missing"), str(tmp_path / "copy"))
+
+# A directory like share/qemu, with links to files and directories in it
+@pytest.fixture
+def tree(tmp_path):
+    tree = tmp_path / "qemu"
+    (tree / "firmware").mkdir(parents=True)
+    (tree / "edk2-aarch64-code.fd").write_bytes(b"edk2")
+    (tree / "firmware" / "60-edk2-aarch64.json").write_text("{}")
+    os.symlink("edk2-aarch64-code.fd", tree / "edk2-arm-code.fd")
+    os.symlink("firmware", tree / "descriptors")
+    os.symlink("../missing.rom", tree / "dangling.rom")
+    return tree
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_copy_tree(lq, tree, tmp_path, workers):
+    stats = lq.CopyStats()
+    executor = ThreadPoolExecutor(workers) if workers else None
+    lq.copy_tree(str(tree), str(tmp_path / "copy"), stats, executor)
+    if executor:
+        executor.shutdown()
+
+    copy = tmp_path / "copy"
+    assert (copy / "edk2-aarch64-code.fd").read_bytes() == b"edk2"
+    assert (copy / "firmware" / "60-edk2-aarch64.json").read_text() == "{}"
+    # symlinks are copied as they are, even if they point at directories or nowhere
+    assert os.readlink(copy / "edk2-arm-code.fd") == "edk2-aarch64-code.fd"
+    assert os.readlink(copy / "descriptors") == "firmware"
+    assert os.readlink(copy / "dangling.rom") == "../missing.rom"
+    assert len(stats.files) == 2
+
+def test_copy_tree_collects_failures(lq, tree, tmp_path, monkeypatch, capsys):
+    (tree / "efi-virtio.rom").write_bytes(b"rom")
+    copy_file = lq.copy_file
+    def failing_copy_file(src, dst, stats=None):
+        if not src.endswith(".json"):
+            raise RuntimeError(f"failed to copy {src} to {dst}")
+        copy_file(src, dst, stats)
+    monkeypatch.setattr(lq, "copy_file", failing_copy_file)
+
+    # every file is tried, and all failures are reported before raising
+    with ThreadPoolExecutor(4) as executor:
+        with pytest.raises(RuntimeError, match=f"failed to copy {tree} to {tmp_path}/copy: 2 errors"):
+            lq.copy_tree(str(tree), str(tmp_path / "copy"), lq.CopyStats(), executor)
+    assert (tmp_path / "copy" / "firmware" / "60-edk2-aarch64.json").exists()
+    out = capsys.readouterr().out
+    assert f"ERROR: failed to copy {tree}/edk2-aarch64-code.fd" in out
+    assert f"ERROR: failed to copy {tree}/efi-virtio.rom" in out
+
+def test_copy_dep(lq, tree, tmp_path):
+    stats = lq.CopyStats()
+    copy = tmp_path / "dist" / "bin" / "edk2-arm-code.fd"
+    lq._copy_dep(str(tree / "edk2-arm-code.fd"), str(copy), False, stats)
+    assert os.readlink(copy) == "edk2-aarch64-code.fd"
+
+    # in bin the link is replaced by a copy of its target, also over an existing copy
+    lq._copy_dep(str(tree / "edk2-arm-code.fd"), str(copy), True, stats)
+    assert not os.path.islink(copy)
+    assert copy.read_bytes() == b"edk2"
+
+    # a directory replaces whatever was copied before
+    lq._copy_dep(str(tree), str(copy), False, stats)
+    assert os.readlink(copy / "descriptors") == "firmware"
+    assert (copy / "edk2-aarch64-code.fd").read_bytes() == b"edk2"
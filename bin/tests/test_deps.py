@@ -0,0 +1,167 @@
+import os
+
+import pytest
+
+LIBSSH = "Cellar/libssh/0.9.5_1"
+QEMU = "Cellar/qemu/9.0.2_1"
+
+# A Homebrew prefix with the link chains the dependencies are usually reached through
+@pytest.fixture
+def install_dir(tmp_path):
+    install_dir = tmp_path / "homebrew"
+    files = {
+        f"{LIBSSH}/lib/libssh.4.8.6.dylib": b"\xcc" * (394 << 10),
+        f"{QEMU}/share/qemu/edk2-aarch64-code.fd": b"\0" * 6800000,
+        f"{QEMU}/bin/qemu-img": b"qemu-img",
+    }
+    links = {
+        f"{LIBSSH}/lib/libssh.4.dylib": "libssh.4.8.6.dylib",
+        "opt/libssh": f"../{LIBSSH}",
+        # an alias of an alias, like opt/<name>@<major>
+        "opt/libssh@0": "libssh",
+        "share/qemu": f"../{QEMU}/share/qemu",
+        # a link with ".." segments in the middle of the resolved path
+        f"{QEMU}/lib/libssh.dylib": "../../../../opt/libssh@0/lib/libssh.4.dylib",
+        "bin/qemu-img": f"../{QEMU}/bin/qemu-img",
+    }
+    for rel_path, data in files.items():
+        (install_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (install_dir / rel_path).write_bytes(data)
+    for rel_path, target in links.items():
+        (install_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        os.symlink(target, install_dir / rel_path)
+    return str(install_dir)
+
+def recorded(resolver, install_dir):
+    return {path.removeprefix(f"{install_dir}/"): str(entry) for path, entry in resolver.deps.items()}
+
+def test_record_follows_link_chains(lq, install_dir):
+    resolver = lq.DepResolver(install_dir)
+    resolver.record(f"{install_dir}/opt/libssh@0/lib/libssh.4.dylib")
+
+    # the format of the verification files
+    assert recorded(resolver, install_dir) == {
+        "opt/libssh@0": "→ libssh",
+        "opt/libssh": f"→ ../{LIBSSH}",
+        f"{LIBSSH}/lib/libssh.4.dylib": "→ libssh.4.8.6.dylib",
+        f"{LIBSSH}/lib/libssh.4.8.6.dylib": "[394K]",
+    }
+    entry = resolver.deps[f"{install_dir}/{LIBSSH}/lib/libssh.4.8.6.dylib"]
+    assert (entry.kind, entry.size, entry.target) == ("file", 394 << 10, None)
+    assert resolver.deps[f"{install_dir}/opt/libssh"].kind == "link"
+
+def test_record_relative_links(lq, install_dir):
+    resolver = lq.DepResolver(install_dir)
+    resolver.record(f"{install_dir}/share/qemu/edk2-aarch64-code.fd")
+    resolver.record(f"{install_dir}/{QEMU}/lib/libssh.dylib")
+
+    assert recorded(resolver, install_dir) == {
+        "share/qemu": f"→ ../{QEMU}/share/qemu",
+        f"{QEMU}/share/qemu/edk2-aarch64-code.fd": "[6.5M]",
+        f"{QEMU}/lib/libssh.dylib": "→ ../../../../opt/libssh@0/lib/libssh.4.dylib",
+        "opt/libssh@0": "→ libssh",
+        "opt/libssh": f"→ ../{LIBSSH}",
+        f"{LIBSSH}/lib/libssh.4.dylib": "→ libssh.4.8.6.dylib",
+        f"{LIBSSH}/lib/libssh.4.8.6.dylib": "[394K]",
+    }
+
+def test_record_bin_links(lq, install_dir):
+    resolver = lq.DepResolver(install_dir)
+    resolver.record(f"{install_dir}/bin/qemu-img")
+
+    # the link is recorded without its target, copy_deps replaces it by a copy of the file
+    entry = resolver.deps[f"{install_dir}/bin/qemu-img"]
+    assert (entry.kind, entry.target) == ("link", None)
+    assert list(resolver.deps) == [f"{install_dir}/bin/qemu-img"]
+
+def test_record_caches_prefixes(lq, install_dir, monkeypatch):
+    lstat_calls = []
+    lstat = os.lstat
+    def counting_lstat(path, *args, **kwargs):
+        lstat_calls.append(path)
+        return lstat(path, *args, **kwargs)
+    monkeypatch.setattr(lq.os, "lstat", counting_lstat)
+    readlink_calls = []
+    readlink = os.readlink
+    def counting_readlink(path, *args, **kwargs):
+        readlink_calls.append(path)
+        return readlink(path, *args, **kwargs)
+    monkeypatch.setattr(lq.os, "readlink", counting_readlink)
+
+    resolver = lq.DepResolver(install_dir)
+    resolver.record(f"{install_dir}/opt/libssh@0/lib/libssh.4.dylib")
+    resolver.record(f"{install_dir}/opt/libssh/lib/libssh.4.8.6.dylib")
+    resolver.record(f"{install_dir}/{QEMU}/lib/libssh.dylib")
+    monkeypatch.undo()
+
+    assert lstat_calls and len(lstat_calls) == len(set(lstat_calls))
+    assert readlink_calls and len(readlink_calls) == len(set(readlink_calls))
+    assert f"{install_dir}/{QEMU}/lib/libssh.dylib" in resolver.deps
+
+def test_on_record(lq, install_dir):
+    resolver = lq.DepResolver(install_dir)
+    seen = []
+    resolver.on_record = seen.append
+
+    resolver.record(f"{install_dir}/opt/libssh@0/lib/libssh.4.dylib")
+    # recording the same path again is a no-op
+    resolver.record(f"{install_dir}/opt/libssh@0/lib/libssh.4.dylib")
+    assert seen == list(resolver.deps)
+    assert len(seen) == 4
+
+    # merged deps are only reported if they are new
+    merged = {
+        f"{install_dir}/opt/libssh": resolver.deps[f"{install_dir}/opt/libssh"],
+        f"{install_dir}/{QEMU}/bin/qemu-img": lq.DepEntry("file", 8, None, 0),
+    }
+    resolver.merge(merged)
+    assert seen[4:] == [f"{install_dir}/{QEMU}/bin/qemu-img"]
+
+def test_record_errors(lq, install_dir, tmp_path):
+    os.symlink(str(tmp_path / "elsewhere"), f"{install_dir}/opt/outside")
+    resolver = lq.DepResolver(install_dir)
+
+    with pytest.raises(RuntimeError, match="is not in"):
+        resolver.record(f"{install_dir}/opt/outside/lib/libfoo.dylib")
+    with pytest.raises(RuntimeError, match="failed to get size of"):
+        resolver.record(f"{install_dir}/opt/libssh/lib/libmissing.dylib")
+    with pytest.raises(RuntimeError, match="is not an absolute path"):
+        resolver.record("opt/libssh/lib/libssh.4.dylib")
+
+def test_opt_inode_index_picks_up_retargeted_links(lq, tmp_path, capsys):
+    install_dir = tmp_path / "homebrew"
+    for keg in ["glib/2.80.0", "glib/2.82.4", "pixman/0.42.2"]:
+        (install_dir / "Cellar" / keg / "lib").mkdir(parents=True)
+        (install_dir / "Cellar" / keg / "lib" / "lib.dylib").write_text(keg)
+    (install_dir / "opt").mkdir()
+    os.symlink("../Cellar/glib/2.80.0", install_dir / "opt" / "glib")
+    os.symlink("../Cellar/pixman/0.42.2", install_dir / "opt" / "pixman")
+    old_glib = str(install_dir / "Cellar" / "glib" / "2.80.0" / "lib" / "lib.dylib")
+    new_glib = str(install_dir / "Cellar" / "glib" / "2.82.4" / "lib" / "lib.dylib")
+    pixman = str(install_dir / "Cellar" / "pixman" / "0.42.2" / "lib" / "lib.dylib")
+
+    index = lq.OptInodeIndex(str(install_dir))
+    index.build()
+    assert "walked 2 of 2 entries" in capsys.readouterr().out
+    assert index.links_to(old_glib) == [f"{install_dir}/opt/glib/lib/lib.dylib"]
+    assert index.links_to(new_glib) == []
+    assert os.path.isfile(index.cache_path)
+
+    # like "brew upgrade glib", which points the opt link at the new keg
+    os.symlink("../Cellar/glib/2.82.4", install_dir / "opt" / "glib.new")
+    os.replace(install_dir / "opt" / "glib.new", install_dir / "opt" / "glib")
+
+    index = lq.OptInodeIndex(str(install_dir))
+    index.build()
+    assert "walked 1 of 2 entries" in capsys.readouterr().out
+    assert index.links_to(new_glib) == [f"{install_dir}/opt/glib/lib/lib.dylib"]
+    assert index.links_to(old_glib) == []
+    # pixman comes from the entry cached by the first run
+    assert index.links_to(pixman) == [f"{install_dir}/opt/pixman/lib/lib.dylib"]
+
+    mtime = os.stat(index.cache_path).st_mtime_ns
+    index = lq.OptInodeIndex(str(install_dir))
+    index.build()
+    assert "walked 0 of 2 entries" in capsys.readouterr().out
+    assert index.links_to(new_glib) == [f"{install_dir}/opt/glib/lib/lib.dylib"]
+    assert os.stat(index.cache_path).st_mtime_ns == mtime
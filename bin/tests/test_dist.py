@@ -0,0 +1,150 @@
+import os
+
+import pytest
+
+from helpers import macho_image
+
+QEMU = "Cellar/qemu/9.0.2_1"
+GLIB = "Cellar/glib/2.82.4"
+GLIB_DYLIB = "opt/glib/lib/libglib-2.0.0.dylib"
+GETTEXT_DYLIB = "opt/gettext/lib/libintl.8.dylib"
+
+@pytest.fixture
+def install_dir(tmp_path):
+    install_dir = tmp_path / "homebrew"
+    files = {
+        f"{QEMU}/bin/qemu-system-aarch64": macho_image([], [f"{install_dir}/{GLIB_DYLIB}", "/usr/lib/libSystem.B.dylib"], b"qemu"),
+        f"{GLIB}/lib/libglib-2.0.0.dylib": macho_image([f"{install_dir}/{GLIB_DYLIB}"], [f"{install_dir}/{GETTEXT_DYLIB}"], b"glib"),
+        f"{QEMU}/share/qemu/edk2-aarch64-code.fd": b"edk2",
+        f"{QEMU}/share/qemu/efi-virtio.rom": b"rom",
+        # a Mach-O in a directory that is a dep itself
+        f"{QEMU}/share/qemu/libexec/qemu-bridge-helper": macho_image([], [f"{install_dir}/{GLIB_DYLIB}"], b"helper"),
+    }
+    for rel_path, data in files.items():
+        (install_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (install_dir / rel_path).write_bytes(data)
+    for link, target in {
+        "bin/qemu-system-aarch64": f"../{QEMU}/bin/qemu-system-aarch64",
+        "opt/glib": f"../{GLIB}",
+        "share/qemu": f"../{QEMU}/share/qemu",
+    }.items():
+        (install_dir / link).parent.mkdir(exist_ok=True)
+        os.symlink(target, install_dir / link)
+    return str(install_dir)
+
+def deps_of(install_dir, *rel_paths):
+    return dict.fromkeys(f"{install_dir}/{rel_path}" for rel_path in rel_paths)
+
+DEPS = ["bin/qemu-system-aarch64", f"{QEMU}/bin/qemu-system-aarch64", "opt/glib", f"{GLIB}/lib/libglib-2.0.0.dylib", "share/qemu", f"{QEMU}/share/qemu"]
+
+def sync(lq, install_dir, dist_path, deps):
+    syncer = lq.DistSyncer(lq.Arch.AARCH64, install_dir, 4, str(dist_path))
+    syncer.start()
+    _, resign_files, manifest = syncer.finish(deps)
+    return syncer, {path.removeprefix(f"{dist_path}/") for path in resign_files}, manifest
+
+def dylibs(lq, path):
+    return [ref.name for image in lq.read_macho(str(path)) for ref in image.dependent_dylibs()]
+
+def test_copy_deps(lq, install_dir, tmp_path):
+    dist_path = tmp_path / "dist"
+    syncer, resign_files, manifest = sync(lq, install_dir, dist_path, deps_of(install_dir, *DEPS))
+
+    # symlinks in bin are replaced by a copy of their target
+    assert not os.path.islink(dist_path / "bin" / "qemu-system-aarch64")
+    assert os.readlink(dist_path / "opt" / "glib") == f"../{GLIB}"
+    assert dylibs(lq, dist_path / "bin" / "qemu-system-aarch64") == [f"@executable_path/../{GLIB_DYLIB}", "/usr/lib/libSystem.B.dylib"]
+    # files copied along with their directory are not relinked, only traced ones are
+    assert dylibs(lq, dist_path / QEMU / "share" / "qemu" / "libexec" / "qemu-bridge-helper") == [f"{install_dir}/{GLIB_DYLIB}"]
+    # everything relinked needs a new signature on aarch64
+    assert resign_files == {"bin/qemu-system-aarch64", f"{QEMU}/bin/qemu-system-aarch64", f"{GLIB}/lib/libglib-2.0.0.dylib"}
+    assert set(manifest.entries) == set(DEPS)
+    assert os.path.isfile(f"{dist_path}.manifest.json")
+    assert syncer.updated_count == len(DEPS)
+
+def test_incremental_rebuild(lq, install_dir, tmp_path, capsys):
+    dist_path = tmp_path / "dist"
+    deps = deps_of(install_dir, *DEPS)
+    sync(lq, install_dir, dist_path, deps)
+
+    # nothing changed, but nothing was signed either, so the signatures are still missing
+    syncer, resign_files, manifest = sync(lq, install_dir, dist_path, deps)
+    assert syncer.updated_count == 0
+    assert resign_files == {"bin/qemu-system-aarch64", f"{QEMU}/bin/qemu-system-aarch64", f"{GLIB}/lib/libglib-2.0.0.dylib"}
+
+    for rel_path in resign_files:
+        manifest.mark_signed(f"{dist_path}/{rel_path}", "unsigned", "signed")
+    manifest.save()
+    syncer, resign_files, _ = sync(lq, install_dir, dist_path, deps)
+    assert (syncer.updated_count, resign_files) == (0, set())
+
+    # like a rebuild of glib, only its copy is made and signed again
+    glib = f"{install_dir}/{GLIB}/lib/libglib-2.0.0.dylib"
+    with open(glib, "ab") as f:
+        f.write(b"rebuilt")
+    capsys.readouterr()
+    syncer, resign_files, _ = sync(lq, install_dir, dist_path, deps)
+    assert (syncer.updated_count, resign_files) == (1, {f"{GLIB}/lib/libglib-2.0.0.dylib"})
+    assert (dist_path / GLIB / "lib" / "libglib-2.0.0.dylib").read_bytes().endswith(b"rebuilt")
+    assert f"updated 1 of {len(deps)} entries" in capsys.readouterr().out
+
+    # a dist copy changed by something else is made again too
+    (dist_path / QEMU / "share" / "qemu" / "stray.rom").write_bytes(b"stray")
+    syncer, _, _ = sync(lq, install_dir, dist_path, deps)
+    assert syncer.updated_count == 1
+    assert not (dist_path / QEMU / "share" / "qemu" / "stray.rom").exists()
+
+def test_removed_deps(lq, install_dir, tmp_path, capsys):
+    dist_path = tmp_path / "dist"
+    sync(lq, install_dir, dist_path, deps_of(install_dir, *DEPS))
+
+    deps = deps_of(install_dir, *[rel_path for rel_path in DEPS if rel_path != "opt/glib"])
+    _, _, manifest = sync(lq, install_dir, dist_path, deps)
+    assert not os.path.lexists(dist_path / "opt" / "glib")
+    assert "opt/glib" not in manifest.entries
+    assert f"removing {dist_path}/opt/glib, it is no longer a dependency" in capsys.readouterr().out
+
+def test_removed_dir_with_live_child(lq, install_dir, tmp_path):
+    dist_path = tmp_path / "dist"
+    sync(lq, install_dir, dist_path, deps_of(install_dir, *DEPS))
+    firmware = f"{QEMU}/share/qemu/edk2-aarch64-code.fd"
+    helper = f"{QEMU}/share/qemu/libexec/qemu-bridge-helper"
+
+    # like the prune stage, which replaces share/qemu by the files that are used
+    deps = deps_of(install_dir, *[rel_path for rel_path in DEPS if rel_path != f"{QEMU}/share/qemu"], firmware, helper)
+    _, _, manifest = sync(lq, install_dir, dist_path, deps)
+
+    assert (dist_path / firmware).read_bytes() == b"edk2"
+    assert dylibs(lq, dist_path / helper) == [f"@executable_path/../{GLIB_DYLIB}"]
+    assert not (dist_path / QEMU / "share" / "qemu" / "efi-virtio.rom").exists()
+    assert f"{QEMU}/share/qemu" not in manifest.entries
+    assert {firmware, helper} <= set(manifest.entries)
+
+def test_dir_dep_after_its_files(lq, install_dir, tmp_path):
+    dist_path = tmp_path / "dist"
+    helper = f"{QEMU}/share/qemu/libexec/qemu-bridge-helper"
+    syncer = lq.DistSyncer(lq.Arch.AARCH64, install_dir, 4, str(dist_path))
+    syncer.start()
+    # the traced helper is submitted before the directory containing it, whose copy overwrites it
+    syncer.submit(f"{install_dir}/{helper}")
+    syncer.submit(f"{install_dir}/{QEMU}/share/qemu")
+    _, resign_files, manifest = syncer.finish(deps_of(install_dir, helper, f"{QEMU}/share/qemu"))
+
+    assert dylibs(lq, dist_path / helper) == [f"@executable_path/../{GLIB_DYLIB}"]
+    assert manifest.entries[helper]["rewrites"] == {f"{install_dir}/{GLIB_DYLIB}": f"@executable_path/../{GLIB_DYLIB}"}
+    assert f"{dist_path}/{helper}" in resign_files
+    assert manifest.is_current(helper, lq._source_signature(f"{install_dir}/{helper}", dereference=False))
+
+@pytest.mark.parametrize("manifest", [None, "{not json"])
+def test_rebuild_without_manifest(lq, install_dir, tmp_path, manifest):
+    dist_path = tmp_path / "dist"
+    (dist_path / "lib").mkdir(parents=True)
+    (dist_path / "lib" / "leftover.dylib").write_bytes(b"leftover")
+    if manifest is not None:
+        (tmp_path / "dist.manifest.json").write_text(manifest)
+
+    # nothing is known about the existing tree, so it is built from scratch
+    syncer, _, _ = sync(lq, install_dir, dist_path, deps_of(install_dir, *DEPS))
+    assert not (dist_path / "lib").exists()
+    assert syncer.updated_count == len(DEPS)
+    assert dylibs(lq, dist_path / "bin" / "qemu-system-aarch64") == [f"@executable_path/../{GLIB_DYLIB}", "/usr/lib/libSystem.B.dylib"]
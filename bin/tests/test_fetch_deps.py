@@ -0,0 +1,149 @@
+import hashlib
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ARTIFACT = random.Random(0).randbytes(3 << 20)
+
+# Serves ARTIFACT with Range support. server.mode changes how it responds: "no-range" ignores Range
+# headers like some mirrors do, "flaky" closes the connection halfway through the first response.
+class ArtifactHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.server.requests.append(range_header)
+        start = 0
+        if range_header and self.server.mode != "no-range":
+            start = int(range_header.removeprefix("bytes=").removesuffix("-"))
+            if start >= len(ARTIFACT):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(ARTIFACT)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(ARTIFACT) - 1}/{len(ARTIFACT)}")
+        else:
+            self.send_response(200)
+        body = ARTIFACT[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.server.mode == "flaky":
+            self.server.mode = ""
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ArtifactHandler)
+    server.mode = ""
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def artifact(fetch_deps, server, tmp_path):
+    url = f"http://127.0.0.1:{server.server_address[1]}/aarch64/lima-and-qemu.macos-aarch64.tar.gz"
+    return fetch_deps.Artifact("deps/lima-bundles.conf", url, "sha512", hashlib.sha512(ARTIFACT).hexdigest(), str(tmp_path / "out" / "lima-and-qemu.tar.gz"))
+
+@pytest.fixture
+def pool(fetch_deps):
+    pool = fetch_deps.ConnectionPool(10)
+    yield pool
+    pool.close()
+
+def write_partial(artifact, data):
+    os.makedirs(os.path.dirname(artifact.cache_path), exist_ok=True)
+    with open(f"{artifact.cache_path}.partial", "wb") as f:
+        f.write(data)
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def test_fetch(fetch_deps, server, artifact, pool):
+    action, size, _ = fetch_deps.fetch(artifact, pool, 3)
+    assert (action, size) == ("downloaded", len(ARTIFACT))
+    assert read(artifact.output) == ARTIFACT
+    assert server.requests == [None]
+
+    # the output is a copy of the cache entry, changing it leaves the cache intact
+    with open(artifact.output, "r+b") as f:
+        f.write(b"changed")
+    assert read(artifact.cache_path) == ARTIFACT
+    assert os.stat(artifact.output).st_ino != os.stat(artifact.cache_path).st_ino
+
+    assert fetch_deps.fetch(artifact, pool, 3)[0] == "cached"
+    assert read(artifact.output) == ARTIFACT
+    assert server.requests == [None]
+
+def test_fetch_resumes_partial_download(fetch_deps, server, artifact, pool):
+    write_partial(artifact, ARTIFACT[:1000000])
+
+    fetch_deps.fetch(artifact, pool, 3)
+
+    assert server.requests == ["bytes=1000000-"]
+    assert read(artifact.output) == ARTIFACT
+    assert not os.path.exists(f"{artifact.cache_path}.partial")
+
+def test_fetch_resumes_interrupted_download(fetch_deps, server, artifact, pool):
+    server.mode = "flaky"
+
+    assert fetch_deps.fetch(artifact, pool, 3)[0] == "resumed"
+
+    assert server.requests == [None, f"bytes={len(ARTIFACT) // 2}-"]
+    assert read(artifact.output) == ARTIFACT
+
+def test_fetch_without_range_support(fetch_deps, server, artifact, pool):
+    server.mode = "no-range"
+    # the partial file must be discarded rather than appended to
+    write_partial(artifact, b"\0" * 1000000)
+
+    fetch_deps.fetch(artifact, pool, 3)
+
+    assert server.requests == ["bytes=1000000-"]
+    assert read(artifact.output) == ARTIFACT
+
+def test_fetch_complete_partial_download(fetch_deps, server, artifact, pool):
+    write_partial(artifact, ARTIFACT)
+
+    fetch_deps.fetch(artifact, pool, 3)
+
+    # the server answers 416 Range Not Satisfiable, the digest of the partial file decides
+    assert server.requests == [f"bytes={len(ARTIFACT)}-"]
+    assert read(artifact.output) == ARTIFACT
+
+def test_fetch_digest_mismatch(fetch_deps, server, artifact, pool):
+    artifact = artifact._replace(digest=hashlib.sha512(b"other").hexdigest())
+
+    with pytest.raises(RuntimeError, match=f"expected {artifact.digest}"):
+        fetch_deps.fetch(artifact, pool, 3)
+
+    assert not os.path.exists(artifact.cache_path)
+    assert not os.path.exists(f"{artifact.cache_path}.partial")
+    assert not os.path.exists(artifact.output)
+
+def test_fetch_same_artifact_concurrently(fetch_deps, server, artifact, pool, tmp_path):
+    artifacts = [artifact._replace(output=str(tmp_path / f"out{i}" / "lima-and-qemu.tar.gz")) for i in range(4)]
+    results = []
+    threads = [threading.Thread(target=lambda a=a: results.append(fetch_deps.fetch(a, pool, 3)[0])) for a in artifacts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == ["cached"] * 3 + ["downloaded"]
+    assert server.requests == [None]
+    assert all(read(a.output) == ARTIFACT for a in artifacts)
@@ -0,0 +1,59 @@
+import gzip
+import hashlib
+import io
+import random
+import shutil
+import subprocess
+
+import pytest
+
+BLOCK_SIZE = 1 << 16
+
+def sample(size):
+    rng = random.Random(size)
+    words = [b"qemu-system-aarch64 ", b"libglib-2.0.0.dylib ", b"/opt/homebrew/Cellar/ "]
+    # words that repeat across block boundaries, so blocks depend on the dictionary of the previous
+    # one, mixed with bytes that don't compress at all
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words) if rng.random() < 0.9 else rng.randbytes(64)
+    return bytes(data[:size])
+
+def compress(lq, data, chunk_size, workers):
+    out = io.BytesIO()
+    with lq.ParallelGzipWriter(out, 9, block_size=BLOCK_SIZE, workers=workers) as gz:
+        for offset in range(0, len(data), chunk_size):
+            gz.write(data[offset:offset + chunk_size])
+    return out.getvalue()
+
+@pytest.mark.parametrize("size", [0, 1, 1000, BLOCK_SIZE, 20 * BLOCK_SIZE + 12345])
+@pytest.mark.parametrize("workers", [1, 4])
+def test_parallel_gzip_round_trip(lq, size, workers):
+    data = sample(size)
+    compressed = compress(lq, data, 7919, workers)
+    assert gzip.decompress(compressed) == data
+    # the output is the same no matter how many workers compressed it, past the mtime in the header
+    assert compressed[10:] == compress(lq, data, BLOCK_SIZE * 3, 1)[10:]
+
+@pytest.mark.skipif(shutil.which("gunzip") is None, reason="gunzip is not installed")
+def test_parallel_gzip_gunzip(lq, tmp_path):
+    data = sample(20 * BLOCK_SIZE + 12345)
+    path = tmp_path / "data.gz"
+    path.write_bytes(compress(lq, data, 1 << 20, 4))
+    assert subprocess.run(["gunzip", "--test", str(path)]).returncode == 0
+    assert subprocess.run(["gunzip", "--stdout", str(path)], stdout=subprocess.PIPE, check=True).stdout == data
+
+def test_parallel_gzip_header(lq):
+    compressed = compress(lq, b"", 1, 1)
+    # deflate, no flags, the mtime, maximum compression and Unix
+    assert compressed[:4] == b"\x1f\x8b\x08\x00"
+    assert compressed[8:10] == b"\x02\x03"
+    assert gzip.decompress(compressed) == b""
+
+def test_digest_writer(lq):
+    out = io.BytesIO()
+    digest = lq.DigestWriter(out)
+    with lq.ParallelGzipWriter(digest, block_size=BLOCK_SIZE, workers=2) as gz:
+        gz.write(sample(3 * BLOCK_SIZE))
+    assert digest.bytes_written == len(out.getvalue())
+    assert digest.hash.hexdigest() == hashlib.sha512(out.getvalue()).hexdigest()
@@ -0,0 +1,103 @@
+import json
+import os
+import stat
+import tarfile
+
+import pytest
+
+QEMU = "Cellar/qemu/9.0.2_1"
+GLIB = "Cellar/glib/2.82.4"
+
+# A dist tree with a file in every layer, duplicates within a layer and across layers, and opt links
+@pytest.fixture
+def dist_tree(tmp_path):
+    install_dir = "/opt/homebrew"
+    dist_path = tmp_path / "dist"
+    files = {
+        "bin/qemu-system-aarch64": b"qemu" * 1000,
+        f"{QEMU}/bin/qemu-system-aarch64": b"qemu" * 1000,
+        f"{QEMU}/share/qemu/edk2-aarch64-code.fd": b"\0" * 70000,
+        f"{QEMU}/share/qemu/edk2-arm-vars.fd": b"\0" * 70000,
+        f"{QEMU}/lib/libqemu.dylib": b"\0" * 70000,
+        f"{GLIB}/lib/libglib-2.0.0.dylib": b"glib" * 1000,
+        f"{GLIB}/lib/libgio-2.0.0.dylib": b"gio",
+    }
+    for rel_path, data in files.items():
+        path = dist_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        path.chmod(0o755 if "/bin/" in f"/{rel_path}" else 0o644)
+    links = {
+        "share/qemu": f"../{QEMU}/share/qemu",
+        "opt/qemu": f"../{QEMU}",
+        "opt/glib": f"../{GLIB}",
+        f"{GLIB}/lib/libglib-2.0.dylib": "libglib-2.0.0.dylib",
+    }
+    for rel_path, target in links.items():
+        (dist_path / rel_path).parent.mkdir(exist_ok=True)
+        os.symlink(target, dist_path / rel_path)
+    deps = dict.fromkeys(f"{install_dir}/{rel_path}" for rel_path in ["bin/qemu-system-aarch64", QEMU, "share/qemu", "opt/qemu", "opt/glib", GLIB])
+    return install_dir, str(dist_path), deps
+
+def package(lq, dist_tree, tmp_path, monkeypatch, workers=4):
+    install_dir, dist_path, deps = dist_tree
+    (tmp_path / "src" / "lima").mkdir(parents=True, exist_ok=True)
+    monkeypatch.chdir(tmp_path)
+    lq.package_files_and_socket_vmnet(deps, install_dir, dist_path, "1.0.1", compression_block_size=1 << 15, compression_workers=workers, layered=True)
+    layer_dir = tmp_path / "src" / "lima" / "layers"
+    with open(layer_dir / lq.LAYERS_MANIFEST) as f:
+        return json.load(f), layer_dir
+
+# The files, links and directories below root, with the content and mode of every file
+def tree(root):
+    entries = {}
+    for dir_path, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(dir_path, name)
+            rel_path = os.path.relpath(path, root)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                entries[rel_path] = ("link", os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                entries[rel_path] = ("dir",)
+            else:
+                with open(path, "rb") as f:
+                    entries[rel_path] = ("file", f.read(), stat.S_IMODE(st.st_mode))
+    return entries
+
+def test_layers_are_deterministic(lq, dist_tree, tmp_path, monkeypatch):
+    manifest, layer_dir = package(lq, dist_tree, tmp_path, monkeypatch)
+    assert [layer["name"] for layer in manifest["layers"]] == ["binaries", "brew-glib", "brew-qemu", "share-qemu"]
+    files = sorted(os.listdir(layer_dir))
+
+    # neither the mtimes of the files nor the number of workers change a layer
+    _, dist_path, _ = dist_tree
+    for root, dirs, names in os.walk(dist_path):
+        for name in names:
+            os.utime(os.path.join(root, name), (0, 0))
+    assert package(lq, dist_tree, tmp_path, monkeypatch, workers=1) == (manifest, layer_dir)
+    assert sorted(os.listdir(layer_dir)) == files
+
+    # only the layer of a changed file gets a new digest, and its old file is removed
+    with open(f"{dist_path}/{GLIB}/lib/libgio-2.0.0.dylib", "ab") as f:
+        f.write(b" 2.82.5")
+    changed, _ = package(lq, dist_tree, tmp_path, monkeypatch)
+    assert [layer["name"] for layer in changed["layers"] if layer not in manifest["layers"]] == ["brew-glib"]
+    assert sorted(os.listdir(layer_dir)) == sorted([lq.LAYERS_MANIFEST] + [layer["file"] for layer in changed["layers"]])
+
+def test_layers_union_is_archive(lq, dist_tree, tmp_path, monkeypatch):
+    manifest, layer_dir = package(lq, dist_tree, tmp_path, monkeypatch)
+
+    with tarfile.open(tmp_path / "src" / "lima" / "lima-and-qemu.tar.gz") as tar:
+        tar.extractall(tmp_path / "archive")
+    names = []
+    for layer in manifest["layers"]:
+        with tarfile.open(layer_dir / layer["file"]) as tar:
+            names += tar.getnames()
+            tar.extractall(tmp_path / "layered")
+        assert os.path.getsize(layer_dir / layer["file"]) == layer["size"]
+
+    # every member is in exactly one layer, extracting all of them yields the tree of the archive
+    assert len(names) == len(set(names))
+    assert tree(tmp_path / "layered") == tree(tmp_path / "archive")
+    assert (tmp_path / "layered" / "LIMA_VERSION").read_text() == "1.0.1"
@@ -0,0 +1,199 @@
+import os
+import struct
+
+import pytest
+
+from helpers import CPU_TYPE_ARM64, CPU_TYPE_X86_64, dylib_command, fat_macho, macho_image, with_cputype
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return str(path)
+
+def link(path, target):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.symlink(target, path)
+
+def names(refs):
+    return [ref.name for ref in refs]
+
+def test_read_thin_macho(lq, tmp_path):
+    payload = b"\xcc" * 256
+    image = macho_image(
+        ["/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib"],
+        ["/opt/homebrew/opt/gettext/lib/libintl.8.dylib", "@rpath/libpixman-1.0.dylib", "/usr/lib/libSystem.B.dylib"],
+        payload,
+        rpaths=("@loader_path/../lib",),
+    )
+    path = write(tmp_path / "libglib-2.0.0.dylib", image)
+
+    slices = lq.read_macho(path)
+
+    assert len(slices) == 1
+    image_slice = slices[0]
+    assert (image_slice.offset, image_slice.size, image_slice.cputype) == (0, len(image), CPU_TYPE_ARM64)
+    assert image_slice.is_64 and image_slice.byteorder == "<"
+    assert image_slice.install_name() == "/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib"
+    assert names(image_slice.dependent_dylibs()) == [
+        "/opt/homebrew/opt/gettext/lib/libintl.8.dylib",
+        "@rpath/libpixman-1.0.dylib",
+        "/usr/lib/libSystem.B.dylib",
+    ]
+    assert image_slice.rpaths() == ["@loader_path/../lib"]
+    # the __text section starts right where the payload does
+    assert image_slice.data_offset == len(image) - len(payload)
+
+def test_read_fat_macho(lq, tmp_path):
+    x86_64 = with_cputype(macho_image([], ["/usr/local/opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib"], b"x86_64"), CPU_TYPE_X86_64)
+    arm64 = macho_image([], ["/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib"], b"arm64")
+    data, offsets = fat_macho([x86_64, arm64], [CPU_TYPE_X86_64, CPU_TYPE_ARM64])
+    path = write(tmp_path / "qemu-img", data)
+
+    slices = lq.read_macho(path)
+
+    assert [(s.offset, s.size, s.cputype) for s in slices] == [
+        (offsets[0], len(x86_64), CPU_TYPE_X86_64),
+        (offsets[1], len(arm64), CPU_TYPE_ARM64),
+    ]
+    assert names(slices[0].dependent_dylibs()) == ["/usr/local/opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib"]
+    assert names(slices[1].dependent_dylibs()) == ["/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib"]
+    assert all(s.install_name() is None for s in slices)
+
+@pytest.mark.parametrize("data", [
+    b"#!/bin/sh\necho not a Mach-O file\n",
+    b"\xca\xfe",
+    # a Java class file, which shares the fat magic
+    struct.pack(">IHH", 0xcafebabe, 0, 52) + b"\0" * 64,
+])
+def test_read_macho_of_other_files(lq, tmp_path, data):
+    assert lq.read_macho(write(tmp_path / "file", data)) is None
+
+def test_read_macho_truncated(lq, tmp_path):
+    image = macho_image([], ["/usr/lib/libSystem.B.dylib"], b"")
+    path = write(tmp_path / "truncated", image[:48])
+    with pytest.raises(RuntimeError, match="failed to read Mach-O headers"):
+        lq.read_macho(path)
+
+def test_record_load_command_closure(lq, tmp_path, capsys):
+    install_dir = os.path.realpath(tmp_path / "homebrew")
+    qemu = f"{install_dir}/Cellar/qemu/9.0.2_1"
+    glib = f"{install_dir}/Cellar/glib/2.82.4"
+    write(f"{qemu}/bin/qemu-system-aarch64", macho_image(
+        [],
+        [f"{install_dir}/opt/glib/lib/libglib-2.0.0.dylib", "@rpath/libpixman-1.0.dylib", "/usr/lib/libSystem.B.dylib"],
+        b"qemu",
+        rpaths=("@executable_path/../lib",),
+    ))
+    # resolved through the rpath of qemu-system-aarch64, which it inherits
+    write(f"{qemu}/lib/libpixman-1.0.dylib", macho_image(["@rpath/libpixman-1.0.dylib"], ["@loader_path/libpng.dylib", "@rpath/libz.dylib"], b"pixman"))
+    write(f"{qemu}/lib/libpng.dylib", macho_image(["@rpath/libpng.dylib"], [], b"png"))
+    write(f"{qemu}/lib/libz.dylib", macho_image(["@rpath/libz.dylib"], [], b"z"))
+    write(f"{glib}/lib/libglib-2.0.0.dylib", macho_image(
+        [f"{install_dir}/opt/glib/lib/libglib-2.0.0.dylib"],
+        [f"{install_dir}/opt/gettext/lib/libintl.8.dylib"],
+        b"glib",
+    ))
+    write(f"{install_dir}/Cellar/unused/1.0/lib/libunused.dylib", macho_image([], [], b"unused"))
+    link(f"{install_dir}/opt/glib", "../Cellar/glib/2.82.4")
+    link(f"{install_dir}/opt/unused", "../Cellar/unused/1.0")
+    link(f"{install_dir}/bin/qemu-system-aarch64", "../Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64")
+
+    resolver = lq.DepResolver(install_dir)
+    opt_index = lq.OptInodeIndex(install_dir)
+    opt_index.build()
+    lq.record_load_command_closure(lq.TraceConsumer(resolver, opt_index), [f"{install_dir}/bin/qemu-system-aarch64"])
+
+    assert {path.removeprefix(f"{install_dir}/"): entry.kind for path, entry in resolver.deps.items()} == {
+        # symlinks in bin are recorded without a target, the dist tree gets a copy of the file
+        "bin/qemu-system-aarch64": "link",
+        "Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64": "file",
+        "Cellar/qemu/9.0.2_1/lib/libpixman-1.0.dylib": "file",
+        "Cellar/qemu/9.0.2_1/lib/libpng.dylib": "file",
+        "Cellar/qemu/9.0.2_1/lib/libz.dylib": "file",
+        "opt/glib": "link",
+        "Cellar/glib/2.82.4/lib/libglib-2.0.0.dylib": "file",
+    }
+    assert f"{install_dir}/opt/glib/lib/libglib-2.0.0.dylib references {install_dir}/opt/gettext/lib/libintl.8.dylib, which does not exist" in capsys.readouterr().out
+
+def test_change_install_names_thin(lq, tmp_path):
+    payload = b"\xcc" * 256
+    image = macho_image(
+        ["/opt/homebrew/opt/pixman/lib/libpixman-1.0.dylib"],
+        ["/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib", "/opt/homebrew/opt/z/lib/libz.dylib"],
+        payload,
+    )
+    path = write(tmp_path / "libpixman-1.0.dylib", image)
+
+    assert lq.change_install_names(path, {
+        "/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib": "@executable_path/../opt/glib/lib/libglib-2.0.0.dylib",
+        "/opt/homebrew/opt/z/lib/libz.dylib": "@rpath/z.dylib",
+        # like "install_name_tool -change", the install name of the image itself is left alone
+        "/opt/homebrew/opt/pixman/lib/libpixman-1.0.dylib": "@executable_path/../opt/pixman/lib/libpixman-1.0.dylib",
+    })
+
+    image_slice, = lq.read_macho(path)
+    assert image_slice.install_name() == "/opt/homebrew/opt/pixman/lib/libpixman-1.0.dylib"
+    assert names(image_slice.dependent_dylibs()) == [
+        "@executable_path/../opt/glib/lib/libglib-2.0.0.dylib",
+        "/usr/lib/libSystem.B.dylib",
+        "@rpath/z.dylib",
+    ]
+    assert image_slice.ncmds == 5
+    with open(path, "rb") as f:
+        data = f.read()
+    assert len(data) == len(image)
+    assert data.endswith(payload)
+
+def test_change_install_names_moves_following_commands(lq, tmp_path):
+    image = bytearray(macho_image([], ["/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib"], b"glib"))
+    # put an LC_ID_DYLIB after the LC_LOAD_DYLIB that grows, it has to move along unchanged
+    id_command = dylib_command(lq.LC_ID_DYLIB, "/opt/homebrew/opt/glib/lib/libgio-2.0.0.dylib")
+    ncmds, sizeofcmds = struct.unpack_from("<II", image, 16)
+    image[32 + sizeofcmds:32 + sizeofcmds + len(id_command)] = id_command
+    struct.pack_into("<II", image, 16, ncmds + 1, sizeofcmds + len(id_command))
+    path = write(tmp_path / "libgio-2.0.0.dylib", image)
+
+    assert lq.change_install_names(path, {"/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib": "@executable_path/../opt/glib/lib/libglib-2.0.0.dylib"})
+
+    image_slice, = lq.read_macho(path)
+    assert names(image_slice.dependent_dylibs()) == ["@executable_path/../opt/glib/lib/libglib-2.0.0.dylib"]
+    assert image_slice.install_name() == "/opt/homebrew/opt/glib/lib/libgio-2.0.0.dylib"
+    assert image_slice.sizeofcmds > sizeofcmds + len(id_command)
+
+def test_change_install_names_fat(lq, tmp_path):
+    x86_64 = with_cputype(macho_image([], ["/usr/local/opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib"], b"x86_64"), CPU_TYPE_X86_64)
+    arm64 = macho_image([], ["/usr/lib/libSystem.B.dylib", "/usr/local/opt/glib/lib/libglib-2.0.0.dylib"], b"arm64")
+    data, _ = fat_macho([x86_64, arm64], [CPU_TYPE_X86_64, CPU_TYPE_ARM64])
+    path = write(tmp_path / "qemu-img", data)
+
+    assert lq.change_install_names(path, {"/usr/local/opt/glib/lib/libglib-2.0.0.dylib": "@executable_path/../opt/glib/lib/libglib-2.0.0.dylib"})
+
+    slices = lq.read_macho(path)
+    assert names(slices[0].dependent_dylibs()) == ["@executable_path/../opt/glib/lib/libglib-2.0.0.dylib", "/usr/lib/libSystem.B.dylib"]
+    assert names(slices[1].dependent_dylibs()) == ["/usr/lib/libSystem.B.dylib", "@executable_path/../opt/glib/lib/libglib-2.0.0.dylib"]
+    assert os.path.getsize(path) == len(data)
+
+def test_change_install_names_unreferenced(lq, tmp_path):
+    image = macho_image([], ["/usr/lib/libSystem.B.dylib"], b"")
+    path = write(tmp_path / "limactl", image)
+
+    assert not lq.change_install_names(path, {"/opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib": "@executable_path/../opt/glib/lib/libglib-2.0.0.dylib"})
+    with open(path, "rb") as f:
+        assert f.read() == image
+
+def test_change_install_names_does_not_fit(lq, tmp_path):
+    # only the second slice runs out of room, the first one must not be changed either
+    small = with_cputype(macho_image([], ["/usr/local/opt/glib/lib/libglib-2.0.0.dylib"], b"x86_64"), CPU_TYPE_X86_64)
+    image = macho_image([], ["/usr/local/opt/glib/lib/libglib-2.0.0.dylib"] * 2, b"arm64")
+    data, _ = fat_macho([small, image], [CPU_TYPE_X86_64, CPU_TYPE_ARM64])
+    path = write(tmp_path / "qemu-img", data)
+    data_offset = lq.read_macho(path)[1].data_offset
+    # about 4 KiB of padding follow the load commands of both images, enough to grow one command by 3 KiB but not two
+    changes = {"/usr/local/opt/glib/lib/libglib-2.0.0.dylib": "@executable_path/" + "x" * 3000}
+    assert lq.change_install_names(write(tmp_path / "small", small), changes)
+
+    with pytest.raises(RuntimeError, match=rf"need \d+ bytes, but only {data_offset} are available before the first section"):
+        lq.change_install_names(path, changes)
+    with open(path, "rb") as f:
+        assert f.read() == data
@@ -0,0 +1,42 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+@pytest.fixture
+def profiler(lq, monkeypatch, tmp_path):
+    profiler = lq.BuildProfiler()
+    monkeypatch.setattr(lq, "PROFILER", profiler)
+    profiler.install(str(tmp_path / "build-profile.json"))
+    return profiler
+
+def test_profiler_counts_subprocesses(lq, profiler, tmp_path):
+    popen = subprocess.Popen
+    with profiler.phase("copy"):
+        lq.run_process(["true"], check=True)
+        with profiler.template("default"):
+            process = lq.start_process([sys.executable, "-c", "import time; time.sleep(0.1)"])
+            process.wait()
+    # processes the build doesn't start itself, e.g. those of pytest, are left alone
+    subprocess.run(["true"], check=True)
+    assert subprocess.Popen is popen
+
+    with open(tmp_path / "build-profile.json") as f:
+        report = json.load(f)
+    phase, = report["phases"]
+    assert (phase["name"], phase["subprocesses"]) == ("copy", 2)
+    assert phase["subprocess_seconds"] >= 0.1
+    template, = report["templates"]
+    assert (template["name"], template["subprocesses"]) == ("default", 1)
+
+def test_run_process(lq, profiler):
+    result = lq.run_process([sys.executable, "-c", "import sys; print('out'); print('err', file=sys.stderr)"], capture_output=True, text=True)
+    assert (result.returncode, result.stdout, result.stderr) == (0, "out\n", "err\n")
+
+    with pytest.raises(subprocess.CalledProcessError) as info:
+        lq.run_process("echo failed; exit 3", shell=True, stdout=subprocess.PIPE, check=True)
+    assert (info.value.returncode, info.value.stdout) == (3, b"failed\n")
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        lq.run_process(["sleep", "10"], timeout=0.1)
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+# signs by appending a signature to the file, and reports the hypervisor entitlement unless
+# ENTITLEMENTS says otherwise
+CODESIGN = """#!/bin/sh
+echo "$*" >> {calls}
+for file; do :; done
+case "$1" in
+  --sign)
+    [ -n "$CODESIGN_FAIL" ] && {{ echo "$file: invalid format" >&2; exit 1; }}
+    printf ' signed' >> "$file" ;;
+  -d)
+    echo "${{ENTITLEMENTS-<key>com.apple.security.hypervisor</key>}}" ;;
+esac
+"""
+
+@pytest.fixture
+def codesign(stand_in, tmp_path):
+    calls = tmp_path / "codesign.calls"
+    calls.touch()
+    stand_in("codesign", CODESIGN.format(calls=calls))
+    def read_calls():
+        with open(calls) as f:
+            return [line.split()[0] for line in f]
+    return read_calls
+
+def dist_tree(lq, dist_path, files):
+    manifest = lq.DistManifest(str(dist_path))
+    paths = set()
+    for rel_path, data in files.items():
+        path = dist_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        manifest.entries[rel_path] = {}
+        paths.add(str(path))
+    return manifest, paths
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def test_resign(lq, codesign, tmp_path):
+    manifest, paths = dist_tree(lq, tmp_path / "dist", {"bin/qemu-system-aarch64": b"qemu", "lib/libglib.dylib": b"glib"})
+
+    lq.resign(paths, manifest, 2)
+
+    assert (tmp_path / "dist" / "bin" / "qemu-system-aarch64").read_bytes() == b"qemu signed"
+    assert (tmp_path / "dist" / "lib" / "libglib.dylib").read_bytes() == b"glib signed"
+    # only qemu-system is checked for the hypervisor entitlement
+    assert sorted(codesign()) == ["--sign", "--sign", "-d"]
+    assert manifest.entries["lib/libglib.dylib"]["signed"]
+    assert manifest.entries["lib/libglib.dylib"]["unsigned_digest"] == sha256(b"glib")
+    assert manifest.entries["lib/libglib.dylib"]["signed_digest"] == sha256(b"glib signed")
+    assert sorted(os.listdir(lq.SIGNED_CACHE_DIR)) == sorted([sha256(b"qemu"), sha256(b"glib")])
+
+    # files that are still signed aren't signed again
+    lq.resign(paths, manifest, 2)
+    assert len(codesign()) == 3
+
+def test_resign_from_cache(lq, codesign, tmp_path):
+    manifest, paths = dist_tree(lq, tmp_path / "dist", {"lib/libglib.dylib": b"glib"})
+    lq.resign(paths, manifest, 1)
+
+    # another dist tree with the same bytes, e.g. after the dist tree was removed
+    other_manifest, other_paths = dist_tree(lq, tmp_path / "other-dist", {"lib/libglib.dylib": b"glib", "lib/libz.dylib": b"z"})
+    lq.resign(other_paths, other_manifest, 1)
+
+    assert (tmp_path / "other-dist" / "lib" / "libglib.dylib").read_bytes() == b"glib signed"
+    assert (tmp_path / "other-dist" / "lib" / "libz.dylib").read_bytes() == b"z signed"
+    assert codesign() == ["--sign", "--sign"]
+    assert other_manifest.entries["lib/libglib.dylib"]["signed_digest"] == sha256(b"glib signed")
+
+def test_resign_failure(lq, codesign, tmp_path, monkeypatch):
+    manifest, paths = dist_tree(lq, tmp_path / "dist", {"lib/libglib.dylib": b"glib", "lib/libz.dylib": b"z"})
+    monkeypatch.setenv("CODESIGN_FAIL", "1")
+
+    with pytest.raises(RuntimeError, match="failed to resign files: 2 errors") as info:
+        lq.resign(paths, manifest, 2)
+    assert "codesign exited with 1" in str(info.value.__cause__.__cause__)
+    # the manifest is saved anyway, nothing is marked as signed
+    assert not any(entry.get("signed") for entry in manifest.entries.values())
+    assert os.path.isfile(manifest.path)
+
+def test_resign_missing_entitlement(lq, codesign, tmp_path, monkeypatch):
+    manifest, paths = dist_tree(lq, tmp_path / "dist", {"bin/qemu-system-aarch64": b"qemu"})
+    monkeypatch.setenv("ENTITLEMENTS", "")
+
+    with pytest.raises(RuntimeError, match="failed to resign files") as info:
+        lq.resign(paths, manifest, 1)
+    assert "missing the com.apple.security.hypervisor entitlement" in str(info.value.__cause__.__cause__)
+
+def test_evict_signed_copies(lq, codesign, tmp_path):
+    # the cache is shared with the dist tree of another arch, whose copies must survive this build
+    other_manifest, other_paths = dist_tree(lq, tmp_path / "dist-x86_64", {"lib/libglib.dylib": b"glib x86_64"})
+    lq.resign(other_paths, other_manifest, 1)
+    manifest, paths = dist_tree(lq, tmp_path / "dist-aarch64", {"lib/libglib.dylib": b"glib aarch64"})
+    lq.resign(paths, manifest, 1)
+    assert sorted(os.listdir(lq.SIGNED_CACHE_DIR)) == sorted([sha256(b"glib x86_64"), sha256(b"glib aarch64")])
+
+    # copies no build used for longer than the max age are evicted, the ones of this build are kept
+    expired = time.time() - lq.SIGNED_CACHE_MAX_AGE - 60
+    for name in os.listdir(lq.SIGNED_CACHE_DIR):
+        os.utime(os.path.join(lq.SIGNED_CACHE_DIR, name), (expired, expired))
+    lq.resign(paths, manifest, 1)
+    assert os.listdir(lq.SIGNED_CACHE_DIR) == [sha256(b"glib aarch64")]
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import random
+import tarfile
+
+import pytest
+
+@pytest.fixture
+def dist_tree(tmp_path):
+    dist_path = tmp_path / "dist"
+    rng = random.Random(0)
+    files = {
+        "bin/qemu-img": rng.randbytes(100),
+        # larger than the blocks the members are read in
+        "Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64": rng.randbytes(3 << 20) + b"qemu" * 1000,
+        "Cellar/qemu/9.0.2_1/bin/qemu-img": None,
+        "Cellar/qemu/9.0.2_1/share/qemu/edk2-aarch64-code.fd": b"\0" * 70000,
+        "Cellar/qemu/9.0.2_1/share/qemu/empty": b"",
+    }
+    files["Cellar/qemu/9.0.2_1/bin/qemu-img"] = files["bin/qemu-img"]
+    for rel_path, data in files.items():
+        path = dist_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    os.symlink("../Cellar/qemu/9.0.2_1/share/qemu", dist_path / "share-qemu")
+    return str(dist_path), files
+
+def write_archive(lq, dist_path, archive_path):
+    members = lq._archive_members(dist_path, ["bin", "Cellar", "share-qemu"])
+    duplicates = lq._duplicate_files(members)
+    lq.write_seekable_archive(members, duplicates, "1.0.1", archive_path, 6, 4)
+    return members, duplicates
+
+# Reads every file of a seekable archive through its TOC, last one first, and compares it with what
+# extracting the whole archive with tarfile yields
+def verify_seekable_archive(lq, path):
+    archive = lq.SeekableArchive(path)
+    digests = {}
+    for name, entry in reversed(archive.entries.items()):
+        if entry["type"] == "reg":
+            digests[name] = hashlib.sha256(archive.read(name)).hexdigest()
+
+    names = []
+    with tarfile.open(path, "r:gz") as tar:
+        for member in tar:
+            if member.name == lq.SEEKABLE_TOC: continue
+            names.append(member.name)
+            entry = archive.entries[member.name]
+            assert entry["size"] == member.size
+            if member.isreg():
+                assert hashlib.sha256(tar.extractfile(member).read()).hexdigest() == digests[member.name]
+    assert names == list(archive.entries)
+    return archive
+
+def test_seekable_archive(lq, dist_tree, tmp_path):
+    dist_path, files = dist_tree
+    archive_path = str(tmp_path / "lima-and-qemu.seekable.tar.gz")
+    members, duplicates = write_archive(lq, dist_path, archive_path)
+
+    archive = verify_seekable_archive(lq, archive_path)
+
+    assert list(archive.entries) == [arcname for _, arcname in members] + ["LIMA_VERSION"]
+    for rel_path, data in files.items():
+        if rel_path in duplicates:
+            assert archive.entries[rel_path]["type"] == "hardlink"
+            assert archive.entries[rel_path]["linkname"] == duplicates[rel_path]
+        else:
+            assert archive.read(rel_path) == data
+    assert duplicates == {"Cellar/qemu/9.0.2_1/bin/qemu-img": "bin/qemu-img"}
+    assert archive.read("LIMA_VERSION") == b"1.0.1"
+    assert archive.entries["share-qemu"]["type"] == "symlink"
+    with pytest.raises(RuntimeError, match="is not a regular file"):
+        archive.read("share-qemu")
+
+    with tarfile.open(archive_path, "r:gz") as tar:
+        assert tar.extractfile("Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64").read() == files["Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64"]
+
+def test_seekable_archive_digest_mismatch(lq, dist_tree, tmp_path):
+    dist_path, _ = dist_tree
+    archive_path = str(tmp_path / "lima-and-qemu.seekable.tar.gz")
+    write_archive(lq, dist_path, archive_path)
+    archive = lq.SeekableArchive(archive_path)
+    archive.entries["bin/qemu-img"]["digest"] = f"sha256:{hashlib.sha256(b'other').hexdigest()}"
+
+    with pytest.raises(RuntimeError, match="doesn't match its digest"):
+        archive.read("bin/qemu-img")
+
+def test_seekable_archive_without_footer(lq, tmp_path):
+    path = tmp_path / "lima-and-qemu.tar.gz"
+    path.write_bytes(b"\x1f\x8b" + bytes(100))
+    with pytest.raises(RuntimeError, match="has no seekable archive footer"):
+        lq.SeekableArchive(str(path))
+
+def test_seekable_chunk_of_changed_file(lq, tmp_path):
+    path = tmp_path / "qemu-img"
+    path.write_bytes(b"qemu-img")
+    tarinfo = tarfile.TarInfo("bin/qemu-img")
+    tarinfo.size = 4
+
+    with pytest.raises(RuntimeError, match="changed size from 4 to 8 bytes"):
+        lq._seekable_chunk(tarinfo, str(path), None, 6)
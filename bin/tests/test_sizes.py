@@ -0,0 +1,79 @@
+import json
+import os
+import random
+
+import pytest
+
+QEMU = "Cellar/qemu/9.0.2_1"
+GLIB = "Cellar/glib/2.82.4"
+
+@pytest.fixture
+def prefix(lq, tmp_path, monkeypatch):
+    install_dir = tmp_path / "homebrew"
+    dist_path = tmp_path / "dist"
+    rng = random.Random(0)
+    files = {
+        f"{QEMU}/bin/qemu-img": rng.randbytes(3 << 20),
+        f"{GLIB}/lib/libglib-2.0.0.dylib": b"glib" * 100000,
+    }
+    for root in [install_dir, dist_path]:
+        for rel_path, data in files.items():
+            (root / rel_path).parent.mkdir(parents=True, exist_ok=True)
+            (root / rel_path).write_bytes(data)
+    (install_dir / "bin").mkdir()
+    os.symlink(f"../{QEMU}/bin/qemu-img", install_dir / "bin" / "qemu-img")
+    # symlinks in bin are replaced by a copy of their target in the dist tree
+    (dist_path / "bin").mkdir()
+    (dist_path / "bin" / "qemu-img").write_bytes(files[f"{QEMU}/bin/qemu-img"])
+    (install_dir / "opt").mkdir()
+    os.symlink(f"../{GLIB}", install_dir / "opt" / "glib")
+    (dist_path / "opt").mkdir()
+    os.symlink(f"../{GLIB}", dist_path / "opt" / "glib")
+
+    deps = {f"{install_dir}/{rel_path}": None for rel_path in ["bin/qemu-img", f"{QEMU}/bin/qemu-img", "opt/glib", f"{GLIB}/lib/libglib-2.0.0.dylib"]}
+    monkeypatch.chdir(tmp_path)
+    return deps, str(install_dir), str(dist_path), files
+
+def test_package_sizes(lq, prefix):
+    deps, install_dir, dist_path, files = prefix
+
+    sizes = lq.package_sizes(deps, install_dir, dist_path, compression_level=6, compression_workers=4)
+
+    assert set(sizes) == {"qemu", "glib"}
+    # the copy in bin is a hardlink in the archive, so it doesn't count
+    assert (sizes["qemu"]["size"], sizes["qemu"]["files"]) == (len(files[f"{QEMU}/bin/qemu-img"]), 1)
+    assert (sizes["glib"]["size"], sizes["glib"]["files"]) == (len(files[f"{GLIB}/lib/libglib-2.0.0.dylib"]), 1)
+    # qemu-img doesn't compress at all, libglib does
+    assert sizes["qemu"]["compressed_size"] > sizes["qemu"]["size"]
+    assert sizes["glib"]["compressed_size"] < sizes["glib"]["size"] // 100
+
+    without_dedup = lq.package_sizes(deps, install_dir, dist_path, compression_level=6, compression_workers=4, dedup=False)
+    assert (without_dedup["qemu"]["size"], without_dedup["qemu"]["files"]) == (2 * len(files[f"{QEMU}/bin/qemu-img"]), 2)
+
+def test_check_package_sizes(lq, prefix, capsys):
+    deps, install_dir, dist_path, _ = prefix
+    thresholds = lq.SizeThresholds(10, 50, 5, 20, 1000)
+
+    # without a baseline the sizes are only written for the workflow to pick up
+    lq.check_package_sizes(deps, lq.Arch.AARCH64, install_dir, dist_path, thresholds, compression_level=6)
+    assert "size baseline deps-size-baseline-arm64.json not found" in capsys.readouterr().out
+    os.replace("deps-size-baseline-arm64.generated.json", "deps-size-baseline-arm64.json")
+    lq.check_package_sizes(deps, lq.Arch.AARCH64, install_dir, dist_path, thresholds, compression_level=6)
+    with open("deps-size-diff-arm64.json") as f:
+        assert json.load(f)["status"] == "ok"
+
+    # qemu doubles in size
+    with open(f"{dist_path}/{QEMU}/bin/qemu-system-aarch64", "wb") as f:
+        f.write(random.Random(1).randbytes(3 << 20))
+    deps[f"{install_dir}/{QEMU}/bin/qemu-system-aarch64"] = None
+    with pytest.raises(RuntimeError, match="the bundle grew more than allowed over deps-size-baseline-arm64.json"):
+        lq.check_package_sizes(deps, lq.Arch.AARCH64, install_dir, dist_path, thresholds, compression_level=6)
+    with open("deps-size-diff-arm64.json") as f:
+        diff = json.load(f)
+    assert (diff["packages"]["qemu"]["status"], diff["packages"]["glib"]["status"], diff["total"]["status"]) == ("fail", "ok", "fail")
+
+def test_size_gate_is_opt_in(lq, capsys):
+    # the stage returns before it looks at the build state
+    lq.size_stage(lq.parse_args([]), None)
+    assert "Skipping the package size gate" in capsys.readouterr().out
+    assert lq.parse_args(["--size-gate"]).size_gate
@@ -0,0 +1,51 @@
+import os
+import time
+
+import pytest
+
+LIMACTL = """#!/bin/sh
+echo "$*" >> {calls}
+case "$*" in
+  start*/failing.yaml) sleep 0.5; echo "failed to boot"; exit 1 ;;
+  start*/slow.yaml) exec sleep 600 ;;
+esac
+"""
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch, stand_in):
+    template_dir = tmp_path / "src" / "lima" / "templates"
+    template_dir.mkdir(parents=True)
+    for template in ["failing", "slow", "pending", "default"]:
+        (template_dir / f"{template}.yaml").write_text("vmType: qemu\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    calls = tmp_path / "limactl.calls"
+    stand_in("limactl", LIMACTL.format(calls=calls))
+    return calls
+
+def read_calls(calls):
+    with open(calls) as f:
+        return [line.split()[:2] + [os.path.basename(line.split()[-1])] for line in f]
+
+def test_run_lima_templates(lq, templates):
+    lq.run_lima_templates(["default"], 1, lq.Tracer(lq.Arch.AARCH64, "/opt/homebrew", print))
+
+    assert read_calls(templates) == [
+        ["start", "--tty=false", "default.yaml"],
+        ["shell", "default", "uname"],
+        ["stop", "default", "default"],
+        ["delete", "default", "default"],
+    ]
+
+def test_run_lima_templates_cancels_on_failure(lq, templates):
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="failed to run lima template 'failing'"):
+        lq.run_lima_templates(["failing", "slow", "pending"], 2, lq.Tracer(lq.Arch.AARCH64, "/opt/homebrew", print))
+
+    # the slow template is stopped rather than waited for, and the pending one never boots
+    assert time.monotonic() - start < 30
+    calls = read_calls(templates)
+    assert ["start", "--tty=false", "failing.yaml"] in calls
+    assert ["start", "--tty=false", "slow.yaml"] in calls
+    assert ["delete", "-f", "slow"] in calls
+    assert ["start", "--tty=false", "pending.yaml"] not in calls
@@ -0,0 +1,175 @@
+import os
+import time
+
+import pytest
+
+QEMU_VERSION = "9.0.2_1"
+QEMU = f"Cellar/qemu/{QEMU_VERSION}"
+GLIB = "Cellar/glib/2.82.4"
+GETTEXT = "Cellar/gettext/0.22.5"
+
+# A prefix with qemu, glib, which qemu loads, and gettext, which only glib loads
+@pytest.fixture
+def install_dir(tmp_path):
+    install_dir = tmp_path / "homebrew"
+    for rel_path in [f"{QEMU}/bin/qemu-system-aarch64", f"{QEMU}/bin/qemu-img", f"{QEMU}/share/qemu/edk2-aarch64-code.fd", "Cellar/lima/1.0.1/bin/limactl", f"{GLIB}/lib/libglib-2.0.0.dylib", f"{GETTEXT}/lib/libintl.8.dylib"]:
+        (install_dir / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (install_dir / rel_path).write_text(rel_path)
+    for link, target in {
+        "bin/qemu-system-aarch64": f"../{QEMU}/bin/qemu-system-aarch64",
+        "bin/qemu-img": f"../{QEMU}/bin/qemu-img",
+        "bin/limactl": "../Cellar/lima/1.0.1/bin/limactl",
+        "share/qemu": f"../{QEMU}/share/qemu",
+        "opt/qemu": f"../{QEMU}",
+        "opt/glib": f"../{GLIB}",
+        "opt/gettext": f"../{GETTEXT}",
+    }.items():
+        (install_dir / link).parent.mkdir(exist_ok=True)
+        os.symlink(target, install_dir / link)
+    return str(install_dir)
+
+def initial_deps(lq, install_dir):
+    resolver = lq.DepResolver(install_dir)
+    lq.record_initial_deps(lq.Arch.AARCH64, resolver, QEMU_VERSION)
+    return resolver.deps
+
+def traced_deps(lq, install_dir):
+    resolver = lq.DepResolver(install_dir)
+    lq.record_initial_deps(lq.Arch.AARCH64, resolver, QEMU_VERSION)
+    resolver.record(f"{install_dir}/opt/glib/lib/libglib-2.0.0.dylib")
+    resolver.record(f"{install_dir}/opt/gettext/lib/libintl.8.dylib")
+    return resolver.deps
+
+def key(lq, prefix, **changes):
+    inputs = {
+        "arch": lq.Arch.AARCH64,
+        "install_dir": prefix,
+        "qemu_version": QEMU_VERSION,
+        "lima_version": "1.0.1",
+        "templates": ["fedora-44", "default"],
+        "initial_deps": initial_deps(lq, prefix),
+    }
+    inputs.update(changes)
+    return lq.TraceCache.key(**inputs)
+
+def test_trace_cache_key(lq, install_dir):
+    assert key(lq, install_dir) == key(lq, install_dir)
+    keys = {
+        key(lq, install_dir),
+        key(lq, install_dir, arch=lq.Arch.X86_64),
+        key(lq, install_dir, install_dir="/usr/local"),
+        key(lq, install_dir, qemu_version="9.1.0"),
+        key(lq, install_dir, lima_version="1.0.2"),
+        key(lq, install_dir, templates=["default"]),
+    }
+    assert len(keys) == 6
+
+    # the content of the initial deps counts, not just their size
+    with open(f"{install_dir}/{QEMU}/bin/qemu-img", "r+") as f:
+        data = f.read()
+        f.seek(0)
+        f.write(data.upper())
+    assert key(lq, install_dir) not in keys
+
+def test_trace_cache_hit(lq, install_dir):
+    deps = traced_deps(lq, install_dir)
+    cache = lq.TraceCache(key(lq, install_dir))
+    assert cache.load() is None
+
+    cache.store(deps)
+    assert lq.TraceCache(key(lq, install_dir)).load() == deps
+    assert lq.TraceCache(key(lq, install_dir, templates=["default"])).load() is None
+
+def test_trace_cache_miss_after_transitive_upgrade(lq, install_dir, capsys):
+    deps = traced_deps(lq, install_dir)
+    lq.TraceCache(key(lq, install_dir)).store(deps)
+
+    # like "brew upgrade gettext", which none of the key's inputs covers
+    os.makedirs(f"{install_dir}/Cellar/gettext/0.23.1/lib")
+    with open(f"{install_dir}/Cellar/gettext/0.23.1/lib/libintl.8.dylib", "w") as f:
+        f.write("gettext 0.23.1")
+    os.unlink(f"{install_dir}/opt/gettext")
+    os.symlink("../Cellar/gettext/0.23.1", f"{install_dir}/opt/gettext")
+
+    assert lq.TraceCache(key(lq, install_dir)).load() is None
+    assert f"cached trace is stale, {install_dir}/opt/gettext changed" in capsys.readouterr().out
+
+def test_trace_cache_miss_after_rebuilt_dylib(lq, install_dir, capsys):
+    deps = traced_deps(lq, install_dir)
+    lq.TraceCache(key(lq, install_dir)).store(deps)
+
+    # a reinstall of the same version replaces the file
+    path = f"{install_dir}/{GETTEXT}/lib/libintl.8.dylib"
+    with open(f"{path}.new", "w") as f:
+        f.write("rebuilt")
+    os.replace(f"{path}.new", path)
+    assert lq.TraceCache(key(lq, install_dir)).load() is None
+    assert f"{path} changed" in capsys.readouterr().out
+
+    os.unlink(path)
+    assert lq.TraceCache(key(lq, install_dir)).load() is None
+    assert f"{path} no longer exists" in capsys.readouterr().out
+
+def store_trace(lq, name, size, age):
+    cache = lq.TraceCache(name)
+    cache.store({f"/opt/homebrew/{'x' * size}": lq.DepEntry("file", 1, None, 1)})
+    mtime = time.time() - age
+    os.utime(cache.path, (mtime, mtime))
+    return cache.path
+
+def test_trace_cache_evict(lq):
+    day = 24 * 60 * 60
+    old = store_trace(lq, "old", 100, 40 * day)
+    recent = store_trace(lq, "recent", 1000, 1 * day)
+    older = store_trace(lq, "older", 1000, 2 * day)
+    oldest = store_trace(lq, "oldest", 1000, 3 * day)
+
+    # old isn't used for 30 days, and only the two most recently used ones fit into 2500 bytes
+    lq.TraceCache.evict(30 * day, 2500)
+    assert [os.path.exists(path) for path in [old, recent, older, oldest]] == [False, True, True, False]
+
+def test_trace_cache_load_marks_trace_as_used(lq, install_dir):
+    deps = traced_deps(lq, install_dir)
+    cache = lq.TraceCache(key(lq, install_dir))
+    cache.store(deps)
+    mtime = time.time() - 40 * 24 * 60 * 60
+    os.utime(cache.path, (mtime, mtime))
+
+    assert cache.load() == deps
+    lq.TraceCache.evict(30 * 24 * 60 * 60, 64 << 20)
+    assert os.path.exists(cache.path)
+
+@pytest.fixture
+def templates_run(lq, install_dir, monkeypatch):
+    runs = []
+    def run_lima_templates(templates, concurrency, tracer):
+        runs.append(templates)
+        tracer.on_path(f"{install_dir}/opt/glib/lib/libglib-2.0.0.dylib")
+        tracer.on_path(f"{install_dir}/opt/gettext/lib/libintl.8.dylib")
+    monkeypatch.setattr(lq, "run_lima_templates", run_lima_templates)
+    monkeypatch.setattr(lq, "create_tracer", lambda name, arch, install_dir, on_path: lq.Tracer(arch, install_dir, on_path))
+    return runs
+
+def trace(lq, install_dir, argv):
+    args = lq.parse_args(argv)
+    state = lq.BuildState(lq.Arch.AARCH64, install_dir, args.templates, QEMU_VERSION, "1.0.1")
+    lq.trace_stage(args, state, None)
+    return state
+
+def test_trace_stage_reuses_cached_trace(lq, install_dir, templates_run):
+    state = trace(lq, install_dir, [])
+    assert (state.deps_source, len(templates_run)) == ("trace", 1)
+    assert f"{install_dir}/{GETTEXT}/lib/libintl.8.dylib" in state.deps
+    lq.TraceCache(state.trace_cache_key).store(state.deps)
+
+    cached = trace(lq, install_dir, [])
+    assert (cached.deps_source, len(templates_run)) == ("cache", 1)
+    assert cached.deps == state.deps
+
+def test_trace_stage_force_trace(lq, install_dir, templates_run):
+    state = trace(lq, install_dir, [])
+    lq.TraceCache(state.trace_cache_key).store(state.deps)
+
+    forced = trace(lq, install_dir, ["--force-trace"])
+    assert (forced.deps_source, len(templates_run)) == ("trace", 2)
+    assert forced.deps == state.deps
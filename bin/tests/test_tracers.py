@@ -0,0 +1,232 @@
+import os
+import shutil
+import signal
+import threading
+import time
+
+import pytest
+
+from helpers import fs_usage_line
+
+FS_USAGE = """#!/bin/sh
+cat {log}
+# like fs_usage, keep running until killed
+sleep 600 >/dev/null &
+trap 'kill $!; exit 0' TERM
+wait
+"""
+
+# writes a line like strace would for every path in PATHS to the -o file, then runs the command
+STRACE = """#!/bin/sh
+while [ "$1" != "--" ]; do
+  [ "$1" = "-o" ] && out="$2"
+  shift
+done
+shift
+for path in $PATHS; do
+  echo "4242  openat(AT_FDCWD, \\"$path\\", O_RDONLY|O_CLOEXEC) = 3"
+done > "$out"
+exec "$@"
+"""
+
+SUDO = """#!/bin/sh
+exec "$@"
+"""
+
+@pytest.fixture
+def fs_usage(stand_in, tmp_path):
+    def install(install_dir, paths):
+        log = tmp_path / "fs_usage.log"
+        with open(log, "w") as f:
+            for n, path in enumerate(paths):
+                f.write(fs_usage_line(n, "open", path, "qemu-system-aarch64.4242"))
+                f.write(fs_usage_line(n, "stat64", path, "qemu-system-aarch64.4242"))
+        stand_in("sudo", SUDO)
+        stand_in("fs_usage", FS_USAGE.format(log=log))
+    return install
+
+def test_fs_usage_tracer(lq, fs_usage):
+    install_dir = "/opt/homebrew"
+    paths = [f"{install_dir}/Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64", f"{install_dir}/opt/glib/lib/libglib-2.0.0.dylib"]
+    fs_usage(install_dir, paths)
+    seen = []
+    tracer = lq.FsUsageTracer(lq.Arch.AARCH64, install_dir, seen.append)
+
+    tracer.start()
+    tracer.stop()
+
+    assert seen == paths
+
+def test_fs_usage_tracer_on_path_error(lq, fs_usage):
+    install_dir = "/opt/homebrew"
+    fs_usage(install_dir, [f"{install_dir}/Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64"] * 2000)
+    def on_path(path):
+        raise ValueError(f"unexpected {path}")
+    tracer = lq.FsUsageTracer(lq.Arch.AARCH64, install_dir, on_path)
+
+    tracer.start()
+    with pytest.raises(RuntimeError, match="failed to process fs_usage output") as info:
+        tracer.stop()
+    assert isinstance(info.value.__cause__, ValueError)
+
+# follows the trace the stand-in limactl writes to, like fs_usage reporting file access as it happens
+FOLLOWING_FS_USAGE = """#!/bin/sh
+tail -n +1 -f {trace} &
+trap 'kill $!; exit 0' TERM
+wait
+"""
+
+# reports reading LIMA_HOME, unless it is told to stay quiet
+PROBED_LIMACTL = """#!/bin/sh
+echo "$LIMA_HOME" >> {calls}
+[ -n "$QUIET" ] || printf '12:00:00.000000  open              F=3        (R_____)  %s  0.000010   limactl.4242\\n' "$LIMA_HOME" >> {trace}
+"""
+
+@pytest.fixture
+def probed_fs_usage(stand_in, tmp_path):
+    trace = tmp_path / "fs_usage.trace"
+    trace.touch()
+    calls = tmp_path / "limactl.calls"
+    calls.touch()
+    stand_in("sudo", SUDO)
+    stand_in("fs_usage", FOLLOWING_FS_USAGE.format(trace=trace))
+    stand_in("limactl", PROBED_LIMACTL.format(trace=trace, calls=calls))
+    return calls
+
+def test_fs_usage_tracer_ready(lq, probed_fs_usage):
+    seen = []
+    tracer = lq.FsUsageTracer(lq.Arch.AARCH64, "/opt/homebrew", seen.append)
+
+    tracer.start()
+    try:
+        tracer.ready(30)
+    finally:
+        tracer.stop()
+
+    # every probe runs limactl against the same empty LIMA_HOME, which is removed afterwards
+    lima_homes = set(probed_fs_usage.read_text().split())
+    assert len(lima_homes) == 1
+    assert not os.path.exists(lima_homes.pop())
+    # reading the sentinel is not a dependency
+    assert seen == []
+
+def test_fs_usage_tracer_ready_timeout(lq, probed_fs_usage, monkeypatch):
+    monkeypatch.setenv("QUIET", "1")
+    tracer = lq.FsUsageTracer(lq.Arch.AARCH64, "/opt/homebrew", print)
+
+    tracer.start()
+    start = time.monotonic()
+    try:
+        with pytest.raises(RuntimeError, match="fs_usage did not report file access within 1s"):
+            tracer.ready(1)
+    finally:
+        tracer.stop()
+    assert time.monotonic() - start < 10
+    # limactl was run again until the deadline
+    assert len(probed_fs_usage.read_text().split()) > 1
+
+def test_fs_usage_tracer_ready_exited(lq, stand_in):
+    stand_in("sudo", SUDO)
+    stand_in("fs_usage", "#!/bin/sh\necho 'fs_usage: must be run as root' >&2\nexit 1\n")
+    stand_in("limactl", "#!/bin/sh\n")
+    tracer = lq.FsUsageTracer(lq.Arch.AARCH64, "/opt/homebrew", print)
+
+    tracer.start()
+    try:
+        with pytest.raises(RuntimeError, match="fs_usage exited with 1 before reporting file access"):
+            tracer.ready(30)
+    finally:
+        tracer.cleanup()
+
+# A log like "fs_usage -w -f pathname" writes while a template boots, with a few lines of every kind
+RECORDED_LOG = """\
+10:32:01.103412  open              F=3        (R_____)  /opt/homebrew/Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64                                 0.000031   limactl.52311
+10:32:01.103598  stat64                                 /opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib                                          0.000006   qemu-system-aarch64.52340
+10:32:01.103711  open              F=4        (R_____)  /opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib                                          0.000012   qemu-system-aarch64.52340
+10:32:01.103790  read              F=4    B=0x1000     /opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib                                          0.000004   qemu-system-aarch64.52340
+10:32:01.104002  open              F=5        (R_____)  /System/Library/Frameworks/Hypervisor.framework/Versions/A/Hypervisor                    0.000010   qemu-system-aarch64.52340
+10:32:01.104120  open              F=6        (R__D__)  /opt/homebrew/Cellar/qemu/9.0.2_1/share/qemu                                            0.000009   qemu-system-aarch64.52340
+10:32:01.104233  open              F=6        (R_____)  ../share/qemu/edk2-aarch64-code.fd                                                    0.000015   qemu-system-aarch64.52340
+10:32:01.104301  open              F=7        (R_____)  /opt/homebrew/opt/glib/lib/libglib-2.0.0.dylib                                          0.000011   qemu-system-aarch64.52341
+10:32:01.104377  open              [  2]      (R_____)  /opt/homebrew/Cellar/qemu/9.0.2_1/lib/libmissing.dylib                                  0.000007   qemu-system-aarch64.52340
+10:32:01.104450  read              F=8    B=0x2a        /Users/runner/.lima/default/lima.yaml                                                   0.000003   limactl.52311
+"""
+
+def test_parse_fs_usage_log(lq, tmp_path, capsys):
+    install_dir = tmp_path / "homebrew"
+    qemu = install_dir / "Cellar" / "qemu" / "9.0.2_1"
+    for path in [qemu / "bin" / "qemu-system-aarch64", qemu / "share" / "qemu" / "edk2-aarch64-code.fd", install_dir / "Cellar" / "glib" / "2.82.4" / "lib" / "libglib-2.0.0.dylib"]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"\0" * 100)
+    for link, target in {"opt/qemu": "../Cellar/qemu/9.0.2_1", "opt/glib": "../Cellar/glib/2.82.4", "share/qemu": "../Cellar/qemu/9.0.2_1/share/qemu"}.items():
+        (install_dir / link).parent.mkdir(exist_ok=True)
+        os.symlink(target, install_dir / link)
+    log = tmp_path / "fs_usage.log"
+    log.write_text(RECORDED_LOG.replace("/opt/homebrew", str(install_dir)))
+    resolver = lq.DepResolver(str(install_dir))
+    opt_index = lq.OptInodeIndex(str(install_dir))
+    opt_index.build()
+    consumer = lq.TraceConsumer(resolver, opt_index)
+
+    lq.parse_fs_usage_log(str(log), lq.Arch.AARCH64, consumer)
+
+    assert {path.removeprefix(f"{install_dir}/"): str(entry) for path, entry in resolver.deps.items()} == {
+        "Cellar/qemu/9.0.2_1/bin/qemu-system-aarch64": "[100B]",
+        # the opt paths reaching a traced file are recorded along with it
+        "opt/qemu": "→ ../Cellar/qemu/9.0.2_1",
+        "opt/glib": "→ ../Cellar/glib/2.82.4",
+        "Cellar/glib/2.82.4/lib/libglib-2.0.0.dylib": "[100B]",
+        "share/qemu": "→ ../Cellar/qemu/9.0.2_1/share/qemu",
+        "Cellar/qemu/9.0.2_1/share/qemu/edk2-aarch64-code.fd": "[100B]",
+    }
+    # directories and files that don't exist are not counted
+    assert "fs_usage detected 3 files, 5 new deps recorded" in capsys.readouterr().out
+
+def run_limactl(lq, tracer, tmp_path, args):
+    with open(tmp_path / "limactl.log", "w") as log:
+        lq.run_limactl("default", args, log, threading.Event(), tracer)
+
+def test_strace_tracer_on_path_error(lq, stand_in, tmp_path, monkeypatch):
+    install_dir = "/opt/homebrew"
+    monkeypatch.setenv("PATHS", f"{install_dir}/bin/limactl {install_dir}/share/lima/lima-guestagent.Linux-aarch64.gz")
+    stand_in("strace", STRACE)
+    stand_in("limactl", "#!/bin/sh\n")
+    seen = []
+    def on_path(path):
+        seen.append(path)
+        raise ValueError(f"unexpected {path}")
+    tracer = lq.StraceTracer(lq.Arch.AARCH64, install_dir, on_path)
+
+    tracer.start()
+    run_limactl(lq, tracer, tmp_path, ["list"])
+    run_limactl(lq, tracer, tmp_path, ["list"])
+    with pytest.raises(RuntimeError, match="failed to process the output of 2 strace runs") as info:
+        tracer.stop()
+    assert isinstance(info.value.__cause__, ValueError)
+    assert seen == [f"{install_dir}/bin/limactl"] * 2
+
+@pytest.mark.skipif(shutil.which("strace") is None, reason="strace is not installed")
+def test_strace_tracer_returns_before_background_processes_exit(lq, stand_in, tmp_path):
+    install_dir = tmp_path / "homebrew"
+    data_file = install_dir / "share" / "lima" / "lima-guestagent.Linux-aarch64.gz"
+    data_file.parent.mkdir(parents=True)
+    data_file.write_text("guest agent")
+    pid_file = tmp_path / "hostagent.pid"
+    # like "limactl start", which leaves the hostagent and qemu running
+    stand_in("limactl", f"""#!/bin/sh
+cat {data_file}
+sleep 600 >/dev/null 2>&1 &
+echo $! > {pid_file}
+""")
+    seen = []
+    tracer = lq.StraceTracer(lq.Arch.AARCH64, str(install_dir), seen.append)
+
+    tracer.start()
+    start = time.monotonic()
+    try:
+        run_limactl(lq, tracer, tmp_path, ["start", "default"])
+        assert time.monotonic() - start < 30
+    finally:
+        os.kill(int(pid_file.read_text()), signal.SIGTERM)
+    tracer.stop()
+    assert str(data_file) in seen
@@ -0,0 +1,124 @@
+import json
+import time
+
+import pytest
+
+from helpers import macho_image
+
+def packed_version(*parts):
+    a, b, c, d, e = (list(parts) + [0, 0, 0, 0])[:5]
+    return a << 40 | b << 30 | c << 20 | d << 10 | e
+
+@pytest.mark.parametrize("parts, version", [
+    ((1, 2, 3), "1.2.3"),
+    ((2, 0, 0), "2.0.0"),
+    ((1, 2, 3, 4), "1.2.3.4"),
+    ((1, 0, 0, 0, 5), "1.0.0.0.5"),
+    ((1023, 1023, 1023, 1023, 1023), "1023.1023.1023.1023.1023"),
+])
+def test_embedded_source_version(lq, tmp_path, parts, version):
+    path = tmp_path / "socket_vmnet"
+    # the load command wins over any string in the binary
+    path.write_bytes(macho_image([], [], b"socket_vmnet version 9.9.9\n", source_version=packed_version(*parts)))
+    assert lq._embedded_version(str(path)) == version
+
+def test_embedded_version_string(lq, tmp_path):
+    path = tmp_path / "docker-credential-osxkeychain"
+    path.write_bytes(macho_image([], [], b"\0usage: docker-credential-osxkeychain version 0.8.2+ds1\0"))
+    assert lq._embedded_version(str(path)) == "0.8.2+ds1"
+
+    # only the version of the binary itself counts, not that of something it mentions
+    path.write_bytes(macho_image([], [], b"\0helper version 1.2.3\0xdocker-credential-osxkeychain version 2.3.4\0"))
+    assert lq._embedded_version(str(path)) is None
+
+def test_embedded_version_of_other_files(lq, tmp_path):
+    path = tmp_path / "script"
+    path.write_text("#!/bin/sh\necho script version 1.2.3\n")
+    assert lq._embedded_version(str(path)) is None
+    assert lq._embedded_version(str(tmp_path / "missing")) is None
+
+# The timeouts processes were run with. Setting limit shortens them.
+class Timeouts(list):
+    limit = None
+
+@pytest.fixture
+def timeouts(lq, monkeypatch):
+    timeouts = Timeouts()
+    run_process = lq.run_process
+    def recording_run_process(cmd, **kwargs):
+        timeouts.append(kwargs.get("timeout"))
+        if timeouts.limit is not None:
+            kwargs["timeout"] = timeouts.limit
+        return run_process(cmd, **kwargs)
+    monkeypatch.setattr(lq, "run_process", recording_run_process)
+    return timeouts
+
+def test_version_from_output(lq, tmp_path, timeouts):
+    path = tmp_path / "tool"
+    path.write_text("#!/bin/sh\necho 'tool 3.4.5-beta (built today)'\n")
+    path.chmod(0o755)
+    assert lq._version_from_output(str(path)) == "3.4.5-beta"
+
+    path.write_text("#!/bin/sh\necho unknown\nexit 1\n")
+    assert lq._version_from_output(str(path)) is None
+    assert lq._version_from_output(str(tmp_path / "missing")) is None
+
+    # a binary that doesn't know --version and waits for input instead
+    timeouts.limit = 0.5
+    path.write_text("#!/bin/sh\nexec sleep 30\n")
+    start = time.monotonic()
+    assert lq._version_from_output(str(path)) is None
+    assert time.monotonic() - start < 5
+    assert timeouts == [5, 5, 5, 5]
+
+# A Homebrew prefix with binaries in bin for every way of finding their version
+@pytest.fixture
+def install_dir(tmp_path):
+    install_dir = tmp_path / "homebrew"
+    (install_dir / "bin").mkdir(parents=True)
+    binaries = {
+        "socket_vmnet": macho_image([], [], b"", source_version=packed_version(1, 2, 1)),
+        "docker-credential-osxkeychain": macho_image([], [], b"\0docker-credential-osxkeychain version 0.8.2\0"),
+        # lima and qemu are never run, their versions are already known
+        "limactl": "#!/bin/sh\necho limactl version 0.0.0 > \"$0.ran\"\n",
+        "qemu-img": "#!/bin/sh\necho qemu-img version 0.0.0 > \"$0.ran\"\n",
+        "qemu-system-aarch64": "#!/bin/sh\necho qemu-system-aarch64 version 0.0.0 > \"$0.ran\"\n",
+    }
+    for n in range(3):
+        binaries[f"tool-{n}"] = f"#!/bin/sh\nsleep 1\necho tool-{n} 3.{n}.0\n"
+    for name, content in binaries.items():
+        path = install_dir / "bin" / name
+        path.write_bytes(content if isinstance(content, bytes) else content.encode())
+        path.chmod(0o755)
+    return install_dir
+
+def test_extract_and_export_package_versions(lq, install_dir, tmp_path, monkeypatch, timeouts):
+    (tmp_path / "src" / "lima").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    deps = dict.fromkeys([f"{install_dir}/bin/{path.name}" for path in (install_dir / "bin").iterdir()] + [
+        f"{install_dir}/Cellar/glib/2.82.4/lib/libglib-2.0.0.dylib",
+        f"{install_dir}/Cellar/qemu/9.0.2_1/share/qemu/edk2-aarch64-code.fd",
+    ])
+
+    start = time.monotonic()
+    lq.extract_and_export_package_versions(deps, lq.Arch.AARCH64, str(install_dir), "1.0.1", "9.0.2_1")
+    # the binaries that have to be run are run at the same time
+    assert time.monotonic() - start < 2.5
+    assert len(timeouts) == 3
+
+    with open(tmp_path / "src" / "lima" / "dep-version-mapping-aarch64.json") as f:
+        versions = {name: entry["version"] for name, entry in json.load(f).items()}
+    assert versions == {
+        "glib": "2.82.4",
+        "qemu": "9.0.2_1",
+        "limactl": "1.0.1",
+        # without the Homebrew revision
+        "qemu-img": "9.0.2",
+        "qemu-system-aarch64": "9.0.2",
+        "socket_vmnet": "1.2.1",
+        "docker-credential-osxkeychain": "0.8.2",
+        "tool-0": "3.0.0",
+        "tool-1": "3.1.0",
+        "tool-2": "3.2.0",
+    }
+    assert not list((install_dir / "bin").glob("*.ran"))